@@ -1,29 +1,46 @@
 import argparse
-import ast
 import datetime
 import logging
 import os
 import time
 from ast import literal_eval
-from functools import partial
 from time import sleep as _sleep
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-import pyproj
 import simplejson as json
 
+from app.geo.cache import file_fingerprint as _file_fingerprint
+from app.geo.cache import load_arrays_dir as _load_arrays_dir
+from app.geo.cache import params_hash as _params_hash
+from app.geo.cache import save_arrays_dir as _save_arrays_dir
 from app.geo.util import file_exists as _file_exists
-from app.geo.util import distance_between_geom as _distance_between_geom
-from app.geo.util import split_dataframe as _split_dataframe
+from app.geo.util import geojson_bounds as _geojson_bounds
+from app.geo.util import iter_points_file as _iter_points_file
+from app.geo.util import get_transformer as _get_transformer
+from app.geo.util import line_strings_bounds as _line_strings_bounds
+from app.geo.util import line_strings_to_arrays as _line_strings_to_arrays
+from app.geo.util import load_ndjson as _load_ndjson
+from app.geo.util import parse_bounding_box as _parse_bounding_box
+from app.geo.util import points_to_lines_distance as _points_to_lines_distance
 from app.geo.util import save_records as _save_records
+from app.geo.index import PackedRTree
+from app.geo.writer import ColumnarWriter as _ColumnarWriter
+from app.geo.writer import NDJSONWriter as _NDJSONWriter
+from app.geo.writer import compression_from_path as _compression_from_path
+from app.geo.writer import output_format_from_path as _output_format_from_path
+from app.geo.street_store import StreetStore
 from app.geo.transformer import OSMStreetTransformations
+from app.geo.transformer import decode_geometry as _decode_geometry
+from app.geo.transformer import geometry_type as _geometry_type
+from app.geo.transformer import get_geometry_encoding as _get_geometry_encoding
 
 from app.geo.config import get_geo_config as _get_geo_config
 from app.geo.osm import osm_data_pipeline as _osm_data_pipeline
 
 from app.geo.util import isoencode as _isoencode
-from shapely.geometry import LineString, Point, Polygon
+from shapely.geometry import Point, Polygon
 from shapely.ops import transform
 
 logging.basicConfig()
@@ -35,15 +52,99 @@ __location__ = os.path.realpath(
     )
 
 # Define the project to be used to calculate distances
-PROJECT = partial(
-    pyproj.transform,
-    pyproj.Proj(init='EPSG:4326'),
-    pyproj.Proj(init='EPSG:32633'))
+TRANSFORMER = _get_transformer('EPSG:4326', 'EPSG:32633')
+PROJECT = TRANSFORMER.transform
 
+# Max number of (point, street) pairs measured at once in batch queries
+MAX_PAIRS_PER_CHUNK = 2000000
 
+# Parameters of the street cache; bump the version if the layout changes
+STREET_CACHE_PARAMS = {
+    "version": 3,
+    "crs": ["EPSG:4326", "EPSG:32633"]
+}
 
-def load_street_data(osm_resource, schema, geojson_file_path=None):
+# Prefix of the arrays of the spatial index in the street cache
+STREET_INDEX_PREFIX = 'index_'
+
+# Fields of the transformed street records used by prepare_street_store
+STREET_RECORD_COLUMNS = ['id', 'name', 'geometry', 'types', 'observation_date']
+
+
+
+def street_record_filter(geometry_types=None, highways=None, bounding_box=None):
+    """Filter of transformed street records, see load_street_data
+
+    :param geometry_types: keep the records of these GeoJSON geometry
+        types, e.g., ['LineString']
+    :param highways: keep the records of these highway classes (the
+        highway of types), e.g., ['primary', 'residential']
+    :param bounding_box: keep the records whose geometry bounds intersect
+        "left,bottom,right,top" (longitude/latitude), or a sequence of the
+        four values
+    :return: function of a record returning whether it is kept, None
+        without any filter
+    """
+
+    if (geometry_types is None) and (highways is None) and (bounding_box is None):
+        return None
+
+    if geometry_types is not None:
+        geometry_types = set(geometry_types)
+    if highways is not None:
+        highways = set(highways)
+    if bounding_box is not None:
+        left, bottom, right, top = _parse_bounding_box(bounding_box)
+
+    def is_kept(record):
+
+        if highways is not None:
+            types = record.get('types')
+            if not (isinstance(types, dict) and types.get('highway') in highways):
+                return False
+
+        # the type is read without decoding the geometry
+        if (geometry_types is not None) and (
+            _geometry_type(record.get('geometry')) not in geometry_types
+            ):
+            return False
+
+        if bounding_box is not None:
+            geometry = _decode_geometry(record.get('geometry'))
+            if not geometry:
+                return False
+            bounds = _geojson_bounds(geometry)
+            if (bounds is None) or not (
+                (bounds[0] <= right) and (bounds[2] >= left)
+                and (bounds[1] <= top) and (bounds[3] >= bottom)
+                ):
+                return False
+
+        return True
+
+    return is_kept
+
+
+def load_street_data(
+    osm_resource,
+    schema,
+    geojson_file_path=None,
+    columns=None,
+    geometry_types=None,
+    highways=None,
+    bounding_box=None
+    ):
     """Load street data into geodataframe
+
+    The columns and filters are applied while the file is parsed, rejected
+    records are never loaded into the GeoDataFrame.
+
+    :param columns: only load these fields, e.g., STREET_RECORD_COLUMNS,
+        default to all fields
+    :param geometry_types: only load these geometry types, e.g., ['LineString']
+    :param highways: only load these highway classes
+    :param bounding_box: only load the streets intersecting this bounding
+        box, see street_record_filter
     """
 
     if geojson_file_path:
@@ -52,17 +153,24 @@ def load_street_data(osm_resource, schema, geojson_file_path=None):
             )
 
         if geojson_file_exists:
-            geojson_data = []
-            with open(geojson_file_path) as fp:
-                for line in fp:
-                    geojson_data.append(json.loads(line))
-
-            df_geopandas_output = gpd.GeoDataFrame( geojson_data )
-            del geojson_data
+            load_stats = {}
+            df_geopandas_output = gpd.GeoDataFrame(
+                _load_ndjson(
+                    geojson_file_path,
+                    columns=columns,
+                    record_filter=street_record_filter(
+                        geometry_types=geometry_types,
+                        highways=highways,
+                        bounding_box=bounding_box
+                        ),
+                    stats=load_stats
+                    )
+                )
             df_geopandas_output_length = len(df_geopandas_output)
             _logger.info(
                 f"""Loaded {geojson_file_path} ({geojson_file_size} Mb);
-                    produced GeoDataFrame with {df_geopandas_output_length} rows!"""
+                    produced GeoDataFrame with {df_geopandas_output_length} rows,
+                    rejected {load_stats['rejected']} records!"""
                 )
 
             return df_geopandas_output
@@ -73,7 +181,9 @@ def load_street_data(osm_resource, schema, geojson_file_path=None):
             if not schema:
                 raise Exception('load_street_data did find schema')
 
-            osm_transformer = OSMStreetTransformations()
+            osm_transformer = OSMStreetTransformations(
+                geometry_encoding=_get_geometry_encoding(schema)
+                )
             _osm_data_pipeline(
                 schema=schema,
                 transformations=osm_transformer,
@@ -84,53 +194,286 @@ def load_street_data(osm_resource, schema, geojson_file_path=None):
                 )
 
 
-def prepare_street_data(df_inp):
-    """Prepare street data with geometries to be used for the distance calculations
+def build_street_index(coords_projected, offsets):
+    """Build a packed R-tree over the bounds of the projected street geometries
+
+    The index is built in the projection used for the distances,
+    so that ``max_distance`` can be used directly as search radius.
 
+    :param coords_projected: projected coordinate buffer of the streets
+    :param offsets: offsets of the streets in the coordinate buffer
     """
 
-    # convert geojson dict string to actual dict
-    df_highway_intermediate = df_inp.copy()
-    df_highway_intermediate['geometry'] = df_highway_intermediate.apply(
-        lambda x: ast.literal_eval(x.geometry), axis=1
+    start_time = time.time()
+    street_index = PackedRTree(
+        _line_strings_bounds(coords_projected, offsets)
+        )
+    end_time = time.time()
+    _logger.info(
+        f'Built spatial index of {street_index.size} streets in {end_time - start_time} seconds'
         )
 
+    return street_index
+
+
+def prepare_street_store(df_inp, dtype=None):
+    """Prepare street data as a compact StreetStore for the distance calculations
+
+    Only the LineStrings are kept; their coordinates, the projected
+    coordinates and the columns are encoded into the arrays of the
+    store without copying df_inp.
+
+    :param df_inp: DataFrame of transformed street records
+    :param dtype: dtype of the coordinates of the store, float64 (default) or float32
+    :return: (StreetStore of streets, spatial index of the streets)
+    """
+
+    # filter geometry type before decoding, only the LineStrings are decoded
+    is_line_string = np.array([
+        _geometry_type(geometry) == 'LineString'
+        for geometry in df_inp['geometry'].values
+        ], dtype=bool)
+
+    # decode geometries to geojson dicts, including the python repr
+    # written by older versions of the transformer
+    geometries = [
+        _decode_geometry(geometry)
+        for geometry in df_inp['geometry'].values[is_line_string]
+        ]
+
+    _logger.info('Loaded {} clean geopandas data'.format(len(geometries)))
+
     # extract highway types
-    df_highway_intermediate['highway'] = df_highway_intermediate.apply(
-        lambda x: x.types.get('highway'), axis=1
-        )
-    # extract and filter geometry type
-    df_highway_intermediate['geom_type'] = df_highway_intermediate.apply(
-        lambda x: x.geometry.get('type'), axis=1
-        )
-    df_highway_intermediate = df_highway_intermediate[
-        df_highway_intermediate['geom_type'] == 'LineString'
+    highways = [
+        types.get('highway') if isinstance(types, dict) else None
+        for types in df_inp['types'].values[is_line_string]
         ]
-    # reset index since we have remove some rows
-    df_highway_intermediate.reset_index(drop=True, inplace=True)
 
+    # project all streets at once so that queries only project the point
+    start_time = time.time()
+    street_store = StreetStore.from_columns(
+        (geometry.get('coordinates') for geometry in geometries),
+        df_inp['id'].values[is_line_string],
+        df_inp['name'].values[is_line_string],
+        highways,
+        df_inp['observation_date'].values[is_line_string],
+        transformer=TRANSFORMER,
+        dtype=dtype
+        )
+    del geometries
+    end_time = time.time()
     _logger.info(
-        'Loaded {} clean geopandas data'.format(len(df_highway_intermediate))
+        f'Projected {len(street_store)} streets in {end_time - start_time} seconds'
         )
 
-    # construct actual shapely geometry object
-    df_highway_intermediate['geometry'] = df_highway_intermediate.apply(
-        lambda x: LineString( x.geometry.get('coordinates') ), axis=1
+    street_index = build_street_index(
+        street_store.arrays['coords_projected'], street_store.arrays['offsets']
         )
-    df_highway_intermediate.set_geometry('geometry', inplace=True)
 
-    # select essential columns
-    df_highway_intermediate = df_highway_intermediate[
-        ['geometry', 'id', 'name', 'highway', 'observation_date']
-    ]
+    return street_store, street_index
+
 
-    return df_highway_intermediate
+def prepare_street_data(df_inp):
+    """Prepare street data with geometries to be used for the distance calculations
+
+    :return: (GeoDataFrame of streets, spatial index of the streets)
+    """
+
+    street_store, street_index = prepare_street_store(df_inp)
+
+    return street_store.to_geodataframe(), street_index
+
+
+def query_street_candidates(
+    geo_point_projected, streets_df, street_index, max_distance=None, top_k=None,
+    street_arrays=None
+    ):
+    """Positions of the streets which can be part of the result of a point
+
+    With max_distance, the streets within max_distance are looked up.
+    With top_k only, the search radius grows until the candidates contain
+    top_k different (name, highway), which makes sure that the nearest
+    street of each of the top_k nearest (name, highway) is included.
+    Otherwise all streets are candidates.
+
+    :param geo_point_projected: projected shapely Point
+    :param streets_df: StreetStore or street GeoDataFrame as returned by
+        prepare_street_data
+    :param street_index: spatial index from prepare_street_data
+    :param street_arrays: result of street_query_arrays for streets_df
+    :return: sorted positions of the streets
+    """
+
+    if max_distance:
+        return street_index.query_point(
+            geo_point_projected.x, geo_point_projected.y, max_distance
+            )
+
+    if not top_k:
+        return np.arange(len(streets_df))
+
+    if street_arrays is None:
+        street_arrays = street_query_arrays(streets_df)
+    coords, offsets, name_code, highway_code = street_arrays
+    point = np.array([[geo_point_projected.x, geo_point_projected.y]])
+
+    n_candidates = top_k
+    while True:
+        positions, _ = street_index.nearest(
+            geo_point_projected.x, geo_point_projected.y,
+            lambda x: _points_to_lines_distance(
+                np.repeat(point, len(x), axis=0),
+                np.asarray(x, dtype=np.int64), coords, offsets
+                ),
+            min_results=n_candidates
+            )
+        is_named = (name_code[positions] >= 0) & (highway_code[positions] >= 0)
+        n_streets = len(set(zip(
+            name_code[positions][is_named], highway_code[positions][is_named]
+            )))
+        if (n_streets >= top_k) or (len(positions) >= street_index.size):
+            return positions
+        n_candidates = min(n_candidates * 2, street_index.size)
+
+
+def street_cache_dir(street_resource):
+    """Directory of the street cache of a street resource
+
+    It is located at street_cache_dir of the resource, or next to
+    transformed_json_file.
+    """
+
+    return street_resource.get(
+        'street_cache_dir',
+        f'{street_resource.get("transformed_json_file")}.cache'
+        )
+
+
+def save_street_store(cache_dir, street_store, street_index, source_file, params=None):
+    """Save a StreetStore and its spatial index as memory mappable street cache
+
+    :param cache_dir: directory of the cache
+    :param source_file: file the streets are prepared from
+    :param params: parameters the streets depend on
+    """
+
+    arrays = street_store.to_arrays()
+    for key, value in street_index.to_arrays().items():
+        arrays[f'{STREET_INDEX_PREFIX}{key}'] = value
+
+    return _save_arrays_dir(cache_dir, arrays, source_file, params=params)
+
+
+def attach_street_store(cache_dir, source_file=None, params=None):
+    """Map a street cache written by save_street_store into memory
+
+    The arrays are memory mapped read only without copying, so that all
+    processes attached to the same cache share one physical copy of the
+    streets and the spatial index.
+
+    :param source_file: only attach if the cache is up to date for source_file
+    :param params: only attach if the cache was saved with params
+    :return: (StreetStore of streets, spatial index of the streets), None
+        if the cache is missing or outdated; cache_dir of the store is set
+    """
 
+    arrays = _load_arrays_dir(cache_dir, source_file=source_file, params=params)
+    if arrays is None:
+        return None
 
-def street_distance_to_point(geo_point, streets_df, max_distance=None):
+    index_arrays = {
+        key[len(STREET_INDEX_PREFIX):]: arrays.pop(key)
+        for key in list(arrays) if key.startswith(STREET_INDEX_PREFIX)
+    }
+
+    return (
+        StreetStore.from_arrays(arrays, cache_dir=os.path.abspath(cache_dir)),
+        PackedRTree.from_arrays(index_arrays)
+        )
+
+
+def load_street_store(street_resource, schema, use_cache=None, dtype=None):
+    """Load prepared street data as StreetStore, from the street cache if it is up to date
+
+    The cache (see street_cache_dir) is rebuilt whenever
+    transformed_json_file changes. Streets loaded from the cache are
+    memory mapped, see attach_street_store.
+
+    Only the fields and the LineStrings used by prepare_street_store are
+    loaded; street_filter of the resource can restrict the streets to
+    "highways" classes and a "bounding_box", see street_record_filter.
+
+    :param street_resource: street resource from the config
+    :param use_cache: whether to use the street cache, default to True
+    :param dtype: dtype of the coordinates, see prepare_street_store
+    :return: (StreetStore of streets, spatial index of the streets)
+    """
+
+    if use_cache is None:
+        use_cache = True
+    if dtype is None:
+        dtype = np.float64
+
+    transformed_json_file = street_resource.get('transformed_json_file')
+    cache_dir = street_cache_dir(street_resource)
+    street_filter = street_resource.get('street_filter') or {}
+    cache_params = {
+        **STREET_CACHE_PARAMS,
+        "dtype": np.dtype(dtype).name,
+        "street_filter": street_filter
+    }
+
+    if use_cache:
+        start_time = time.time()
+        street_data = attach_street_store(
+            cache_dir, source_file=transformed_json_file, params=cache_params
+            )
+        if street_data is not None:
+            end_time = time.time()
+            _logger.info(
+                f'Loaded {len(street_data[0])} streets from cache {cache_dir} in {end_time - start_time} seconds'
+                )
+            return street_data
+
+    df_streets = load_street_data(
+        street_resource,
+        schema=schema,
+        geojson_file_path=transformed_json_file,
+        columns=STREET_RECORD_COLUMNS,
+        geometry_types=['LineString'],
+        highways=street_filter.get('highways'),
+        bounding_box=street_filter.get('bounding_box')
+        )
+    street_store, street_index = prepare_street_store(df_streets, dtype=dtype)
+    del df_streets
+
+    if use_cache:
+        try:
+            save_street_store(
+                cache_dir, street_store, street_index, transformed_json_file,
+                params=cache_params
+                )
+        except Exception as ee:
+            _logger.warning(f'Could not save street cache {cache_dir}: {ee}')
+        else:
+            # use the mapped arrays, which are shared with other processes
+            street_data = attach_street_store(cache_dir)
+            if street_data is not None:
+                return street_data
+
+    return street_store, street_index
+
+
+def street_distance_to_point(
+    geo_point, streets_df, max_distance=None, street_index=None, top_k=None
+    ):
     """Calculate distance from a point to streets and fine the
 
     :param geo_point: (longitude,latitude), this should be a string
+    :param street_index: spatial index from prepare_street_data; if specified
+        together with max_distance or top_k, only the streets close to the
+        point are considered instead of all the streets in streets_df
+    :param top_k: only return the top_k nearest streets
     """
     if isinstance(geo_point, (str)):
         geo_point = literal_eval(geo_point)
@@ -138,27 +481,49 @@ def street_distance_to_point(geo_point, streets_df, max_distance=None):
     geo_point = Point(geo_point_longitude, geo_point_latitude)
 
     start_time = time.time()
-    streets_df['distance'] = streets_df.apply(
-        lambda x: _distance_between_geom(x.geometry, geo_point, PROJECT), axis=1
+    # streets are projected in prepare_street_data, only project the point
+    geo_point_projected = Point(
+        PROJECT(geo_point_longitude, geo_point_latitude)
         )
+
+    if (street_index is not None) and (max_distance or top_k):
+        streets_df = streets_df.iloc[
+            query_street_candidates(
+                geo_point_projected, streets_df, street_index,
+                max_distance=max_distance,
+                top_k=top_k
+                )
+            ].copy()
+
+    if streets_df.empty:
+        streets_df = streets_df.assign(distance=[])
+    else:
+        streets_df['distance'] = streets_df['geometry_projected'].apply(
+            geo_point_projected.distance
+            )
     end_time = time.time()
     _logger.debug(f'{end_time - start_time} seconds used ended for {geo_point}')
 
     if max_distance:
         streets_df = streets_df[ streets_df['distance'] <= max_distance ]
 
+    if not streets_df.empty:
+        # nearest street of every (name, highway), sorted by distance
+        streets_df = streets_df.iloc[
+            nearest_per_street(
+                np.zeros(len(streets_df), dtype=np.int64),
+                np.arange(len(streets_df)),
+                streets_df['distance'].values,
+                pd.factorize(streets_df['name'], sort=True)[0],
+                pd.factorize(streets_df['highway'], sort=True)[0],
+                top_k=top_k
+                )
+            ]
+
     if streets_df.empty:
         _logger.warning(f"Got no nearby streets!")
         return [], datetime.datetime.today().strftime('%Y-%m-%d')
     else:
-        streets_df = streets_df.groupby(
-            ['name','highway']
-            ).apply(
-                lambda x: x.sort_values(by='distance').iloc[0]
-                )
-
-        streets_df = streets_df.reset_index(drop=True).sort_values(by='distance')
-
         observation_date = streets_df.observation_date.iloc[0]
 
         return streets_df[['id', 'name', 'highway', 'distance']].to_dict(
@@ -166,55 +531,524 @@ def street_distance_to_point(geo_point, streets_df, max_distance=None):
             ), observation_date
 
 
-def save_data(records, output):
+def parse_geo_points(geo_points):
+    """Convert points to an array of (longitude, latitude) of shape (n, 2)
 
-    # Check if the output json file exists
-    street_distance_json_file = output
-    street_distance_json_file_exists, _ = _file_exists(
-        street_distance_json_file
-        )
+    :param geo_points: array, or iterable of (longitude,latitude) tuples or strings
+    """
 
-    if street_distance_json_file_exists:
-        _logger.info(
-            street_distance_json_file + ' already exists! Will delete the file'
+    if isinstance(geo_points, np.ndarray):
+        return geo_points.astype(np.float64).reshape(-1, 2)
+
+    return np.array(
+        [
+            literal_eval(geo_point) if isinstance(geo_point, str) else geo_point
+            for geo_point in geo_points
+        ],
+        dtype=np.float64
+        ).reshape(-1, 2)
+
+
+def nearest_per_street(
+    point_index, street_position, distance, name_code, highway_code, top_k=None
+    ):
+    """Select the nearest street of every (point, name, highway) group
+
+    Pairs with missing name or highway (code -1) are dropped, just like
+    groupby does. Ties are resolved by the position of the street.
+
+    :param point_index: array of point indices of the (point, street) pairs
+    :param street_position: array of street positions of the pairs
+    :param distance: array of distances of the pairs
+    :param name_code: array of sorted factorized names of the streets of the pairs
+    :param highway_code: array of sorted factorized highways of the streets of the pairs
+    :param top_k: only keep the top_k nearest streets of every point
+    :return: positions of the selected pairs, sorted by point_index and distance
+    """
+
+    selected = np.nonzero((name_code >= 0) & (highway_code >= 0))[0]
+    selected = selected[np.lexsort((
+        street_position[selected],
+        distance[selected],
+        highway_code[selected],
+        name_code[selected],
+        point_index[selected]
+    ))]
+
+    is_first = np.ones(len(selected), dtype=bool)
+    is_first[1:] = (
+        (np.diff(point_index[selected]) != 0)
+        | (np.diff(name_code[selected]) != 0)
+        | (np.diff(highway_code[selected]) != 0)
+        )
+    selected = selected[is_first]
+    selected = selected[np.lexsort((distance[selected], point_index[selected]))]
+
+    if top_k:
+        # rank of the streets within each point
+        point_start = np.ones(len(selected), dtype=bool)
+        point_start[1:] = np.diff(point_index[selected]) != 0
+        point_start_position = np.nonzero(point_start)[0]
+        rank = np.arange(len(selected)) - np.repeat(
+            point_start_position, np.diff(np.append(point_start_position, len(selected)))
             )
-        try:
-            os.remove(street_distance_json_file)
-        except Exception as ee:
-            raise Exception(
-                'Could not remove old data file for apt nearby streets'
+        selected = selected[rank < top_k]
+
+    return selected
+
+
+def street_query_arrays(streets_df):
+    """Arrays of the streets used by street_distances_to_points
+
+    They only depend on the streets, so they can be computed once when
+    many queries are answered with the same streets.
+
+    :param streets_df: StreetStore or street GeoDataFrame as returned by
+        prepare_street_data
+    :return tuple: (coords, offsets, name_code, highway_code)
+    """
+
+    if isinstance(streets_df, StreetStore):
+        return streets_df.query_arrays()
+
+    coords, offsets = _line_strings_to_arrays(streets_df['geometry_projected'])
+    name_code, _ = pd.factorize(streets_df['name'], sort=True)
+    highway_code, _ = pd.factorize(streets_df['highway'], sort=True)
+
+    return coords, offsets, name_code, highway_code
+
+
+def street_distances_to_points(
+    geo_points, streets_df, max_distance=None, street_index=None, top_k=None,
+    chunk_size=None, street_arrays=None
+    ):
+    """Calculate distances from many points to streets at once
+
+    The result for each point is the same as street_distance_to_point.
+    All points are projected with one call, the (point, street) pairs
+    are measured with numpy and the nearest street of every name and
+    highway is selected without groupby.
+
+    :param geo_points: (longitude,latitude) points, e.g. an array of shape (n, 2)
+    :param streets_df: StreetStore or street GeoDataFrame as returned by
+        prepare_street_data
+    :param max_distance: only streets within max_distance meters are returned
+    :param street_index: spatial index from prepare_street_data
+    :param top_k: only return the top_k nearest streets of every point
+    :param chunk_size: number of points measured at once; by default it is
+        chosen such that at most MAX_PAIRS_PER_CHUNK pairs are measured at once
+    :param street_arrays: result of street_query_arrays for streets_df
+    :return: DataFrame with columns point_index, id, name, highway and
+        distance, sorted by point_index and distance
+    """
+
+    geo_points = parse_geo_points(geo_points)
+    n_points = len(geo_points)
+    n_streets = len(streets_df)
+
+    if chunk_size is None:
+        chunk_size = max(1, MAX_PAIRS_PER_CHUNK // max(n_streets, 1))
+
+    start_time = time.time()
+    points_x, points_y = PROJECT(geo_points[:, 0], geo_points[:, 1])
+    points_projected = np.column_stack([points_x, points_y])
+
+    if street_arrays is None:
+        street_arrays = street_query_arrays(streets_df)
+    coords, offsets, name_code, highway_code = street_arrays
+
+    res_point_index = []
+    res_street_position = []
+    res_distance = []
+    for chunk_start in range(0, n_points, chunk_size):
+        chunk_points = np.arange(chunk_start, min(chunk_start + chunk_size, n_points))
+
+        if (street_index is not None) and (max_distance or top_k):
+            candidates = [
+                query_street_candidates(
+                    Point(points_projected[i]), streets_df, street_index,
+                    max_distance=max_distance,
+                    top_k=top_k,
+                    street_arrays=street_arrays
+                    )
+                for i in chunk_points
+            ]
+            pair_point = np.repeat(
+                chunk_points, [len(candidate) for candidate in candidates]
                 )
+            pair_street = np.concatenate(candidates).astype(np.int64)
+        else:
+            pair_point = np.repeat(chunk_points, n_streets)
+            pair_street = np.tile(np.arange(n_streets, dtype=np.int64), len(chunk_points))
 
-    _save_records(records, output)
+        pair_distance = _points_to_lines_distance(
+            points_projected[pair_point], pair_street, coords, offsets
+            )
 
+        if max_distance:
+            is_near = pair_distance <= max_distance
+            pair_point = pair_point[is_near]
+            pair_street = pair_street[is_near]
+            pair_distance = pair_distance[is_near]
 
-# Connecting the pipes
-def geo_distance_calculator(street_resource, geo_points, schema):
-    """Calculate distances to the given point
+        nearest = nearest_per_street(
+            pair_point, pair_street, pair_distance,
+            name_code[pair_street], highway_code[pair_street],
+            top_k=top_k
+            )
+        res_point_index.append(pair_point[nearest])
+        res_street_position.append(pair_street[nearest])
+        res_distance.append(pair_distance[nearest])
+
+    if n_points:
+        street_position = np.concatenate(res_street_position)
+        point_index = np.concatenate(res_point_index)
+        distance = np.concatenate(res_distance)
+    else:
+        street_position = point_index = np.zeros(0, dtype=np.int64)
+        distance = np.zeros(0, dtype=np.float64)
+
+    end_time = time.time()
+    _logger.debug(
+        f'{end_time - start_time} seconds used for {n_points} points'
+        )
+
+    df_distances = {
+        'point_index': point_index,
+        'distance': distance
+    }
+    for column in ['id', 'name', 'highway']:
+        if isinstance(streets_df, StreetStore):
+            df_distances[column] = streets_df.column_values(column, street_position)
+        else:
+            df_distances[column] = streets_df[column].values[street_position]
+
+    return pd.DataFrame(
+        df_distances, columns=['point_index', 'id', 'name', 'highway', 'distance']
+        )
+
+
+def save_data(records, output, compression=None):
+    """Write records to a line delimited json file, replacing it atomically
+
+    :param compression: gzip, zstd or None, default to the file extension
+        of output, e.g., .gz
     """
 
-    if not schema:
-        raise Exception('geo_distance_calculator did not find schema')
+    with _NDJSONWriter(output, compression=compression) as writer:
+        writer.write_records(records)
 
-    # Load transformed street data
-    df_streets = load_street_data(
-        street_resource,
-        schema=schema,
-        geojson_file_path=street_resource.get('transformed_json_file')
+
+def distances_to_records(df_distances, n_points):
+    """Split the result of street_distances_to_points into records per point
+
+    :param df_distances: DataFrame as returned by street_distances_to_points
+    :param n_points: number of points of the query
+    :return list: {"records": [...]} for every point
+    """
+
+    # rows of each point are consecutive since they are sorted by point_index
+    point_bounds = np.searchsorted(
+        df_distances['point_index'].values, np.arange(n_points + 1)
         )
-    df_streets = prepare_street_data(df_streets)
 
     res = []
-    for geo_point in geo_points:
-        geo_records, date = street_distance_to_point(geo_point, df_streets)
+    for point_start, point_end in zip(point_bounds[:-1], point_bounds[1:]):
+        geo_records = df_distances.iloc[point_start:point_end][
+            ['id', 'name', 'highway', 'distance']
+            ].to_dict(orient='record')
+        if not geo_records:
+            _logger.warning(f"Got no nearby streets!")
         res.append(
             {
                 "records": geo_records
             }
         )
 
+    return res
+
+
+# Connecting the pipes
+def iter_geo_distance_calculator(
+    street_resource, geo_points, schema, max_distance=None, top_k=None,
+    use_cache=None, dtype=None, workers=None, chunk_size=None, chunk_stats=None,
+    points_file=None, skip_chunks=None, as_columns=None
+    ):
+    """Calculate distances to the given points in chunks
+
+    The chunks are answered by a pool of workers sharing the streets, see
+    iter_parallel_distances, and returned in the order of the points.
+
+    :param geo_points: (longitude,latitude) points, ignored with points_file
+    :param max_distance: only streets within max_distance meters are returned
+    :param top_k: only the top_k nearest streets are returned
+    :param use_cache: whether to use the street cache, default to True
+    :param dtype: dtype of the street coordinates, see prepare_street_store
+    :param workers: number of processes, default to 1
+    :param chunk_size: number of points answered at once by a worker
+    :param list chunk_stats: receives the timing of every chunk
+    :param points_file: csv, ndjson or parquet file of points, which is
+        read chunk by chunk, see iter_points_file
+    :param skip_chunks: number of chunks to skip, e.g., to resume a run
+    :param as_columns: return columns instead of records, see
+        distances_to_columns
+    :return: generator of the records of every chunk, one {"records": [...]}
+        per point, or of the columns of every chunk
+    """
+
+    from app.query_executor import QUERY_CHUNK_SIZE as _QUERY_CHUNK_SIZE
+    from app.query_executor import iter_parallel_distances as _iter_parallel_distances
+    from app.query_executor import split_points as _split_points
+
+    if use_cache is None:
+        use_cache = True
+    if chunk_size is None:
+        chunk_size = _QUERY_CHUNK_SIZE
+    if skip_chunks is None:
+        skip_chunks = 0
+
+    if not schema:
+        raise Exception('geo_distance_calculator did not find schema')
+
+    # Load transformed street data
+    street_store, street_index = load_street_store(
+        street_resource, schema, use_cache=use_cache, dtype=dtype
+        )
+
+    if points_file:
+        point_chunks = _iter_points_file(
+            points_file, chunk_size=chunk_size, skip_chunks=skip_chunks
+            )
+    else:
+        point_chunks = _split_points(geo_points, chunk_size=chunk_size)[skip_chunks:]
+
+    return _iter_parallel_distances(
+        street_store, street_index, point_chunks,
+        max_distance=max_distance,
+        top_k=top_k,
+        workers=workers,
+        chunk_stats=chunk_stats,
+        as_columns=as_columns,
+        point_offset=skip_chunks * chunk_size
+        )
+
+
+def geo_distance_calculator(
+    street_resource, geo_points, schema, max_distance=None, top_k=None,
+    use_cache=None, dtype=None, workers=None, chunk_size=None
+    ):
+    """Calculate distances to the given point
+
+    :param max_distance: only streets within max_distance meters are returned
+    :param top_k: only the top_k nearest streets are returned
+    :param use_cache: whether to use the street cache, default to True
+    :param dtype: dtype of the street coordinates, see prepare_street_store
+    :param workers: number of processes, see iter_geo_distance_calculator
+    :param chunk_size: number of points answered at once by a worker
+    """
+
+    return {
+        "data": [
+            record
+            for records in iter_geo_distance_calculator(
+                street_resource, geo_points, schema,
+                max_distance=max_distance,
+                top_k=top_k,
+                use_cache=use_cache,
+                dtype=dtype,
+                workers=workers,
+                chunk_size=chunk_size
+                )
+            for record in records
+        ]
+    }
+
+
+def distance_progress_file(output):
+    """Progress of geo_distance_calculator_to_file, stored next to the output
+    """
+
+    return f'{output}.progress.json'
+
+
+def write_columnar_distances(
+    street_resource, schema, output, geo_points=None, points_file=None,
+    max_distance=None, top_k=None, use_cache=None, dtype=None, workers=None,
+    chunk_size=None, output_format=None
+    ):
+    """Calculate distances to points and write them as Parquet or Arrow table
+
+    Instead of records per point, the table has one row per (point,
+    street) with the columns of DISTANCE_COLUMNS: point_index, longitude,
+    latitude, id, name, highway and distance. The columns are written
+    from the arrays of every chunk, without building python records.
+
+    :param output_format: parquet or arrow, default to the file extension
+    :return dict: log with the number of chunks, points and rows
+    """
+
+    from app.query_executor import DISTANCE_COLUMNS as _DISTANCE_COLUMNS
+
+    chunk_stats = []
+    start_time = time.time()
+    with _ColumnarWriter(
+        output, _DISTANCE_COLUMNS, file_format=output_format
+        ) as writer:
+        for columns in iter_geo_distance_calculator(
+            street_resource, geo_points, schema,
+            max_distance=max_distance,
+            top_k=top_k,
+            use_cache=use_cache,
+            dtype=dtype,
+            workers=workers,
+            chunk_size=chunk_size,
+            chunk_stats=chunk_stats,
+            points_file=points_file,
+            as_columns=True
+            ):
+            writer.write_columns(columns)
+
+    seconds = time.time() - start_time
+    n_points = sum(stats['points'] for stats in chunk_stats)
+    _logger.info(
+        f'Wrote {writer.rows} rows of {n_points} points to {output} in {seconds} seconds'
+        )
+
+    return {
+        "output": output,
+        "chunks": len(chunk_stats),
+        "points": n_points,
+        "rows": writer.rows,
+        "seconds": seconds
+    }
+
+
+def geo_distance_calculator_to_file(
+    street_resource, schema, output, geo_points=None, points_file=None,
+    max_distance=None, top_k=None, use_cache=None, dtype=None, workers=None,
+    chunk_size=None, resume=None, output_format=None
+    ):
+    """Calculate distances to points and write the records chunk by chunk
+
+    The records are appended to output + .part as soon as a chunk is
+    answered, which is renamed to output at the end, so that memory does
+    not grow with the number of points. After every chunk the progress is
+    saved; with resume, an interrupted run with the same points and
+    parameters continues after the last completed chunk.
+
+    :param output: path to the output file, compressed with gzip or zstd
+        for the extensions .gz or .zst
+    :param geo_points: (longitude,latitude) points
+    :param points_file: csv, ndjson or parquet file of points instead of geo_points
+    :param resume: continue an interrupted run, default to False
+    :param output_format: ndjson, parquet or arrow, default to the file
+        extension of output, see write_columnar_distances
+    :return dict: log with the number of chunks and points
+    """
+
+    from app.query_executor import QUERY_CHUNK_SIZE as _QUERY_CHUNK_SIZE
+
+    if chunk_size is None:
+        chunk_size = _QUERY_CHUNK_SIZE
+    if output_format is None:
+        output_format = _output_format_from_path(output)
+
+    if output_format != 'ndjson':
+        if resume:
+            _logger.warning(f'{output_format} output can not be resumed, starting over')
+        return write_columnar_distances(
+            street_resource, schema, output,
+            geo_points=geo_points,
+            points_file=points_file,
+            max_distance=max_distance,
+            top_k=top_k,
+            use_cache=use_cache,
+            dtype=dtype,
+            workers=workers,
+            chunk_size=chunk_size,
+            output_format=output_format
+            )
+
+    part_file = f'{output}.part'
+    progress_file = distance_progress_file(output)
+    run_params_hash = _params_hash({
+        "street_resource": street_resource,
+        "points_file": points_file,
+        "points_file_fingerprint": (
+            _file_fingerprint(points_file, with_hash=False) if points_file else None
+            ),
+        "geo_points": None if points_file else [str(x) for x in geo_points],
+        "max_distance": max_distance,
+        "top_k": top_k,
+        "dtype": np.dtype(dtype or np.float64).name,
+        "chunk_size": chunk_size
+    })
+
+    progress = None
+    if resume and os.path.isfile(progress_file) and os.path.isfile(part_file):
+        with open(progress_file, 'r') as fp:
+            progress = json.load(fp)
+        if (
+            (progress.get('params_hash') != run_params_hash)
+            or (os.path.getsize(part_file) < progress.get('output_bytes', 0))
+            ):
+            _logger.warning(f'{progress_file} does not match this run, starting over')
+            progress = None
+
+    if progress is None:
+        progress = {
+            "params_hash": run_params_hash,
+            "chunks": 0,
+            "points": 0,
+            "output_bytes": 0
+        }
+    else:
+        _logger.info(
+            f'Resuming {output} after {progress["chunks"]} chunks ({progress["points"]} points)'
+            )
+    resumed_chunks = progress['chunks']
+
+    # drop whatever was written after the last completed chunk
+    with open(part_file, 'a+') as fp:
+        fp.truncate(progress['output_bytes'])
+
+    start_time = time.time()
+    for records in iter_geo_distance_calculator(
+        street_resource, geo_points, schema,
+        max_distance=max_distance,
+        top_k=top_k,
+        use_cache=use_cache,
+        dtype=dtype,
+        workers=workers,
+        chunk_size=chunk_size,
+        points_file=points_file,
+        skip_chunks=resumed_chunks
+        ):
+        _save_records(
+            records, part_file, is_flush=True, compression=_compression_from_path(output)
+            )
+        progress['chunks'] += 1
+        progress['points'] += len(records)
+        progress['output_bytes'] = os.path.getsize(part_file)
+        with open(f'{progress_file}.tmp', 'w') as fp:
+            json.dump(progress, fp)
+        os.replace(f'{progress_file}.tmp', progress_file)
+
+    os.replace(part_file, output)
+    if os.path.isfile(progress_file):
+        os.remove(progress_file)
+
+    seconds = time.time() - start_time
+    _logger.info(
+        f'Wrote {progress["points"]} points in {progress["chunks"]} chunks to {output} in {seconds} seconds'
+        )
+
     return {
-        "data": res
+        "output": output,
+        "chunks": progress['chunks'],
+        "points": progress['points'],
+        "resumed_chunks": resumed_chunks,
+        "seconds": seconds
     }
 
 
@@ -246,17 +1080,35 @@ def main():
         help='Specify the points to be calculated; e.g., (10.2323,52.9384) (10.012,52.1923)'
     )
 
+    parser.add_argument(
+        '--points-file',
+        dest='points_file',
+        help='csv, ndjson or parquet file with longitude and latitude columns, read in chunks instead of -p'
+    )
+
+    parser.add_argument(
+        '--output-format',
+        dest='output_format',
+        choices=['ndjson', 'parquet', 'arrow'],
+        help='Format of the output, default to the file extension (.parquet, .arrow) or ndjson'
+    )
+
+    parser.add_argument(
+        '--resume',
+        dest='resume',
+        action='store_true',
+        help='Continue an interrupted run with the same points after its last completed chunk'
+    )
+
     parser.add_argument(
         '-cfg','--config',
         dest='config',
-        nargs='+',
         help='Definition of OSM data parameters'
     )
 
     parser.add_argument(
         '-s','--schema',
         dest='schema_path',
-        nargs='+',
         help='Definition of OSM data parameters'
     )
 
@@ -266,23 +1118,113 @@ def main():
         help='Path to output data'
     )
 
+    parser.add_argument(
+        '-d', '--max-distance',
+        dest='max_distance',
+        type=float,
+        help='Only output streets within this distance (in meters) of the points'
+    )
+
+    parser.add_argument(
+        '-k', '--top-k',
+        dest='top_k',
+        type=int,
+        help='Only output the k nearest streets of the points'
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        dest='use_cache',
+        action='store_false',
+        help='Do not load or save the street cache'
+    )
+
+    parser.add_argument(
+        '-w', '--workers',
+        dest='workers',
+        type=int,
+        default=1,
+        help='Number of processes answering the points'
+    )
+
+    parser.add_argument(
+        '--chunk-size',
+        dest='chunk_size',
+        type=int,
+        help='Number of points answered at once by a worker'
+    )
+
+    parser.add_argument(
+        '--float32',
+        dest='float32',
+        action='store_true',
+        help='Keep street coordinates as float32, which halves their memory'
+    )
+
+    parser.add_argument(
+        '--serve',
+        dest='serve',
+        action='store_true',
+        help='Keep the streets loaded and answer queries over http instead of -p'
+    )
+
+    parser.add_argument(
+        '--host',
+        dest='host',
+        default='127.0.0.1',
+        help='Host of the query server'
+    )
+
+    parser.add_argument(
+        '--port',
+        dest='port',
+        type=int,
+        default=8080,
+        help='Port of the query server'
+    )
+
+    parser.add_argument(
+        '--socket',
+        dest='unix_socket',
+        help='Path of a unix socket the query server listens on instead of --host and --port'
+    )
+
+    parser.add_argument(
+        '--max-batch-points',
+        dest='max_batch_points',
+        type=int,
+        help='Max number of points of concurrent requests answered together'
+    )
+
+    parser.add_argument(
+        '--max-batch-wait',
+        dest='max_batch_wait',
+        type=float,
+        help='Max milliseconds a request waits for others to join its batch'
+    )
+
     args = parser.parse_args()
     _logger.setLevel(args.verbose)
+    logging.getLogger('app.query-executor').setLevel(args.verbose)
 
     city = args.city
     geo_points = args.point
     output_path = args.output
     config_path = args.config
-    schema_path = args.schema
+    schema_path = args.schema_path
+    max_distance = args.max_distance
+    top_k = args.top_k
+    use_cache = args.use_cache
+    dtype = np.float32 if args.float32 else None
 
-    if not config_path:
+    if config_path:
         GEO_CONFIG = _get_geo_config(config_path)
     else:
         GEO_CONFIG = _get_geo_config()
 
     GEO_RESOURCES = GEO_CONFIG.get('resources')
 
-    if not output_path:
+    if not (output_path or args.serve):
         raise Exception('Did not specify output path: -o')
 
     if city:
@@ -301,14 +1243,39 @@ def main():
     with open(schema_path, 'rb') as schema_file:
         schema = json.load(schema_file)
 
-    res = geo_distance_calculator(
-        city_resource, geo_points, schema
+    if args.serve:
+        from app.query_server import serve as _serve
+        _serve(
+            city_resource, schema,
+            host=args.host,
+            port=args.port,
+            unix_socket=args.unix_socket,
+            use_cache=use_cache,
+            dtype=dtype,
+            max_batch_points=args.max_batch_points,
+            max_wait=(
+                args.max_batch_wait / 1000 if args.max_batch_wait is not None else None
+                )
+            )
+        return
+
+    if not (geo_points or args.points_file):
+        raise Exception('Did not specify points: -p or --points-file')
+
+    return geo_distance_calculator_to_file(
+        city_resource, schema, output_path,
+        geo_points=geo_points,
+        points_file=args.points_file,
+        max_distance=max_distance,
+        top_k=top_k,
+        use_cache=use_cache,
+        dtype=dtype,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        resume=args.resume,
+        output_format=args.output_format
         )
 
-    save_data(res.get('data'), output_path)
-
-    return res
-
 
 if __name__ == "__main__":
 
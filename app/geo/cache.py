@@ -0,0 +1,270 @@
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import simplejson as json
+
+logging.basicConfig()
+_logger = logging.getLogger('app.geo.cache')
+
+# File with the metadata of a directory of mappable arrays
+CACHE_META_FILE = 'cache_meta.json'
+
+# sha256 of the files hashed by this process, keyed on path, size and mtime
+_FILE_HASHES = {}
+
+
+def file_fingerprint(file_path, with_hash=None, block_size=None):
+    """Size, modification time and (optionally) sha256 of a file
+
+    :param file_path: path to the file
+    :param with_hash: whether to calculate the sha256 of the content
+    :param block_size: size of the blocks read to calculate the hash
+    """
+
+    if with_hash is None:
+        with_hash = True
+    if block_size is None:
+        block_size = 1 << 24
+
+    file_stat = os.stat(file_path)
+    fingerprint = {
+        "size": file_stat.st_size,
+        "mtime": file_stat.st_mtime
+    }
+
+    if with_hash:
+        hash_key = (os.path.realpath(file_path), file_stat.st_size, file_stat.st_mtime)
+        if hash_key not in _FILE_HASHES:
+            file_hash = hashlib.sha256()
+            with open(file_path, 'rb') as fp:
+                for block in iter(lambda: fp.read(block_size), b''):
+                    file_hash.update(block)
+            _FILE_HASHES[hash_key] = file_hash.hexdigest()
+        fingerprint['sha256'] = _FILE_HASHES[hash_key]
+
+    return fingerprint
+
+
+def is_fingerprint_valid(cached_fingerprint, file_path):
+    """Check if the file still matches the fingerprint stored in a cache
+
+    The content is only hashed when the size matches but the modification
+    time does not, e.g. if the file has been copied or touched.
+    """
+
+    if not os.path.isfile(file_path):
+        return False
+
+    current = file_fingerprint(file_path, with_hash=False)
+    if current['size'] != cached_fingerprint.get('size'):
+        return False
+    if current['mtime'] == cached_fingerprint.get('mtime'):
+        return True
+
+    _logger.info(f'{file_path} has been modified, comparing content hash')
+    current = file_fingerprint(file_path)
+
+    return current['sha256'] == cached_fingerprint.get('sha256')
+
+
+def save_arrays_dir(cache_dir, arrays, source_file, params=None):
+    """Save numpy arrays as a directory of npy files keyed on the source file
+
+    The npy files can be memory mapped with load_arrays_dir, so that
+    processes loading the same cache share one copy of the arrays in the
+    page cache.
+
+    The arrays are written to a temporary directory which replaces
+    cache_dir afterwards, so that a crash never leaves a partial cache
+    behind; processes which have mapped the old arrays can keep using
+    them. The replacement takes two renames and is not atomic: in between,
+    cache_dir does not exist and processes loading it miss the cache.
+
+    :param cache_dir: path to the directory
+    :param dict arrays: name -> numpy array, names have to be valid file names
+    :param source_file: file the arrays are derived from, None for a
+        cache which is not kept, e.g., for the workers of one run
+    :param dict params: parameters the arrays depend on
+    """
+
+    cache_meta = {
+        "source_file": source_file,
+        "fingerprint": None if source_file is None else file_fingerprint(source_file),
+        "params": params or {},
+        "arrays": sorted(arrays)
+    }
+
+    cache_dir = os.path.abspath(cache_dir)
+    cache_dir_temp = f'{cache_dir}.tmp-{os.getpid()}'
+    cache_dir_old = f'{cache_dir}.old-{os.getpid()}'
+    shutil.rmtree(cache_dir_temp, ignore_errors=True)
+    os.makedirs(cache_dir_temp)
+
+    for key, value in arrays.items():
+        np.save(
+            os.path.join(cache_dir_temp, f'{key}.npy'),
+            # ascontiguousarray would turn 0-d arrays into shape (1,)
+            np.asarray(value, order='C'),
+            allow_pickle=False
+            )
+    with open(os.path.join(cache_dir_temp, CACHE_META_FILE), 'w') as fp:
+        json.dump(cache_meta, fp, indent=2)
+
+    if os.path.isdir(cache_dir):
+        os.replace(cache_dir, cache_dir_old)
+    os.replace(cache_dir_temp, cache_dir)
+    shutil.rmtree(cache_dir_old, ignore_errors=True)
+
+    _logger.info(f'Saved cache {cache_dir} for {source_file}')
+
+    return cache_meta
+
+
+def load_arrays_dir(cache_dir, source_file=None, params=None, mmap_mode=None):
+    """Load numpy arrays from a directory written by save_arrays_dir
+
+    :param source_file: the cache is only loaded if it is still valid for
+        source_file; None skips the check, e.g., for worker processes
+        attaching to a cache prepared by their parent
+    :param params: the cache is only loaded if it was saved with params,
+        None skips the check
+    :param mmap_mode: mmap_mode of numpy.load, default to r (read only,
+        shared); False loads the arrays into memory
+    :return: dict of arrays or None if the cache is missing or outdated
+    """
+
+    if mmap_mode is None:
+        mmap_mode = 'r'
+
+    cache_meta_file = os.path.join(cache_dir, CACHE_META_FILE)
+    if not os.path.isfile(cache_meta_file):
+        return None
+
+    try:
+        with open(cache_meta_file, 'r') as fp:
+            cache_meta = json.load(fp)
+        if (params is not None) and (cache_meta.get('params') != params):
+            _logger.info(f'Cache {cache_dir} was built with other params')
+            return None
+        if (source_file is not None) and not is_fingerprint_valid(
+            cache_meta.get('fingerprint', {}), source_file
+            ):
+            _logger.info(f'Cache {cache_dir} is outdated')
+            return None
+        arrays = {
+            key: np.load(
+                os.path.join(cache_dir, f'{key}.npy'),
+                mmap_mode=mmap_mode or None,
+                allow_pickle=False
+                )
+            for key in cache_meta['arrays']
+        }
+    except Exception as ee:
+        _logger.warning(f'Could not load cache {cache_dir}: {ee}')
+        return None
+
+    return arrays
+
+
+def params_hash(params):
+    """sha256 of json serialisable parameters, independent of the key order
+    """
+
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+
+
+def stage_manifest_file(output_file, stage_name):
+    """Path of the manifest of a stage, stored next to its first output
+    """
+
+    return f'{output_file}.{stage_name}.manifest.json'
+
+
+def load_stage_manifest(manifest_file):
+    """Load the manifest of a stage, None if it is missing or unreadable
+    """
+
+    if not os.path.isfile(manifest_file):
+        return None
+
+    try:
+        with open(manifest_file, 'r') as fp:
+            return json.load(fp)
+    except Exception as ee:
+        _logger.warning(f'Could not load manifest {manifest_file}: {ee}')
+        return None
+
+
+def is_stage_up_to_date(manifest_file, inputs, params, outputs, max_age=None):
+    """Check if a stage can be skipped
+
+    A stage is up to date if its manifest was written with the same
+    parameters, the content of all inputs is unchanged and all outputs
+    still exist as they were written by the stage.
+
+    :param manifest_file: path to the manifest of the stage
+    :param list inputs: input files of the stage
+    :param dict params: parameters the outputs depend on
+    :param list outputs: output files of the stage
+    :param max_age: max age of the manifest in seconds, e.g. for downloads
+    :return bool:
+    """
+
+    manifest = load_stage_manifest(manifest_file)
+    if manifest is None:
+        return False
+
+    if manifest.get('params_hash') != params_hash(params):
+        _logger.info(f'{manifest_file}: parameters have changed')
+        return False
+
+    if (max_age is not None) and (time.time() - manifest.get('created', 0) > max_age):
+        _logger.info(f'{manifest_file}: older than {max_age} seconds')
+        return False
+
+    for files, key in [(inputs, 'inputs'), (outputs, 'outputs')]:
+        fingerprints = manifest.get(key, {})
+        if sorted(fingerprints) != sorted(files):
+            _logger.info(f'{manifest_file}: {key} have changed')
+            return False
+        for file_path in files:
+            if not is_fingerprint_valid(fingerprints[file_path], file_path):
+                _logger.info(f'{manifest_file}: {file_path} has changed')
+                return False
+
+    return True
+
+
+def save_stage_manifest(manifest_file, stage_name, inputs, params, outputs, log=None):
+    """Record the inputs, parameters and outputs of a finished stage
+
+    :param log: log of the stage, stored for reference
+    :return dict: the manifest
+    """
+
+    manifest = {
+        "stage": stage_name,
+        "created": time.time(),
+        "params": params,
+        "params_hash": params_hash(params),
+        "inputs": {
+            file_path: file_fingerprint(file_path) for file_path in inputs
+        },
+        "outputs": {
+            file_path: file_fingerprint(file_path) for file_path in outputs
+        },
+        "log": log
+    }
+
+    manifest_file_temp = manifest_file + '.tmp'
+    with open(manifest_file_temp, 'w') as fp:
+        json.dump(manifest, fp, indent=2, default=str, ignore_nan=True)
+    os.replace(manifest_file_temp, manifest_file)
+
+    return manifest
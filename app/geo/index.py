@@ -0,0 +1,228 @@
+import logging
+
+import numpy as np
+
+logging.basicConfig()
+_logger = logging.getLogger('app.geo.index')
+
+
+def bbox_distance(bounds, x, y):
+    """Euclidean distance from a point to each bounding box
+
+    :param bounds: array of shape (n, 4) with minx, miny, maxx, maxy
+    :param x: x coordinate of the point
+    :param y: y coordinate of the point
+    :return: array of shape (n,); 0 if the point is inside the box
+    """
+
+    dx = np.maximum(np.maximum(bounds[:, 0] - x, x - bounds[:, 2]), 0)
+    dy = np.maximum(np.maximum(bounds[:, 1] - y, y - bounds[:, 3]), 0)
+
+    return np.hypot(dx, dy)
+
+
+class PackedRTree(object):
+    """Static R-tree packed with the Sort-Tile-Recursive (STR) algorithm
+
+    The tree is kept as a list of bounding box arrays, one per level.
+    Node ``j`` of level ``l + 1`` covers the children ``j * node_capacity``
+    to ``(j + 1) * node_capacity - 1`` of level ``l``, so that no pointers
+    have to be stored and every level can be searched with numpy.
+
+    :param bounds: array of shape (n, 4) with minx, miny, maxx, maxy of the items
+    :param node_capacity: max number of children of a node
+    """
+
+    def __init__(self, bounds, node_capacity=None):
+
+        if node_capacity is None:
+            node_capacity = 16
+
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+
+        self.node_capacity = node_capacity
+        self.size = len(bounds)
+        self.order = self._str_order(bounds, node_capacity)
+
+        self.levels = [bounds[self.order]]
+        while len(self.levels[-1]) > 1:
+            self.levels.append(
+                self._pack_level(self.levels[-1], node_capacity)
+                )
+
+        _logger.debug(
+            f'Packed {self.size} items into {len(self.levels)} levels'
+            )
+
+    def to_arrays(self):
+        """Arrays of the tree, e.g., to be saved and mapped by other processes
+
+        :return dict: order, node_capacity and the bounds of every level
+        """
+
+        arrays = {
+            "order": self.order,
+            "node_capacity": np.array(self.node_capacity, dtype=np.int64)
+        }
+        for level, level_bounds in enumerate(self.levels):
+            arrays[f'level_{level}'] = level_bounds
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Tree from the arrays of to_arrays, without packing it again
+
+        The arrays are used as they are, e.g., memory mapped.
+        """
+
+        tree = cls.__new__(cls)
+        # caches written by earlier versions hold node_capacity with shape (1,)
+        tree.node_capacity = int(np.asarray(arrays['node_capacity']).reshape(-1)[0])
+        tree.order = arrays['order']
+        tree.size = len(tree.order)
+        tree.levels = []
+        while f'level_{len(tree.levels)}' in arrays:
+            tree.levels.append(arrays[f'level_{len(tree.levels)}'])
+
+        return tree
+
+    @staticmethod
+    def _str_order(bounds, node_capacity):
+        """Sort items into tiles: slices along x, then sort along y in each slice
+        """
+
+        n_items = len(bounds)
+        if not n_items:
+            return np.arange(0, dtype=np.int64)
+
+        n_leaves = int(np.ceil(n_items / node_capacity))
+        n_slices = int(np.ceil(np.sqrt(n_leaves)))
+        slice_size = n_slices * node_capacity
+
+        center_x = (bounds[:, 0] + bounds[:, 2]) / 2
+        center_y = (bounds[:, 1] + bounds[:, 3]) / 2
+
+        order_x = np.argsort(center_x, kind='mergesort')
+        slice_id = np.arange(n_items) // slice_size
+
+        # sort by slice first and by y within each slice
+        order_in_slice = np.lexsort((center_y[order_x], slice_id))
+
+        return order_x[order_in_slice].astype(np.int64)
+
+    @staticmethod
+    def _pack_level(level_bounds, node_capacity):
+        """Bounding boxes of the parents of consecutive groups of nodes
+        """
+
+        starts = np.arange(0, len(level_bounds), node_capacity)
+
+        return np.column_stack([
+            np.minimum.reduceat(level_bounds[:, 0], starts),
+            np.minimum.reduceat(level_bounds[:, 1], starts),
+            np.maximum.reduceat(level_bounds[:, 2], starts),
+            np.maximum.reduceat(level_bounds[:, 3], starts)
+        ])
+
+    def _children(self, nodes, level):
+        """Positions of the children (at level - 1) of the nodes at level
+        """
+
+        children = (
+            nodes[:, None] * self.node_capacity
+            + np.arange(self.node_capacity)
+            ).ravel()
+
+        return children[children < len(self.levels[level - 1])]
+
+    def _search(self, is_hit):
+        """Walk down the tree and keep nodes for which is_hit is true
+
+        :param is_hit: callable taking bounds of shape (n, 4) and returning a boolean mask
+        :return: sorted positions of the items in the input bounds
+        """
+
+        if not self.size:
+            return np.arange(0, dtype=np.int64)
+
+        top_level = len(self.levels) - 1
+        nodes = np.arange(len(self.levels[top_level]))
+
+        for level in range(top_level, -1, -1):
+            nodes = nodes[is_hit(self.levels[level][nodes])]
+            if not len(nodes):
+                break
+            if level:
+                nodes = self._children(nodes, level)
+
+        return np.sort(self.order[nodes])
+
+    def query(self, box):
+        """Items whose bounding box intersects box
+
+        :param box: (minx, miny, maxx, maxy)
+        :return: sorted positions of the items in the input bounds
+        """
+
+        minx, miny, maxx, maxy = box
+
+        return self._search(
+            lambda b: (b[:, 0] <= maxx) & (b[:, 2] >= minx)
+            & (b[:, 1] <= maxy) & (b[:, 3] >= miny)
+            )
+
+    def query_point(self, x, y, distance):
+        """Items whose bounding box is not further than distance from (x, y)
+
+        Every item whose geometry is within distance of the point is
+        returned, together with some items which are only close by
+        bounding box.
+
+        :return: sorted positions of the items in the input bounds
+        """
+
+        return self._search(
+            lambda b: bbox_distance(b, x, y) <= distance
+            )
+
+    def nearest(self, x, y, distance_func, min_results=None):
+        """Find the items nearest to (x, y)
+
+        The search radius is doubled until at least ``min_results``
+        candidates have an exact distance within the radius; all items
+        inside the final radius are returned so that ties are kept.
+
+        :param distance_func: callable taking item positions and returning exact distances
+        :param min_results: minimum number of items to return
+        :return: (positions, distances) sorted by position
+        """
+
+        if min_results is None:
+            min_results = 1
+        min_results = min(min_results, self.size)
+
+        if not min_results:
+            return np.arange(0, dtype=np.int64), np.array([], dtype=np.float64)
+
+        # start with the distance to the closest leaf node
+        leaf_level = min(1, len(self.levels) - 1)
+        radius = bbox_distance(self.levels[leaf_level], x, y).min()
+        extent = self.levels[-1][0]
+        max_radius = bbox_distance(self.levels[-1], x, y)[0] + np.hypot(
+            extent[2] - extent[0], extent[3] - extent[1]
+            )
+        if radius <= 0:
+            radius = min(
+                np.hypot(extent[2] - extent[0], extent[3] - extent[1])
+                / max(np.sqrt(self.size), 1),
+                max_radius
+                ) or 1.0
+
+        while True:
+            positions = self.query_point(x, y, radius)
+            distances = np.asarray(distance_func(positions), dtype=np.float64)
+            is_within = distances <= radius
+            if is_within.sum() >= min_results or radius > max_radius:
+                return positions[is_within], distances[is_within]
+            radius *= 2
@@ -3,17 +3,32 @@ import os
 import datetime
 import argparse
 import logging
+import time
 from time import sleep as _sleep
 
+from app.geo.cache import is_stage_up_to_date as _is_stage_up_to_date
+from app.geo.cache import params_hash as _params_hash
+from app.geo.cache import save_stage_manifest as _save_stage_manifest
+from app.geo.cache import stage_manifest_file as _stage_manifest_file
 from app.geo.config import get_geo_config as _get_geo_config
+from app.geo.scheduler import DEFAULT_RESOURCE_LIMITS
+from app.geo.scheduler import Task as _Task
+from app.geo.scheduler import format_task_report as _format_task_report
+from app.geo.scheduler import run_task_graph as _run_task_graph
 from app.geo.sourcing import data_downloader as _data_downloader
 from app.geo.sourcing import pbf_filter as _pbf_filter
 from app.geo.sourcing import pbf2geojson as _pbf2geojson
+from app.geo.sourcing import iter_osmium_export as _iter_osmium_export
 from app.geo.transformer import clean_up_geojson as _clean_up_geojson
 from app.geo.transformer import OSMStreetTransformations
+from app.geo.transformer import get_geometry_encoding as _get_geometry_encoding
+from app.geo.transformer import transform_geojson_and_save_to_file as _transform_geojson_and_save_to_file
 from app.geo.transformer import transform_records_and_save_to_file as _transform_records_and_save_to_file
+from app.geo.transformer import transform_stream_and_save_to_file as _transform_stream_and_save_to_file
+from app.geo.transformer import merge_transformed_files as _merge_transformed_files
 
 from app.geo.util import check_and_convert_to_date as _check_and_convert_to_date
+from app.geo.util import split_bounding_box as _split_bounding_box
 
 logging.basicConfig()
 _logger = logging.getLogger('app.geo.osm')
@@ -28,83 +43,598 @@ __location__ = os.path.realpath(
 GEO_CONFIG = _get_geo_config()
 GEO_RESOURCES = GEO_CONFIG.get('resources')
 HIGHWAY_FILTERS = GEO_CONFIG.get('filters')
+# downloads are only repeated if the pbf file is older than this, in seconds
+DOWNLOAD_MAX_AGE = GEO_CONFIG.get('download_max_age_hours', 24) * 3600
+
+# split resources into tiles which are processed in parallel
+TILING = GEO_CONFIG.get('tiling')
+
+STAGE_NAMES = ['download', 'pbf_filter', 'pbf2geojson', 'transformations', 'merge']
 
 # Define the Pipes
 
 def data_downloader(osm_resource):
     return _data_downloader(
         osm_resource.get("source"),
-        osm_resource.get("pbf_file")
+        osm_resource.get("pbf_file"),
+        checksum=osm_resource.get("checksum"),
+        checksum_url=osm_resource.get("checksum_url")
     )
 
 
+def _tile_file_path(file_path, tile_name):
+    """Path of the file of a tile: <folder>/tiles/<tile_name>/<file name>
+    """
+
+    return os.path.join(
+        os.path.dirname(file_path), 'tiles', tile_name, os.path.basename(file_path)
+        )
+
+
+def resource_tiles(osm_resource):
+    """Split a resource into tiles according to the tiling config
+
+    The tiling of the resource overrides the tiling of the config. The
+    bounding box of the tiling, or else pbf_filter_bounding_box, is split
+    into a grid of rows x columns tiles.
+
+    :return list: (tile name, resource of the tile); empty if the resource
+        is not split
+    """
+
+    tiling = {**(TILING or {}), **(osm_resource.get('tiling') or {})}
+    rows = tiling.get('rows', 1)
+    columns = tiling.get('columns', 1)
+    if rows * columns <= 1:
+        return []
+
+    bounding_box = tiling.get('bounding_box') or osm_resource.get('pbf_filter_bounding_box')
+    if not bounding_box:
+        raise ValueError(
+            'Tiling of {} needs a bounding box'.format(osm_resource.get('city'))
+            )
+
+    tiles = []
+    for tile_name, tile_bounding_box in _split_bounding_box(bounding_box, rows, columns):
+        tiles.append((
+            tile_name,
+            {
+                **osm_resource,
+                "pbf_filter_bounding_box": tile_bounding_box,
+                **{
+                    key: _tile_file_path(osm_resource.get(key), tile_name)
+                    for key in ['pbf_file_highway', 'geojson_file', 'transformed_json_file']
+                }
+            }
+        ))
+
+    return tiles
+
+
+def resource_tile_workers(osm_resource):
+    """Number of tiles of a resource processed at the same time
+
+    It is workers of the tiling, see resource_tiles; 1 if the resource is
+    not split.
+    """
+
+    tiling = {**(TILING or {}), **(osm_resource.get('tiling') or {})}
+    if tiling.get('rows', 1) * tiling.get('columns', 1) <= 1:
+        return 1
+
+    return max(int(tiling.get('workers', 1)), 1)
+
+
 # Connecting the pipes
 
-def osm_data_pipeline(
+def _file_size(file_path):
+    """Size of a file in bytes, None if it does not exist
+    """
+
+    if file_path and os.path.isfile(file_path):
+        return os.path.getsize(file_path)
+
+
+def _add_stage_stats(stage_log, start_time, input_file=None, output_file=None):
+    """Add wall-clock time and the bytes read and written to the log of a stage
+    """
+
+    stage_log = dict(stage_log or {})
+    stage_log['seconds'] = time.time() - start_time
+    stage_log.setdefault('bytes_read', _file_size(input_file))
+    stage_log.setdefault('bytes_written', _file_size(output_file))
+
+    return stage_log
+
+
+def run_stage(
+    stage_name,
+    run,
+    inputs,
+    params,
+    outputs,
+    force_stages=None,
+    max_age=None
+    ):
+    """Run a stage of the pipeline unless its outputs are up to date
+
+    A manifest with the fingerprints of the inputs and outputs and the
+    parameters is stored next to the first output of the stage. The stage
+    is skipped if the manifest matches the current inputs, parameters and
+    outputs.
+
+    :param stage_name: name of the stage, e.g., pbf_filter
+    :param run: callable running the stage and returning its log
+    :param list inputs: input files of the stage
+    :param dict params: parameters the outputs depend on
+    :param list outputs: output files of the stage
+    :param force_stages: names of the stages to run in any case, or ['all']
+    :param max_age: max age of the outputs in seconds
+    :return dict: log of the stage
+    :raises Exception: if the log of the stage reports no success
+    """
+
+    if force_stages is None:
+        force_stages = []
+
+    manifest_file = _stage_manifest_file(outputs[0], stage_name)
+    is_forced = (stage_name in force_stages) or ('all' in force_stages)
+
+    if not is_forced and _is_stage_up_to_date(
+        manifest_file, inputs, params, outputs, max_age=max_age
+        ):
+        _logger.info(f'Skipping {stage_name}: {outputs[0]} is up to date')
+        return {"skipped": True, "manifest_file": manifest_file}
+
+    stage_log = run()
+    if not stage_log.get('success', True):
+        raise Exception(f'Stage {stage_name} failed: {stage_log}')
+
+    _save_stage_manifest(
+        manifest_file, stage_name, inputs, params, outputs, log=stage_log
+        )
+
+    return {**stage_log, "skipped": False, "manifest_file": manifest_file}
+
+
+def osm_pipeline_stages(
     schema,
     transformations,
-    osm_resource
+    osm_resource,
+    workers=None,
+    fused=None,
+    streamed=None,
+    force_stages=None,
+    res_osm_log=None
     ):
-    """Download, Transform, and Upload one poi resource
+    """Stages of the pipeline of one poi resource
+
+    Each stage adds its log to res_osm_log under the name of the stage.
+    If the resource is split into tiles (see resource_tiles), the stages
+    after the download run once per tile, with their logs under
+    res_osm_log['tiles'], and a final merge stage combines the tiles.
+
+    :param res_osm_log: dict collecting the logs of the stages
+    :return list: (stage name, resource, callable, names of the stages it
+        depends on) where resource is network, osmium or cpu; every stage
+        comes after the stages it depends on
     """
 
-    today_is = datetime.date.today().isoformat()
+    if res_osm_log is None:
+        res_osm_log = {}
 
-    res_osm_log = {}
+    today_is = datetime.date.today().isoformat()
+    stages = []
 
     ### Download pbf file
-    _logger.info('Downloading pbf from: ', osm_resource.get("source"))
-    poi_download_log = data_downloader(osm_resource)
+    def run_download():
+        _logger.info('Downloading pbf from: {}'.format( osm_resource.get("source") ) )
+        start_time = time.time()
+        poi_download_log = data_downloader(osm_resource)
+        return _add_stage_stats(
+            poi_download_log, start_time,
+            output_file=osm_resource.get("pbf_file")
+            )
+
+    def stage_download():
+        res_osm_log['download'] = run_stage(
+            'download',
+            run_download,
+            inputs=[],
+            params={"source": osm_resource.get("source")},
+            outputs=[osm_resource.get("pbf_file")],
+            force_stages=force_stages,
+            max_age=DOWNLOAD_MAX_AGE
+            )
 
-    res_osm_log['download'] = poi_download_log
+    stages.append(('download', 'network', stage_download, []))
+
+    tiles = resource_tiles(osm_resource)
+    if not tiles:
+        previous_stage_name = 'download'
+        for stage_name, resource, run_pipeline_stage in _osm_processing_stages(
+            schema,
+            transformations,
+            osm_resource,
+            workers=workers,
+            fused=fused,
+            streamed=streamed,
+            force_stages=force_stages,
+            res_osm_log=res_osm_log,
+            today_is=today_is
+            ):
+            stages.append(
+                (stage_name, resource, run_pipeline_stage, [previous_stage_name])
+                )
+            previous_stage_name = stage_name
+
+        return stages
+
+    ### Process the tiles and merge them
+    res_osm_log['tiles'] = {}
+    last_tile_stage_names = []
+    for tile_name, tile_resource in tiles:
+        res_osm_log['tiles'][tile_name] = {}
+        previous_stage_name = 'download'
+        for stage_name, resource, run_pipeline_stage in _osm_processing_stages(
+            schema,
+            transformations,
+            tile_resource,
+            workers=workers,
+            fused=fused,
+            streamed=streamed,
+            force_stages=force_stages,
+            res_osm_log=res_osm_log['tiles'][tile_name],
+            today_is=today_is
+            ):
+            tile_stage_name = f'{stage_name}:{tile_name}'
+            stages.append(
+                (tile_stage_name, resource, run_pipeline_stage, [previous_stage_name])
+                )
+            previous_stage_name = tile_stage_name
+        last_tile_stage_names.append(previous_stage_name)
+
+    tile_transformed_json_files = [
+        tile_resource.get('transformed_json_file') for _, tile_resource in tiles
+    ]
+
+    def run_merge():
+        _logger.info('Merging tiles into: {}'.format( osm_resource.get('transformed_json_file') ) )
+        start_time = time.time()
+        poi_merge_log = _merge_transformed_files(
+            tile_transformed_json_files,
+            osm_resource.get('transformed_json_file')
+            )
+        return _add_stage_stats(
+            poi_merge_log, start_time,
+            output_file=osm_resource.get('transformed_json_file')
+            )
+
+    def stage_merge():
+        res_osm_log['merge'] = run_stage(
+            'merge',
+            run_merge,
+            inputs=tile_transformed_json_files,
+            params={"key": "id"},
+            outputs=[osm_resource.get('transformed_json_file')],
+            force_stages=force_stages
+            )
+
+    stages.append(('merge', 'cpu', stage_merge, last_tile_stage_names))
+
+    return stages
+
+
+def _osm_processing_stages(
+    schema,
+    transformations,
+    osm_resource,
+    workers=None,
+    fused=None,
+    streamed=None,
+    force_stages=None,
+    res_osm_log=None,
+    today_is=None
+    ):
+    """Stages from the downloaded pbf file to the transformed data
+
+    :return list: (stage name, resource, callable) in the order they have to run
+    """
+
+    if today_is is None:
+        today_is = datetime.date.today().isoformat()
+
+    stages = []
 
     ### Extract highway pbf from all
-    _logger.info('Extacting highways from all pbf: ', osm_resource.get("pbf_file"))
-    poi_pbf_highway_log = _pbf_filter(
-            osm_resource.get("pbf_file"),
+    def run_pbf_filter():
+        _logger.info('Extacting highways from all pbf: {}'.format( osm_resource.get("pbf_file") ) )
+        start_time = time.time()
+        os.makedirs(
+            os.path.dirname(os.path.abspath(osm_resource.get("pbf_file_highway"))),
+            exist_ok=True
+            )
+        poi_pbf_highway_log = _pbf_filter(
+                osm_resource.get("pbf_file"),
+                osm_resource.get("pbf_file_highway"),
+                HIGHWAY_FILTERS,
+                bounding_box=osm_resource.get('pbf_filter_bounding_box')
+            )
+        return _add_stage_stats(
+            poi_pbf_highway_log, start_time,
+            input_file=osm_resource.get("pbf_file"),
+            output_file=osm_resource.get("pbf_file_highway")
+            )
+
+    def stage_pbf_filter():
+        res_osm_log['pbf_filter'] = run_stage(
+            'pbf_filter',
+            run_pbf_filter,
+            inputs=[osm_resource.get("pbf_file")],
+            params={
+                "filters": HIGHWAY_FILTERS,
+                "bounding_box": osm_resource.get('pbf_filter_bounding_box')
+            },
+            outputs=[osm_resource.get("pbf_file_highway")],
+            force_stages=force_stages
+            )
+
+    stages.append(('pbf_filter', 'osmium', stage_pbf_filter))
+
+    # the observation date is not a parameter, so that reruns on a later
+    # day skip the transformations if the data is unchanged; the records
+    # keep the date of the run which transformed them
+    available_osm_transformers = [x for x in dir(transformations) if not x.startswith('_')]
+    transformations_params = {
+        "schema": _params_hash(schema),
+        "transformers": available_osm_transformers
+    }
+
+    if streamed:
+        ### Export pbf and transform the features in one pass
+        def run_streamed_transformations():
+            _logger.info('Streaming and transforming: {}'.format( osm_resource.get("pbf_file_highway") ) )
+            start_time = time.time()
+            poi_pbf2geojson_log = {}
+            poi_transformations_log = _transform_stream_and_save_to_file(
+                schema,
+                available_osm_transformers,
+                transformations,
+                observation_date=today_is,
+                records=_iter_osmium_export(
+                    osm_resource.get("pbf_file_highway"),
+                    stats=poi_pbf2geojson_log
+                    ),
+                output_file=osm_resource.get('transformed_json_file')
+            )
+            res_osm_log['pbf2geojson'] = poi_pbf2geojson_log
+            return _add_stage_stats(
+                poi_transformations_log, start_time,
+                input_file=osm_resource.get("pbf_file_highway")
+                )
+
+        def stage_streamed_transformations():
+            res_osm_log['transformations'] = run_stage(
+                'transformations',
+                run_streamed_transformations,
+                inputs=[osm_resource.get("pbf_file_highway")],
+                params=transformations_params,
+                outputs=[osm_resource.get('transformed_json_file')],
+                force_stages=force_stages
+                )
+            if res_osm_log['transformations'].get('skipped'):
+                # the export is part of the skipped stage
+                res_osm_log['pbf2geojson'] = res_osm_log['transformations']
+
+        # osmium exports the records while they are transformed, so the
+        # stage takes a slot of both resources
+        stages.append(
+            ('transformations', ('osmium', 'cpu'), stage_streamed_transformations)
+            )
+
+        return stages
+
+    ### Convert pbf to geojson
+    def run_pbf2geojson():
+        _logger.info('Converting pbf to geojson: {}'.format( osm_resource.get("pbf_file_highway") ) )
+        start_time = time.time()
+        poi_pbf2geojson_log = _pbf2geojson(
             osm_resource.get("pbf_file_highway"),
-            HIGHWAY_FILTERS,
-            bounding_box=osm_resource.get('pbf_filter_bounding_box')
+            osm_resource.get("geojson_file")
         )
-    res_osm_log['pbf2geojson'] = poi_pbf_highway_log
+        poi_pbf2geojson_log = _add_stage_stats(
+            poi_pbf2geojson_log, start_time,
+            input_file=osm_resource.get("pbf_file_highway"),
+            output_file=osm_resource.get("geojson_file")
+            )
+        if fused or not poi_pbf2geojson_log.get('success', True):
+            return poi_pbf2geojson_log
+
+        ### Clean up geojson
+        # the geojson file is cleaned up in place, so both steps are cached
+        # as one stage
+        _logger.info('Cleaning up geojson file for {}'.format( osm_resource.get("geojson_file") ) )
+        start_time = time.time()
+        geojson_file_size = _file_size(osm_resource.get("geojson_file"))
+        poi_clean_geojson_log = _clean_up_geojson(
+            osm_resource.get("geojson_file"),
+            load_only_key = "features"
+        )
+        res_osm_log['clean_geojson'] = _add_stage_stats(
+            {**poi_clean_geojson_log, "bytes_read": geojson_file_size},
+            start_time,
+            output_file=osm_resource.get("geojson_file")
+            )
 
-    ### Convert pbf to geojson
-    _logger.info('Converting pbf to geojson: ', osm_resource.get("pbf_file_highway"))
-    poi_pbf2geojson_log = _pbf2geojson(
-        osm_resource.get("pbf_file_highway"),
-        osm_resource.get("geojson_file")
-    )
-    res_osm_log['pbf2geojson'] = poi_pbf2geojson_log
+        return poi_pbf2geojson_log
 
-    ### Clean up geojson
-    _logger.info('Cleaning up geojson file for ', osm_resource.get("geojson_file"))
-    poi_clean_geojson_log = _clean_up_geojson(
-        osm_resource.get("geojson_file"),
-        load_only_key = "features"
-    )
-    res_osm_log['clean_geojson'] = {
-        "geojson_file": osm_resource.get("geojson_file")
-    }
+    def stage_pbf2geojson():
+        res_osm_log['pbf2geojson'] = run_stage(
+            'pbf2geojson',
+            run_pbf2geojson,
+            inputs=[osm_resource.get("pbf_file_highway")],
+            params={"clean_up": not fused},
+            outputs=[osm_resource.get("geojson_file")],
+            force_stages=force_stages
+            )
 
-    ### transform data
-    available_osm_transformers = [x for x in dir(transformations) if not x.startswith('_')]
+    stages.append(('pbf2geojson', 'osmium', stage_pbf2geojson))
+
+    if fused:
+        ### Filter and transform data in one pass
+        def run_fused_transformations():
+            _logger.info('Filtering and transforming: {}'.format( osm_resource.get("geojson_file") ) )
+            start_time = time.time()
+            poi_transformations_log = _transform_geojson_and_save_to_file(
+                schema,
+                available_osm_transformers,
+                transformations,
+                observation_date=today_is,
+                input_file=osm_resource.get('geojson_file'),
+                output_file=osm_resource.get('transformed_json_file'),
+                load_only_key="features"
+            )
+            return _add_stage_stats(
+                poi_transformations_log, start_time
+                )
+        run_transformations = run_fused_transformations
+    else:
+        ### transform data
+        def run_transformations():
+            _logger.info('Transforming: {}'.format( osm_resource.get("geojson_file") ) )
+            start_time = time.time()
+            poi_transformations_log = _transform_records_and_save_to_file(
+                    schema,
+                    available_osm_transformers,
+                    transformations,
+                    observation_date=today_is,
+                    input_file=osm_resource.get('geojson_file'),
+                    output_file=osm_resource.get('transformed_json_file'),
+                    workers=workers
+                )
+            return _add_stage_stats(
+                {
+                    "geojson_file": osm_resource.get("geojson_file"),
+                    "transformed_json_file": osm_resource.get('transformed_json_file'),
+                    **poi_transformations_log
+                },
+                start_time,
+                input_file=osm_resource.get('geojson_file'),
+                output_file=osm_resource.get('transformed_json_file')
+                )
+
+    def stage_transformations():
+        res_osm_log['transformations'] = run_stage(
+            'transformations',
+            run_transformations,
+            inputs=[osm_resource.get("geojson_file")],
+            params={**transformations_params, "clean_up": not fused},
+            outputs=[osm_resource.get('transformed_json_file')],
+            force_stages=force_stages
+            )
+
+    stages.append(('transformations', 'cpu', stage_transformations))
+
+    return stages
+
+
+def osm_data_pipeline(
+    schema,
+    transformations,
+    osm_resource,
+    workers=None,
+    fused=None,
+    streamed=None,
+    force_stages=None
+    ):
+    """Download, Transform, and Upload one poi resource
+
+    Stages whose inputs and parameters have not changed since their last
+    run are skipped, see run_stage. The observation_date of the records
+    is the date of the run which transformed them; force the
+    transformations stage to stamp them with today.
+
+    :param workers: number of processes used to transform the records
+    :param fused: filter and transform the geojson export in one pass
+        without writing the line delimited geojson in between
+    :param streamed: transform the features while osmium exports them,
+        without writing the geojson file at all
+    :param force_stages: names of the stages to run even if they are up
+        to date, or ['all']
+    """
+
+    res_osm_log = {}
 
-    _logger.info('Transforming: '.format( osm_resource.get("geojson_file") ) )
-    _transform_records_and_save_to_file(
+    for _, _, run_pipeline_stage, _ in osm_pipeline_stages(
+        schema,
+        transformations,
+        osm_resource,
+        workers=workers,
+        fused=fused,
+        streamed=streamed,
+        force_stages=force_stages,
+        res_osm_log=res_osm_log
+        ):
+        run_pipeline_stage()
+
+    return res_osm_log
+
+
+def osm_data_pipelines(
+    schema,
+    transformations,
+    osm_resources,
+    resource_limits=None,
+    **pipeline_options
+    ):
+    """Run the pipelines of several poi resources with overlapping stages
+
+    Every stage of every resource is a task in a graph. The stages of one
+    resource (or tile) run in order, while stages of different resources overlap as
+    far as the limits of the network, osmium and cpu resources allow,
+    e.g., one city is downloaded while another one is transformed.
+
+    The osmium and cpu limits are raised to the workers of the tiling of
+    the resources (see resource_tile_workers), so that tiles are filtered,
+    exported and transformed in parallel.
+
+    :param list osm_resources: resources from the geo config
+    :param dict resource_limits: resource -> max number of concurrent stages
+    :param pipeline_options: passed on to osm_pipeline_stages
+    :return tuple: (logs of the stages per city, report of run_task_graph)
+    """
+
+    resource_limits = {**DEFAULT_RESOURCE_LIMITS, **(resource_limits or {})}
+    tile_workers = max(
+        [resource_tile_workers(osm_resource) for osm_resource in osm_resources] or [1]
+        )
+    for resource in ['osmium', 'cpu']:
+        resource_limits[resource] = max(resource_limits[resource], tile_workers)
+
+    res_osm_logs = {}
+    tasks = []
+    for osm_resource in osm_resources:
+        city = osm_resource.get('city')
+        res_osm_logs[city] = {}
+        for stage_name, resource, run_pipeline_stage, dependencies in osm_pipeline_stages(
             schema,
-            available_osm_transformers,
             transformations,
-            observation_date=today_is,
-            input_file=osm_resource.get('geojson_file'),
-            output_file=osm_resource.get('transformed_json_file')
-        )
-    res_osm_log['transformations'] = {
-        "geojson_file": osm_resource.get("geojson_file"),
-        "transformed_json_file": osm_resource.get('transformed_json_file')
-    }
+            osm_resource,
+            res_osm_log=res_osm_logs[city],
+            **pipeline_options
+            ):
+            tasks.append(
+                _Task(
+                    f'{city}:{stage_name}',
+                    run_pipeline_stage,
+                    resource,
+                    dependencies=[f'{city}:{x}' for x in dependencies]
+                    )
+                )
 
+    report = _run_task_graph(tasks, resource_limits=resource_limits)
 
-    return res_osm_log
+    return res_osm_logs, report
 
 
 ## Workflow
@@ -125,8 +655,66 @@ def main():
         help= 'Specify city resource to be used'
         )
 
+    parser.add_argument(
+        '-w', '--workers',
+        dest='workers',
+        type=int,
+        default=1,
+        help= 'Number of processes used to transform the records'
+        )
+
+    parser.add_argument(
+        '--fused',
+        dest='fused',
+        action='store_true',
+        help= 'Filter and transform the geojson export in one pass without intermediate files'
+        )
+
+    parser.add_argument(
+        '--streamed',
+        dest='streamed',
+        action='store_true',
+        help= 'Transform the features while osmium exports them, without writing the geojson file'
+        )
+
+    parser.add_argument(
+        '--force-stage',
+        dest='force_stages',
+        nargs='+',
+        choices=STAGE_NAMES + ['all'],
+        default=[],
+        help= 'Run these stages even if their outputs are up to date'
+        )
+
+    parser.add_argument(
+        '--max-downloads',
+        dest='max_downloads',
+        type=int,
+        default=DEFAULT_RESOURCE_LIMITS['network'],
+        help= 'Max number of downloads running at the same time'
+        )
+
+    parser.add_argument(
+        '--max-osmium',
+        dest='max_osmium',
+        type=int,
+        default=DEFAULT_RESOURCE_LIMITS['osmium'],
+        help= 'Max number of osmium calls running at the same time'
+        )
+
+    parser.add_argument(
+        '--max-transforms',
+        dest='max_transforms',
+        type=int,
+        default=DEFAULT_RESOURCE_LIMITS['cpu'],
+        help= 'Max number of transformations running at the same time'
+        )
+
     args = parser.parse_args()
     geo_city = args.city
+    workers = args.workers
+    fused = args.fused
+    streamed = args.streamed
     if geo_city:
         _logger.info(f'--city: {geo_city}')
     else:
@@ -142,16 +730,31 @@ def main():
     with open(os.path.join(__location__, 'schema', 'city_streets.json'), 'rb') as schema_file:
             schema = json.load(schema_file)
 
-    osm_transformer = OSMStreetTransformations()
+    osm_transformer = OSMStreetTransformations(
+        geometry_encoding=_get_geometry_encoding(schema)
+        )
 
-    ### Iterate through selected poi resources
+    ### Run the stages of the selected poi resources
     #
-    for osm_resource in osm_resources_selected:
-        osm_data_pipeline(
-            schema=schema,
-            transformations=osm_transformer,
-            osm_resource=osm_resource
-            )
+    _, report = osm_data_pipelines(
+        schema=schema,
+        transformations=osm_transformer,
+        osm_resources=osm_resources_selected,
+        resource_limits={
+            "network": args.max_downloads,
+            "osmium": args.max_osmium,
+            "cpu": args.max_transforms
+        },
+        workers=workers,
+        fused=fused,
+        streamed=streamed,
+        force_stages=args.force_stages
+        )
+
+    print(_format_task_report(report))
+
+    if report['failed']:
+        raise Exception('Failed stages: {}'.format(', '.join(report['failed'])))
 
 
 if __name__ == "__main__":
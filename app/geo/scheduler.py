@@ -0,0 +1,279 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logging.basicConfig()
+_logger = logging.getLogger('app.geo.scheduler')
+
+# Max number of tasks running at the same time for each kind of resource
+DEFAULT_RESOURCE_LIMITS = {
+    "network": 2,
+    "osmium": 1,
+    "cpu": 1
+}
+
+
+class Task(object):
+    """A unit of work in a task graph
+
+    :param name: unique name of the task, e.g., berlin:download
+    :param run: callable without arguments doing the work
+    :param resource: kind of resource the task is bound by, e.g., network,
+        or a tuple of resources the task takes a slot of at the same time,
+        e.g., (osmium, cpu)
+    :param dependencies: names of the tasks that have to finish before
+    """
+
+    def __init__(self, name, run, resource, dependencies=None):
+
+        self.name = name
+        self.run = run
+        self.resources = (resource,) if isinstance(resource, str) else tuple(resource)
+        self.resource = '+'.join(self.resources)
+        self.dependencies = list(dependencies or [])
+
+    def __repr__(self):
+        return f'Task({self.name!r}, resource={self.resource!r})'
+
+
+def sort_tasks(tasks):
+    """Sort tasks so that every task comes after its dependencies
+
+    :param list tasks: Task objects
+    :return list: sorted tasks, the order of independent tasks is kept
+    """
+
+    tasks_by_name = {}
+    for task in tasks:
+        if task.name in tasks_by_name:
+            raise ValueError(f'Duplicate task: {task.name}')
+        tasks_by_name[task.name] = task
+
+    for task in tasks:
+        for dependency in task.dependencies:
+            if dependency not in tasks_by_name:
+                raise ValueError(f'{task.name} depends on unknown task {dependency}')
+
+    sorted_tasks = []
+    visiting = set()
+    visited = set()
+
+    def visit(task):
+        if task.name in visited:
+            return
+        if task.name in visiting:
+            raise ValueError(f'Cyclic dependency at task {task.name}')
+        visiting.add(task.name)
+        for dependency in task.dependencies:
+            visit(tasks_by_name[dependency])
+        visiting.remove(task.name)
+        visited.add(task.name)
+        sorted_tasks.append(task)
+
+    for task in tasks:
+        visit(task)
+
+    return sorted_tasks
+
+
+def critical_path(task_stats):
+    """Chain of tasks that determined the total run time
+
+    Starting from the task that finished last, follow the dependency that
+    finished last until a task without dependencies is reached.
+
+    :param dict task_stats: name -> stats as returned by run_task_graph
+    :return list: names of the tasks, in the order they ran
+    """
+
+    finished = {
+        name: stats for name, stats in task_stats.items()
+        if stats.get('end') is not None
+    }
+    if not finished:
+        return []
+
+    name = max(finished, key=lambda x: finished[x]['end'])
+    path = [name]
+    while True:
+        dependencies = [
+            x for x in finished[name]['dependencies'] if x in finished
+        ]
+        if not dependencies:
+            break
+        name = max(dependencies, key=lambda x: finished[x]['end'])
+        path.append(name)
+
+    return path[::-1]
+
+
+def _timed_run(task, clock_start):
+    """Run a task and return its start and end relative to clock_start
+
+    :return tuple: (start, end, result, error)
+    """
+
+    result = None
+    error = None
+    start = time.perf_counter() - clock_start
+    try:
+        result = task.run()
+    except Exception as ee:
+        _logger.exception(f'{task.name} failed')
+        error = ee
+    end = time.perf_counter() - clock_start
+    _logger.info(f'{task.name} finished after {end - start:.2f} seconds')
+
+    return start, end, result, error
+
+
+def run_task_graph(tasks, resource_limits=None):
+    """Run a graph of tasks with a concurrency limit per resource
+
+    A task is started as soon as all its dependencies have succeeded and
+    fewer tasks of the same resource than its limit are running, for every
+    resource of the task. Tasks whose dependencies failed are skipped; all
+    other tasks still run.
+
+    :param list tasks: Task objects
+    :param dict resource_limits: resource -> max number of concurrent tasks,
+        default to DEFAULT_RESOURCE_LIMITS; resources without a limit get 1
+    :return dict: report with the stats of every task (status, ready,
+        start, end, seconds, wait_seconds, error and result), the critical
+        path and the total seconds
+    """
+
+    resource_limits = {**DEFAULT_RESOURCE_LIMITS, **(resource_limits or {})}
+    tasks = sort_tasks(tasks)
+
+    task_resources = {resource for task in tasks for resource in task.resources}
+    for resource in task_resources:
+        if resource_limits.setdefault(resource, 1) < 1:
+            raise ValueError(f'Limit of {resource} has to be at least 1')
+
+    task_stats = {
+        task.name: {
+            "resource": task.resource,
+            "dependencies": task.dependencies,
+            "status": "pending",
+            "ready": None,
+            "start": None,
+            "end": None,
+            "seconds": None,
+            "wait_seconds": None,
+            "error": None,
+            "result": None
+        }
+        for task in tasks
+    }
+
+    pending = list(tasks)
+    running = {}
+    running_per_resource = {resource: 0 for resource in resource_limits}
+    max_workers = sum(
+        resource_limits[resource] for resource in task_resources
+        ) or 1
+
+    clock_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            still_pending = []
+            # tasks are sorted, so that skipping cascades in a single pass
+            for task in pending:
+                dependency_status = [
+                    task_stats[x]['status'] for x in task.dependencies
+                ]
+                if any(x in ('failed', 'skipped') for x in dependency_status):
+                    task_stats[task.name]['status'] = 'skipped'
+                    _logger.warning(f'Skipping {task.name}: a dependency failed')
+                    continue
+                if not all(x == 'succeeded' for x in dependency_status):
+                    still_pending.append(task)
+                    continue
+                stats = task_stats[task.name]
+                if stats['ready'] is None:
+                    stats['ready'] = time.perf_counter() - clock_start
+                if any(
+                    running_per_resource[resource] >= resource_limits[resource]
+                    for resource in task.resources
+                    ):
+                    still_pending.append(task)
+                    continue
+                stats['status'] = 'running'
+                for resource in task.resources:
+                    running_per_resource[resource] += 1
+                running[executor.submit(_timed_run, task, clock_start)] = task
+            pending = still_pending
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                for resource in task.resources:
+                    running_per_resource[resource] -= 1
+                stats = task_stats[task.name]
+                stats['start'], stats['end'], stats['result'], error = future.result()
+                stats['seconds'] = stats['end'] - stats['start']
+                stats['wait_seconds'] = stats['start'] - stats['ready']
+                if error is None:
+                    stats['status'] = 'succeeded'
+                else:
+                    stats['status'] = 'failed'
+                    stats['error'] = repr(error)
+
+    path = critical_path(task_stats)
+
+    return {
+        "tasks": task_stats,
+        "critical_path": path,
+        "critical_path_seconds": sum(
+            task_stats[name]['seconds'] or 0 for name in path
+            ),
+        "seconds": time.perf_counter() - clock_start,
+        "failed": [
+            name for name, stats in task_stats.items()
+            if stats['status'] == 'failed'
+        ]
+    }
+
+
+def format_task_report(report):
+    """Table of the task timings and the critical path of a report
+    """
+
+    lines = [
+        '{:<40} {:<11} {:<10} {:>9} {:>9} {:>9} {:>9}'.format(
+            'task', 'resource', 'status', 'ready', 'start', 'end', 'seconds'
+            )
+    ]
+
+    def _format_seconds(value):
+        return '' if value is None else f'{value:.2f}'
+
+    for name, stats in sorted(
+        report['tasks'].items(),
+        key=lambda x: (x[1]['start'] is None, x[1]['start'] or 0)
+        ):
+        lines.append(
+            '{:<40} {:<11} {:<10} {:>9} {:>9} {:>9} {:>9}'.format(
+                name,
+                stats['resource'],
+                stats['status'],
+                _format_seconds(stats['ready']),
+                _format_seconds(stats['start']),
+                _format_seconds(stats['end']),
+                _format_seconds(stats['seconds'])
+                )
+            )
+
+    lines.append(
+        'critical path ({:.2f} of {:.2f} seconds): {}'.format(
+            report['critical_path_seconds'],
+            report['seconds'],
+            ' -> '.join(report['critical_path'])
+            )
+        )
+
+    return '\n'.join(lines)
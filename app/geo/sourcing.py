@@ -1,15 +1,124 @@
 import subprocess
-from subprocess import check_output, STDOUT, CalledProcessError
 
+import hashlib
+import http.client
+import urllib.error
 import urllib.request
 import logging
 import os
+import tempfile
+import threading
+import time
 from shutil import which as _which
 
+import simplejson as json
 
-def data_downloader(data_source_url, target_file):
+# Command used to run osmium, can be changed to use another binary or a stub
+OSMIUM_COMMAND = os.environ.get('OSMIUM_COMMAND', 'osmium')
+
+# Bytes read at a time and socket timeout in seconds for downloads
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_TIMEOUT = 60
+
+
+def _load_json_file(file_path):
+    """Load a small json file, None if it does not exist or is broken
+    """
+
+    try:
+        with open(file_path, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_json_file(file_path, data):
+    """Write a small json file atomically
+    """
+
+    file_path_temp = file_path + '.tmp'
+    with open(file_path_temp, 'w') as fp:
+        json.dump(data, fp, indent=2)
+    os.replace(file_path_temp, file_path)
+
+
+def _remove_files(*file_paths):
+    for file_path in file_paths:
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+
+def parse_checksum(checksum):
+    """Split a checksum into the hash algorithm and the hex digest
+
+    :param checksum: ``<algorithm>:<hex digest>``, e.g., ``md5:d41d8c...``,
+        or a bare md5 or sha256 hex digest; also accepts the content of
+        md5sum/sha256sum files, e.g., ``<hex digest>  file.osm.pbf``
+    :return tuple: (algorithm, hex digest)
+    """
+
+    checksum = checksum.strip()
+    if ':' in checksum.split()[0]:
+        algorithm, digest = checksum.split()[0].split(':', 1)
+    else:
+        digest = checksum.split()[0]
+        algorithm = {32: 'md5', 40: 'sha1', 64: 'sha256'}.get(len(digest))
+    if algorithm not in hashlib.algorithms_available:
+        raise ValueError(f'Unknown checksum: {checksum}')
+
+    return algorithm.lower(), digest.lower()
+
+
+def fetch_checksum(checksum_url, timeout=None):
+    """Download a checksum file, e.g., the .md5 file next to a Geofabrik pbf
+
+    :return tuple: (algorithm, hex digest)
+    """
+
+    with urllib.request.urlopen(checksum_url, timeout=timeout) as response:
+        return parse_checksum(response.read().decode('utf-8'))
+
+
+def data_downloader(
+    data_source_url,
+    target_file,
+    checksum=None,
+    checksum_url=None,
+    chunk_size=None,
+    timeout=None,
+    progress_interval=None
+    ):
     """Download data from remote
+
+    The data is streamed in chunks into ``<target_file>.part`` and moved to
+    target_file when it is complete and the checksum matches.
+
+    * Interrupted downloads are resumed with a HTTP Range request if the
+      server still has the same version (If-Range with ETag or
+      Last-Modified).
+    * The ETag and Last-Modified of a finished download are stored in
+      ``<target_file>.download.json``. The next download is a conditional
+      GET, and the file is not fetched again if the server answers
+      304 Not Modified.
+
+    :param data_source_url: url of the data, http(s) or file
+    :param target_file: path of the downloaded file
+    :param checksum: expected checksum, see parse_checksum
+    :param checksum_url: url of a checksum file, used if checksum is None
+    :param chunk_size: bytes read at a time
+    :param timeout: socket timeout in seconds
+    :param progress_interval: seconds between progress messages
+    :return dict: log with success, not_modified, resumed_from, bytes
+        downloaded, size, seconds and bytes per second
     """
+
+    if chunk_size is None:
+        chunk_size = DOWNLOAD_CHUNK_SIZE
+    if timeout is None:
+        timeout = DOWNLOAD_TIMEOUT
+    if progress_interval is None:
+        progress_interval = 10
+
     download_success = False
 
     try:
@@ -21,21 +130,175 @@ def data_downloader(data_source_url, target_file):
             target_file_dir
         ))
 
+    meta_file = target_file + '.download.json'
+    part_file = target_file + '.part'
+    part_meta_file = part_file + '.json'
+
+    res_log = {
+        "data_source": data_source_url,
+        "data_file": target_file,
+        "success": download_success,
+        "not_modified": False,
+        "resumed_from": 0,
+        "bytes_downloaded": 0,
+        "size": None,
+        "checksum": None,
+        "checksum_verified": False
+    }
+    start_time = time.time()
+
+    headers = {}
+    meta = _load_json_file(meta_file) or {}
+    if os.path.isfile(target_file) and meta.get('url') == data_source_url:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    part_meta = _load_json_file(part_meta_file) or {}
+    resume_from = 0
+    if os.path.isfile(part_file) and part_meta.get('url') == data_source_url:
+        validator = part_meta.get('etag') or part_meta.get('last_modified')
+        if validator:
+            resume_from = os.path.getsize(part_file)
+            headers['Range'] = f'bytes={resume_from}-'
+            headers['If-Range'] = validator
+
     try:
-        res = urllib.request.urlretrieve(data_source_url, target_file)
+        try:
+            response = urllib.request.urlopen(
+                urllib.request.Request(data_source_url, headers=headers),
+                timeout=timeout
+                )
+        except urllib.error.HTTPError as ee:
+            if ee.code == 304:
+                logging.info(f'{data_source_url} has not been modified')
+                _remove_files(part_file, part_meta_file)
+                res_log.update({
+                    "success": True,
+                    "not_modified": True,
+                    "size": os.path.getsize(target_file),
+                    "seconds": time.time() - start_time
+                })
+                return res_log
+            if ee.code == 416:
+                # the partial file does not fit the remote file any more
+                _remove_files(part_file, part_meta_file)
+                headers.pop('Range', None)
+                headers.pop('If-Range', None)
+                resume_from = 0
+                response = urllib.request.urlopen(
+                    urllib.request.Request(data_source_url, headers=headers),
+                    timeout=timeout
+                    )
+            else:
+                raise
+
+        with response:
+            status = response.getcode() or 200
+            if status != 206:
+                resume_from = 0
+            content_length = response.headers.get('Content-Length')
+            size = (resume_from + int(content_length)) if content_length else None
+
+            _save_json_file(part_meta_file, {
+                "url": data_source_url,
+                "etag": response.headers.get('ETag'),
+                "last_modified": response.headers.get('Last-Modified')
+            })
+
+            if checksum is None and checksum_url:
+                checksum = '{}:{}'.format(*fetch_checksum(checksum_url, timeout=timeout))
+            hash_algorithm, expected_digest = (
+                parse_checksum(checksum) if checksum else ('sha256', None)
+                )
+            file_hash = hashlib.new(hash_algorithm)
+
+            if resume_from:
+                logging.info(f'Resuming {data_source_url} from byte {resume_from}')
+                with open(part_file, 'rb') as fp:
+                    for block in iter(lambda: fp.read(chunk_size), b''):
+                        file_hash.update(block)
+
+            bytes_downloaded = 0
+            last_progress_time = time.time()
+            with open(part_file, 'ab' if resume_from else 'wb') as fp:
+                for block in iter(lambda: response.read(chunk_size), b''):
+                    fp.write(block)
+                    file_hash.update(block)
+                    bytes_downloaded += len(block)
+                    if time.time() - last_progress_time >= progress_interval:
+                        last_progress_time = time.time()
+                        _log_download_progress(
+                            data_source_url, resume_from + bytes_downloaded,
+                            size, bytes_downloaded, last_progress_time - start_time
+                            )
+
+        res_log['resumed_from'] = resume_from
+        res_log['bytes_downloaded'] = bytes_downloaded
+        res_log['size'] = resume_from + bytes_downloaded
+        if (size is not None) and (res_log['size'] != size):
+            # the partial file is kept, so that the next call resumes it
+            raise urllib.error.ContentTooShortError(
+                f'Incomplete download of {data_source_url}: '
+                f'{res_log["size"]} of {size} bytes',
+                None
+                )
+
+        res_log['checksum'] = f'{hash_algorithm}:{file_hash.hexdigest()}'
+        if expected_digest is not None:
+            if file_hash.hexdigest() != expected_digest:
+                _remove_files(part_file, part_meta_file)
+                raise Exception(
+                    f'Checksum mismatch for {data_source_url}: '
+                    f'expected {hash_algorithm}:{expected_digest}, '
+                    f'got {res_log["checksum"]}'
+                    )
+            res_log['checksum_verified'] = True
+
+        os.replace(part_file, target_file)
+        _save_json_file(meta_file, {
+            "url": data_source_url,
+            "etag": response.headers.get('ETag'),
+            "last_modified": response.headers.get('Last-Modified'),
+            "size": res_log['size'],
+            "checksum": res_log['checksum']
+        })
+        _remove_files(part_meta_file)
         download_success = True
-    except Exception as ee:
+    except urllib.error.HTTPError as ee:
         if ee.code == 404:
             logging.exception('File does not exist: {} \n'.format(data_source_url) )
             raise Exception(ee)
-        else:
-            logging.exception('Can not download {}\n'.format(data_source_url), ee)
+        logging.exception('Can not download {}\n'.format(data_source_url))
+    except (urllib.error.URLError, http.client.HTTPException, OSError):
+        logging.exception('Can not download {}\n'.format(data_source_url))
+
+    seconds = time.time() - start_time
+    res_log.update({
+        "success": download_success,
+        "seconds": seconds,
+        "bytes_per_second": res_log['bytes_downloaded'] / seconds if seconds else None
+    })
+    if download_success:
+        _log_download_progress(
+            data_source_url, res_log['size'], res_log['size'],
+            res_log['bytes_downloaded'], seconds
+            )
+
+    return res_log
+
+
+def _log_download_progress(data_source_url, position, size, bytes_downloaded, seconds):
+    """Log the progress and throughput of a download
+    """
 
-    return {
-        "data_source": data_source_url,
-        "data_file": target_file,
-        "success": download_success
-    }
+    throughput = bytes_downloaded / seconds / (1 << 20) if seconds else 0
+    progress = f' ({100 * position / size:.1f}%)' if size else ''
+    logging.info(
+        f'{data_source_url}: {position} of {size or "?"} bytes{progress}, '
+        f'{throughput:.2f} MiB/s'
+        )
 
 
 def bash_command_exists(bash_command_name):
@@ -45,17 +308,55 @@ def bash_command_exists(bash_command_name):
     return _which(bash_command_name) is not None
 
 
+def run_osmium(osmium_call, log_file=None):
+    """Run an osmium command and report its exit status and timing
+
+    :param list osmium_call: the command and its arguments
+    :param log_file: file to write stdout and stderr of the command to
+    :return dict: command, returncode, seconds, stderr, log_file and success
+    """
+
+    logging.info(' '.join(osmium_call))
+    start_time = time.time()
+    sp = subprocess.run(
+        osmium_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    seconds = time.time() - start_time
+
+    sp_stderr = sp.stderr.decode('utf-8', errors='replace')
+    if log_file:
+        with open(log_file, 'wb') as sp_log:
+            sp_log.write(sp.stdout)
+            sp_log.write(sp.stderr)
+
+    if sp.returncode != 0:
+        logging.error(
+            '{} failed with exit status {}:\n{}'.format(
+                ' '.join(osmium_call[:2]), sp.returncode, sp_stderr
+                )
+            )
+    elif sp_stderr:
+        logging.warning(sp_stderr)
+
+    return {
+        "command": osmium_call,
+        "returncode": sp.returncode,
+        "seconds": seconds,
+        "stderr": sp_stderr,
+        "log_file": log_file,
+        "success": sp.returncode == 0
+    }
+
+
 def pbf2geojson(pbf_file, geojson_file):
     """Convert pbf data to geojson data
     """
 
-    command_success = False
-
-    if not bash_command_exists("osmium"):
+    if not bash_command_exists(OSMIUM_COMMAND):
         raise Exception("'osmium' is not detected" )
 
     osmium_call = [
-        "osmium",
+        OSMIUM_COMMAND,
         "export",
         pbf_file,
         "-o",
@@ -67,104 +368,196 @@ def pbf2geojson(pbf_file, geojson_file):
         "geojson"
     ]
 
-    try:
-        print(' '.join(osmium_call) )
-        with open(geojson_file, "w") as sp_log:
-            with subprocess.Popen(osmium_call, stdout=sp_log, stderr=subprocess.PIPE) as sp:
-                sp.wait()
-                sp_stdout, sp_stderr = sp.communicate()
-
-            sp_log.flush()
-
-        if sp_stderr:
-            logging.warning(sp_stderr)
-        command_success = True
-    except CalledProcessError as ee:
-        #logging.exception("Could not execute command! stderr:\n{}".format(sp_stderr) )
-        raise Exception(ee)
-
+    export_log = run_osmium(osmium_call, log_file=geojson_file + '.log')
 
     return {
         "pbf_file": pbf_file,
         "geojson_file": geojson_file,
-        "success": command_success
+        "success": export_log['success'],
+        "returncode": export_log['returncode'],
+        "osmium_seconds": export_log['seconds']
     }
 
 
-def pbf_filter(pbf_file, filtered_pbf_file, filter_params, bounding_box=None):
-    """Convert pbf data to geojson data
+def _drain_stream(stream, lines):
+    """Read a stream until it is closed and keep the lines
     """
 
-    if filter_params is None:
-        filter_params = []
+    for line in iter(stream.readline, b''):
+        lines.append(line.decode('utf-8', errors='replace').rstrip())
+
+
+def iter_osmium_export(pbf_file, stats=None, osmium_command=None):
+    """Export pbf data as a GeoJSON text sequence and iterate over the features
 
-    command_success = False
+    osmium writes the features to stdout while they are consumed, so that
+    the export overlaps with whatever processes the features. The pipe
+    gives backpressure: osmium blocks when the consumer falls behind.
+    stderr is read by a thread at the same time, so that osmium can never
+    block on a full stderr pipe.
 
-    if not bash_command_exists("osmium"):
+    If the consumer stops early, osmium is killed.
+
+    :param pbf_file: path to the pbf file
+    :param dict stats: filled with the number of features, exit status,
+        stderr and seconds when the export is finished
+    :param osmium_command: osmium binary, default to OSMIUM_COMMAND
+    """
+
+    if stats is None:
+        stats = {}
+    if osmium_command is None:
+        osmium_command = OSMIUM_COMMAND
+
+    if not bash_command_exists(osmium_command):
         raise Exception("'osmium' is not detected" )
 
-    if bounding_box is None:
-        osmium_call_bounding = []
-        osmium_call = [
-            "osmium",
-            "tags-filter",
-            "-o",
-            filtered_pbf_file,
-            pbf_file
-        ] + filter_params + ["--overwrite"]
-    else:
-        # bounded_pbf_file_sufix = '.bounded.osm.pbf'
-        bounded_pbf_file = pbf_file.split('/')
-        bounded_pbf_file[-1] = 'bounding_' + bounded_pbf_file[-1]
-        bounded_pbf_file = '/'.join(bounded_pbf_file)
-        osmium_call_bounding = [
-            "osmium",
-            "extract",
-            "-b",
-            f"{bounding_box}",
-            f"{pbf_file}",
-            "-o",
-            f"{bounded_pbf_file}",
-            "--overwrite"
-        ]
-        osmium_call = [
-            "osmium",
-            "tags-filter",
-            "-o",
-            filtered_pbf_file,
-            bounded_pbf_file
-        ] + filter_params + ["--overwrite"]
+    osmium_call = [
+        osmium_command,
+        "export",
+        pbf_file,
+        "-u",
+        "type_id",
+        "--output-format",
+        "geojsonseq"
+    ]
 
+    logging.debug(' '.join(osmium_call) )
+    start_time = time.time()
+    sp = subprocess.Popen(
+        osmium_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    sp_stderr = []
+    stderr_thread = threading.Thread(
+        target=_drain_stream, args=(sp.stderr, sp_stderr), daemon=True
+        )
+    stderr_thread.start()
+
+    n_features = 0
+    is_exhausted = False
     try:
-        if osmium_call_bounding:
-            print(' '.join(osmium_call_bounding) )
-            logging.debug('Applying bounding box to pbf data')
-            with open(filtered_pbf_file+'.log', "w") as sp_log:
-                with subprocess.Popen(osmium_call_bounding, stdout=sp_log, stderr=subprocess.PIPE) as sp:
-                    sp.wait()
-                    sp_stdout, sp_stderr = sp.communicate()
+        for line in sp.stdout:
+            # records of geojson text sequences start with a record separator
+            line = line.strip(b'\x1e \t\r\n')
+            if not line:
+                continue
+            n_features += 1
+            yield json.loads(line.decode('utf-8'))
+        is_exhausted = True
+    finally:
+        if not is_exhausted:
+            sp.kill()
+        sp.stdout.close()
+        returncode = sp.wait()
+        stderr_thread.join()
+        sp.stderr.close()
+        stats.update({
+            "pbf_file": pbf_file,
+            "features": n_features,
+            "returncode": returncode,
+            "stderr": sp_stderr,
+            "seconds": time.time() - start_time,
+            "success": is_exhausted and (returncode == 0)
+        })
+
+    if sp_stderr:
+        logging.info('\n'.join(sp_stderr))
+    if returncode != 0:
+        raise Exception(
+            f'osmium export of {pbf_file} failed with exit status {returncode}'
+            )
+
+
+def pbf_filter(
+    pbf_file,
+    filtered_pbf_file,
+    filter_params,
+    bounding_box=None,
+    keep_intermediate=None
+    ):
+    """Filter the tags of pbf data, optionally within a bounding box
+
+    With a bounding box, the area is first cut out with osmium extract
+    into a temporary pbf next to filtered_pbf_file, which is removed once
+    tags-filter has read it. The two commands can't be piped, as both read
+    their input twice to keep the nodes of the ways.
+
+    Every osmium call gets its own log file, exit status and timing.
+
+    :param pbf_file: path to the pbf file
+    :param filtered_pbf_file: path to the filtered pbf file
+    :param list filter_params: osmium tags-filter expressions
+    :param bounding_box: left,bottom,right,top
+    :param keep_intermediate: keep the pbf cut out by the bounding box
+    :return dict: log with the logs of the osmium calls under calls
+    """
 
-                sp_log.flush()
+    if filter_params is None:
+        filter_params = []
 
-        print(' '.join(osmium_call) )
-        with open(filtered_pbf_file+'.log', "w+") as sp_log:
-            with subprocess.Popen(osmium_call, stdout=sp_log, stderr=subprocess.PIPE) as sp:
-                sp.wait()
-                sp_stdout, sp_stderr = sp.communicate()
+    if not bash_command_exists(OSMIUM_COMMAND):
+        raise Exception("'osmium' is not detected" )
 
-            sp_log.flush()
+    osmium_logs = []
+    tags_filter_input = pbf_file
+    bounded_pbf_file = None
 
-        if sp_stderr:
-            logging.warning(sp_stderr)
-        command_success = True
-    except CalledProcessError as ee:
-        #logging.exception("Could not execute command! stderr:\n{}".format(sp_stderr) )
-        raise Exception(ee)
+    try:
+        if bounding_box is not None:
+            bounded_pbf_file_handle, bounded_pbf_file = tempfile.mkstemp(
+                prefix='bounding_',
+                suffix='.osm.pbf',
+                dir=os.path.dirname(os.path.abspath(filtered_pbf_file))
+                )
+            os.close(bounded_pbf_file_handle)
+            osmium_call_bounding = [
+                OSMIUM_COMMAND,
+                "extract",
+                "-b",
+                f"{bounding_box}",
+                f"{pbf_file}",
+                "-o",
+                f"{bounded_pbf_file}",
+                "--overwrite"
+            ]
+            logging.debug('Applying bounding box to pbf data')
+            osmium_logs.append(
+                run_osmium(osmium_call_bounding, log_file=filtered_pbf_file + '.extract.log')
+                )
+            tags_filter_input = bounded_pbf_file
+
+        if all(x['success'] for x in osmium_logs):
+            osmium_call = [
+                OSMIUM_COMMAND,
+                "tags-filter",
+                "-o",
+                filtered_pbf_file,
+                tags_filter_input
+            ] + filter_params + ["--overwrite"]
+            osmium_logs.append(
+                run_osmium(osmium_call, log_file=filtered_pbf_file + '.tags-filter.log')
+                )
+    finally:
+        if bounded_pbf_file and os.path.isfile(bounded_pbf_file):
+            if keep_intermediate:
+                logging.info(f'Keeping intermediate pbf file: {bounded_pbf_file}')
+            else:
+                os.remove(bounded_pbf_file)
 
     return {
         "pbf_file": pbf_file,
-        "filtered_pbf_file": pbf_file,
-        "success": command_success
+        "filtered_pbf_file": filtered_pbf_file,
+        "success": all(x['success'] for x in osmium_logs),
+        "calls": [
+            {
+                "command": x['command'][1],
+                "returncode": x['returncode'],
+                "seconds": x['seconds'],
+                "log_file": x['log_file'],
+                "success": x['success']
+            }
+            for x in osmium_logs
+        ]
     }
 
 
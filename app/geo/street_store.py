@@ -0,0 +1,307 @@
+import logging
+import re
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from app.geo.util import arrays_to_line_strings as _arrays_to_line_strings
+from app.geo.util import coordinates_to_arrays as _coordinates_to_arrays
+from app.geo.util import line_strings_to_arrays as _line_strings_to_arrays
+from app.geo.util import project_coords as _project_coords
+
+logging.basicConfig()
+_logger = logging.getLogger('app.geo.street_store')
+
+# Columns of the street GeoDataFrame used by the distance calculator
+STREET_COLUMNS = ['geometry', 'geometry_projected', 'id', 'name', 'highway', 'observation_date']
+
+# Categorical columns, stored as codes into sorted categories
+CATEGORICAL_COLUMNS = ['name', 'highway']
+
+# Osm ids are split into a prefix and a number, e.g. way/ and 123 of way/123
+OSM_ID_PATTERN = re.compile(r'^(.*?)([1-9][0-9]{0,17})$')
+
+
+def encode_categories(values):
+    """Codes into the sorted distinct values, -1 for missing values
+
+    The categories are kept as fixed width unicode array instead of python
+    strings, which does not hold on to the strings of values and can be
+    saved and mapped without pickling.
+
+    :return tuple: (int32 codes, unicode array of the categories)
+    """
+
+    codes, categories = pd.factorize(
+        pd.Series(list(values), dtype=object), sort=True
+        )
+
+    return codes.astype(np.int32), np.asarray(categories).astype(str)
+
+
+def decode_categories(codes, categories, positions=None):
+    """Values of categorical codes, None for code -1
+
+    :param positions: only decode the codes at these positions
+    :return: object array
+    """
+
+    if positions is not None:
+        codes = codes[positions]
+
+    # code -1 points to the appended None
+    return np.append(categories.astype(object), None)[codes]
+
+
+def encode_osm_ids(osm_ids):
+    """Split osm ids into int64 numbers and categorical prefixes
+
+    The split is lossless: ids without a number get number -1 and are
+    kept as prefix, e.g., way/123 -> (way/, 123), abc -> (abc, -1).
+
+    :return tuple: (int64 numbers, prefix codes, prefix categories)
+    """
+
+    osm_ids = list(osm_ids)
+    numbers = np.full(len(osm_ids), -1, dtype=np.int64)
+    prefixes = []
+    for i, osm_id in enumerate(osm_ids):
+        if osm_id is not None and not isinstance(osm_id, str):
+            osm_id = str(osm_id)
+        match = OSM_ID_PATTERN.match(osm_id) if osm_id is not None else None
+        if match:
+            prefixes.append(match.group(1))
+            numbers[i] = int(match.group(2))
+        else:
+            prefixes.append(osm_id)
+
+    prefix_codes, prefix_categories = encode_categories(prefixes)
+
+    return numbers, prefix_codes, prefix_categories
+
+
+def decode_osm_ids(numbers, prefix_codes, prefix_categories, positions=None):
+    """Osm ids from the result of encode_osm_ids
+
+    :return: object array of str
+    """
+
+    if positions is not None:
+        numbers = numbers[positions]
+        prefix_codes = prefix_codes[positions]
+
+    prefixes = decode_categories(prefix_codes, prefix_categories)
+    osm_ids = np.empty(len(numbers), dtype=object)
+    for i, (prefix, number) in enumerate(zip(prefixes, numbers)):
+        osm_ids[i] = prefix if number < 0 else f'{prefix or ""}{number}'
+
+    return osm_ids
+
+
+class StreetStore(object):
+    """Compact columnar store of prepared street data
+
+    Instead of shapely objects and python strings in a GeoDataFrame, the
+    streets are kept in a few numpy arrays:
+
+    * ``coords`` and ``coords_projected``: flat coordinate buffers of the
+      LineStrings in longitude/latitude and in the projection used for
+      distances, with ``offsets`` into both
+    * ``id_numbers`` (int64) and ``id_prefix_codes``: the osm ids
+    * ``name_codes`` and ``highway_codes``: int32 codes into the sorted
+      unicode arrays ``*_categories``, -1 for missing values
+    * ``observation_date_categories``: the observation date of the
+      snapshot, with ``observation_date_codes`` only if the streets have
+      different observation dates
+
+    to_geodataframe returns the GeoDataFrame of prepare_street_data.
+
+    :param dict arrays: name -> numpy array as returned by to_arrays
+    :param cache_dir: street cache the arrays are mapped from, None if
+        they are not mapped, see attach_street_store
+    """
+
+    def __init__(self, arrays, cache_dir=None):
+
+        self.arrays = dict(arrays)
+        self.cache_dir = cache_dir
+        self._query_arrays = None
+
+    @classmethod
+    def from_columns(
+        cls,
+        geoms_coordinates,
+        ids,
+        names,
+        highways,
+        observation_dates,
+        transformer=None,
+        dtype=None
+        ):
+        """Build a store from the coordinates and attributes of the streets
+
+        :param geoms_coordinates: iterable of sequences of (longitude, latitude)
+        :param transformer: pyproj Transformer to the projection of the distances
+        :param dtype: dtype of the coordinates, float64 (default) or float32;
+            float32 halves the memory of the geometries, the distances are
+            then precise to about a meter
+        """
+
+        if dtype is None:
+            dtype = np.float64
+
+        coords, offsets = _coordinates_to_arrays(geoms_coordinates)
+        arrays = {
+            "coords": coords.astype(dtype, copy=False),
+            "offsets": offsets
+        }
+        if transformer is not None:
+            arrays['coords_projected'] = _project_coords(
+                coords, transformer
+                ).astype(dtype, copy=False)
+        del coords
+
+        (
+            arrays['id_numbers'],
+            arrays['id_prefix_codes'],
+            arrays['id_prefix_categories']
+        ) = encode_osm_ids(ids)
+
+        for column, values in zip(CATEGORICAL_COLUMNS, [names, highways]):
+            arrays[f'{column}_codes'], arrays[f'{column}_categories'] = encode_categories(values)
+
+        observation_date_codes, observation_date_categories = encode_categories(
+            observation_dates
+            )
+        arrays['observation_date_categories'] = observation_date_categories
+        if not (
+            (len(observation_date_categories) == 1)
+            and (observation_date_codes == 0).all()
+            ):
+            arrays['observation_date_codes'] = observation_date_codes
+
+        return cls(arrays)
+
+    @classmethod
+    def from_geodataframe(cls, streets_df, dtype=None):
+        """Build a store from a GeoDataFrame of prepare_street_data
+        """
+
+        store = cls.from_columns(
+            (geom.coords for geom in streets_df.geometry),
+            streets_df['id'],
+            streets_df['name'],
+            streets_df['highway'],
+            streets_df['observation_date'],
+            dtype=dtype
+            )
+        coords_projected, _ = _line_strings_to_arrays(streets_df['geometry_projected'])
+        store.arrays['coords_projected'] = coords_projected.astype(
+            store.arrays['coords'].dtype, copy=False
+            )
+
+        return store
+
+    def to_arrays(self):
+        """Arrays of the store, e.g., to be cached
+        """
+
+        return dict(self.arrays)
+
+    @classmethod
+    def from_arrays(cls, arrays, cache_dir=None):
+        """Inverse of to_arrays
+        """
+
+        return cls(arrays, cache_dir=cache_dir)
+
+    def __len__(self):
+        return len(self.arrays['offsets']) - 1
+
+    @property
+    def nbytes(self):
+        """Bytes used by the arrays
+        """
+
+        return sum(value.nbytes for value in self.arrays.values())
+
+    @property
+    def observation_date(self):
+        """Observation date of the snapshot, None if the dates are mixed
+        """
+
+        if 'observation_date_codes' in self.arrays:
+            return None
+        categories = self.arrays['observation_date_categories']
+
+        return categories[0] if len(categories) else None
+
+    def column_values(self, column, positions=None):
+        """Values of a column of to_geodataframe without building the GeoDataFrame
+
+        :param column: id, name, highway or observation_date
+        :param positions: positions of the streets, default to all
+        :return: object array
+        """
+
+        arrays = self.arrays
+        if column == 'id':
+            return decode_osm_ids(
+                arrays['id_numbers'],
+                arrays['id_prefix_codes'],
+                arrays['id_prefix_categories'],
+                positions=positions
+                )
+        if column == 'observation_date' and 'observation_date_codes' not in arrays:
+            n_values = len(self) if positions is None else len(positions)
+            return decode_categories(
+                np.zeros(n_values, dtype=np.int32),
+                arrays['observation_date_categories']
+                )
+        if column in CATEGORICAL_COLUMNS + ['observation_date']:
+            return decode_categories(
+                arrays[f'{column}_codes'], arrays[f'{column}_categories'],
+                positions=positions
+                )
+
+        raise KeyError(column)
+
+    def query_arrays(self):
+        """Arrays used to measure distances, like street_query_arrays
+
+        :return tuple: (coords_projected, offsets, name_codes, highway_codes)
+        """
+
+        if self._query_arrays is None:
+            self._query_arrays = (
+                self.arrays['coords_projected'],
+                self.arrays['offsets'],
+                self.arrays['name_codes'],
+                self.arrays['highway_codes']
+            )
+
+        return self._query_arrays
+
+    def to_geodataframe(self):
+        """GeoDataFrame of the streets, as returned by prepare_street_data
+        """
+
+        df_streets = {
+            "geometry": gpd.GeoSeries(
+                _arrays_to_line_strings(
+                    self.arrays['coords'].astype(np.float64, copy=False),
+                    self.arrays['offsets']
+                    )
+                ),
+            "geometry_projected": _arrays_to_line_strings(
+                self.arrays['coords_projected'].astype(np.float64, copy=False),
+                self.arrays['offsets']
+                )
+        }
+        for column in ['id', 'name', 'highway', 'observation_date']:
+            df_streets[column] = self.column_values(column)
+
+        return gpd.GeoDataFrame(
+            df_streets, columns=STREET_COLUMNS, geometry='geometry'
+            )
@@ -1,18 +1,26 @@
+import ast
 import datetime
 import logging
+import multiprocessing
 import os
 import re
+import time
 import traceback
-from shutil import copyfile
 
 import numpy as np
 import simplejson as json
+from shapely import wkb as _wkb
+from shapely import wkt as _wkt
+from shapely.geometry import mapping as _mapping
+from shapely.geometry import shape as _shape
 
 from .util import \
     check_and_convert_to_datetime as _check_and_convert_to_datetime
 from .util import get_dict_val_recursively as _get_dict_val_recursively
-from .util import insert_to_dict_at_level as _insert_to_dict_at_level
 from .util import isoencode as _isoencode
+from .util import iter_json_array as _iter_json_array
+from .util import iter_lines_in_range as _iter_lines_in_range
+from .util import split_file_by_lines as _split_file_by_lines
 
 logging.basicConfig()
 _logger = logging.getLogger('app.geo.transformer')
@@ -22,6 +30,33 @@ __location__ = os.path.realpath(
     os.path.join(__cwd__, os.path.dirname(__file__))
     )
 
+# Digits of osm ids, e.g. 123 of w123
+OSM_ID_DIGITS_PATTERN = re.compile(r'\d+')
+
+# GeoJSON geometry types by WKB type code
+WKB_GEOMETRY_TYPES = {
+    1: 'Point',
+    2: 'LineString',
+    3: 'Polygon',
+    4: 'MultiPoint',
+    5: 'MultiLineString',
+    6: 'MultiPolygon',
+    7: 'GeometryCollection'
+}
+
+# GeoJSON geometry types by WKT tag
+WKT_GEOMETRY_TYPES = {
+    type_name.upper(): type_name
+    for type_name in WKB_GEOMETRY_TYPES.values()
+}
+
+# Type of the python repr of a geojson dict
+REPR_GEOMETRY_TYPE_PATTERN = re.compile(r'''['"]type['"]\s*:\s*['"](\w+)''')
+
+# Tag of a wkt geometry
+WKT_TAG_PATTERN = re.compile(r'\s*([A-Za-z]+)')
+
+
 def get_osm_id(osm_id_raw, with_type):
     """Standardize the notations for types
     """
@@ -46,7 +81,7 @@ def get_osm_id(osm_id_raw, with_type):
             elif osm_id_raw.startswith('r'):
                 osm_id_type = 'relation'
 
-            osm_id = re.findall(r'\d+', osm_id_raw)
+            osm_id = OSM_ID_DIGITS_PATTERN.findall(osm_id_raw)
             if osm_id:
                 osm_id = osm_id[-1]
                 osm_id = osm_id_type + '/' + osm_id
@@ -60,7 +95,7 @@ def get_osm_id(osm_id_raw, with_type):
         if '/' in osm_id_raw:
             osm_id = osm_id_raw.split('/')[-1]
         else:
-            osm_id = re.findall(r'\d+', osm_id_raw)
+            osm_id = OSM_ID_DIGITS_PATTERN.findall(osm_id_raw)
             if osm_id:
                 osm_id = osm_id[-1]
             else:
@@ -73,14 +108,125 @@ def get_osm_id(osm_id_raw, with_type):
     return osm_id
 
 
+# Encodings of geometries in the transformed files
+GEOMETRY_ENCODINGS = ['geojson', 'wkt', 'wkb']
+
+
+def get_geometry_encoding(schema):
+    """Get the encoding of the geometry field from the schema
+
+    The encoding is specified by the `encoding` of the field `geometry`;
+    geojson is used if it is not specified.
+    """
+
+    for field in schema or []:
+        if field.get('name') == 'geometry':
+            return field.get('encoding', 'geojson')
+
+    return 'geojson'
+
+
+def encode_geometry(geometry, encoding=None):
+    """Encode a GeoJSON geometry dict
+
+    :param dict geometry: GeoJSON geometry
+    :param encoding: geojson (the dict itself), wkt or wkb (hex string)
+    """
+
+    if encoding is None:
+        encoding = 'geojson'
+
+    if not geometry:
+        return None
+
+    if encoding == 'geojson':
+        return geometry
+    elif encoding == 'wkt':
+        return _shape(geometry).wkt
+    elif encoding == 'wkb':
+        return _shape(geometry).wkb_hex
+    else:
+        raise ValueError(
+            f'Geometry encoding {encoding} is not one of {GEOMETRY_ENCODINGS}'
+            )
+
+
+def decode_geometry(geometry):
+    """Decode a geometry from a transformed file to a GeoJSON geometry dict
+
+    All the encodings of encode_geometry are supported, as well as the
+    python repr of the dict (str(dict)) in files transformed by older
+    versions.
+    """
+
+    if isinstance(geometry, dict):
+        return geometry
+
+    if not isinstance(geometry, str) or not geometry:
+        return None
+
+    if geometry.startswith('{'):
+        # python repr of the geojson dict, only simple quotes have to be
+        # replaced to parse it as json since it has no quoted strings
+        try:
+            return json.loads(geometry.replace("'", '"'))
+        except ValueError:
+            return ast.literal_eval(geometry)
+
+    if geometry[0] in '0123456789abcdefABCDEF':
+        return _mapping(_wkb.loads(geometry, hex=True))
+
+    return _mapping(_wkt.loads(geometry))
+
+
+def geometry_type(geometry):
+    """GeoJSON type of a geometry from a transformed file, without decoding it
+
+    Supports the same encodings as decode_geometry; only the type is read,
+    e.g., the header of wkb, so that geometries can be filtered by type
+    before they are decoded.
+
+    :return: e.g., LineString, None if the type is unknown
+    """
+
+    if isinstance(geometry, dict):
+        return geometry.get('type')
+
+    if not isinstance(geometry, str) or not geometry:
+        return None
+
+    if geometry.startswith('{'):
+        match = REPR_GEOMETRY_TYPE_PATTERN.search(geometry)
+        return match.group(1) if match else None
+
+    if geometry[0] in '0123456789abcdefABCDEF':
+        try:
+            type_code = int.from_bytes(
+                bytes.fromhex(geometry[2:10]),
+                'little' if geometry[:2] == '01' else 'big'
+                )
+        except ValueError:
+            return None
+        # drop the flags of extended wkb (z, m, srid) and the
+        # dimension of iso wkb, e.g., 1002 for LineString Z
+        return WKB_GEOMETRY_TYPES.get((type_code & 0xffff) % 1000)
+
+    match = WKT_TAG_PATTERN.match(geometry)
+
+    return WKT_GEOMETRY_TYPES.get(match.group(1).upper()) if match else None
+
+
 class OSMStreetTransformations(object):
     def __init__(
         self,
         localisation_client=None,
         city_mappings=None,
-        country_mappings=None
+        country_mappings=None,
+        geometry_encoding=None
         ):
 
+        self._geometry_encoding = geometry_encoding
+
         if localisation_client:
             self._localisation_client = localisation_client
         if city_mappings:
@@ -129,15 +275,67 @@ class OSMStreetTransformations(object):
         osm_prop = osm.get('properties',{})
         return osm_prop.get('highway')
 
-    @staticmethod
-    def geometry(osm):
-        osm_geometry = str(
-            osm.get('geometry')
+    def geometry(self, osm):
+        """Geometry of the osm object, encoded as specified by geometry_encoding
+        """
+        return encode_geometry(
+            osm.get('geometry'), self._geometry_encoding
         )
-        if osm_geometry:
-            return osm_geometry
+
+
+def compile_transformer_plan(schema,
+                             available_transformers,
+                             transformations,
+                             path=None):
+    """Compile the schema into a flat list of transformers
+
+    The schema is walked once and each field is bound to the transformer
+    named after its key path, e.g., types__highway, so that records can be
+    transformed without walking the schema again.
+
+    :param list schema: a list of schema objects
+    :param list available_transformers: list of strings, representing the names of the transformation functions
+    :param transformations: Class to combine all the transformation functions
+    :param list path: key path of the schema level
+    :return list: list of (key path of the parent, key, transformer)
+    """
+
+    if path is None:
+        path = []
+
+    plan = []
+    for field in schema:
+        key = field['name']
+        key_path_array = path + [key]
+        key_path_str = '__'.join(key_path_array)
+        if key_path_str in available_transformers:
+            plan.append(
+                (tuple(path), key, getattr(transformations, key_path_str))
+                )
+        elif field['type'] == 'RECORD':
+            plan.extend(compile_transformer_plan(
+                field['fields'], available_transformers, transformations, key_path_array
+                ))
         else:
-            return None
+            _logger.error(f'Could not find transformer for {key_path_str}')
+
+    return plan
+
+
+def execute_transformer_plan(plan, dict_inp, result=None):
+    """Transform one record using a plan from compile_transformer_plan
+    """
+
+    if result is None:
+        result = {}
+
+    for parent_path, key, transformer in plan:
+        result_at_level = result
+        for parent_key in parent_path:
+            result_at_level = result_at_level.setdefault(parent_key, {})
+        result_at_level[key] = transformer(dict_inp)
+
+    return result
 
 
 def transform_record(schema_at_level,
@@ -147,20 +345,18 @@ def transform_record(schema_at_level,
                      available_transformers,
                      transformations):
     """Transforms one record according to the input schema
+
+    To transform many records, compile the plan once using
+    compile_transformer_plan and use execute_transformer_plan instead.
     """
 
-    for field in schema_at_level['fields']:
-        key = field['name']
-        key_path_array = path + [key]
-        key_path_str = '__'.join(key_path_array)
-        if key_path_str in available_transformers:
-            transformed = getattr(transformations, key_path_str)(dict_inp)
-            _insert_to_dict_at_level(result, key_path_array, transformed)
-        else:
-            if field['type'] == 'RECORD':
-                transform_record(field, key_path_array, dict_inp, result, available_transformers, transformations)
-            else:
-                _logger.error('Could not transform data')
+    execute_transformer_plan(
+        compile_transformer_plan(
+            schema_at_level['fields'], available_transformers, transformations, path
+            ),
+        dict_inp,
+        result
+        )
 
 def is_useful_osm_record(dic_inp):
     """Tell if the OSM data record is really useful
@@ -173,47 +369,66 @@ def is_useful_osm_record(dic_inp):
     return is_useful
 
 
-def clean_up_geojson(json_inp, load_only_key = None):
+def clean_up_geojson(json_inp, load_only_key=None, keep_backup=None):
     """Convert json file to line delimited format
 
-    #TODO This is not the best way to deal with large json file.
+    The records are streamed one by one from the json file, so the memory
+    used does not depend on the size of the file. The line delimited
+    records are written to a temporary file in the same folder, which
+    then replaces json_inp by renaming.
+
+    :param json_inp: path to the json file, a json array or an object
+        with the array at load_only_key, e.g., the features of geojson
+    :param load_only_key: key of the array of records in the json object
+    :param keep_backup: whether to keep the original file as json_inp.bak;
+        the file is renamed, not copied
     """
-    today_is = datetime.date.today()
-    json_out_temp = '/'.join(
-        json_inp.split('/')[:-1]
-        ) + "/osm-line-delimited-{}.json".format(
-        today_is
-        )
+
+    json_out_temp = json_inp + '.line-delimited.tmp'
+
+    n_records = 0
+    n_useful_records = 0
     try:
-        with open(json_out_temp, "w+") as fp:
+        with open(json_out_temp, "w") as fp:
             with open(json_inp, "r", encoding='utf-8') as json_inp_fp:
-                json_inp_dict = json.load(json_inp_fp)
-                if load_only_key and json_inp_dict.get(load_only_key):
-                    for record in json_inp_dict.get(load_only_key):
-                        if is_useful_osm_record(record):
-                            fp.write(json.dumps(record)+'\n')
-                else:
-                    for record in json_inp_dict:
-                        if is_useful_osm_record(record):
-                            fp.write(json.dumps(record)+'\n')
+                for record in _iter_json_array(json_inp_fp, key=load_only_key):
+                    n_records += 1
+                    if is_useful_osm_record(record):
+                        n_useful_records += 1
+                        fp.write(json.dumps(record)+'\n')
     except Exception as ee:
-        raise Exception("Can not convert json file to line delimited!")
+        if os.path.isfile(json_out_temp):
+            os.remove(json_out_temp)
+        raise Exception(
+            "Can not convert json file to line delimited: {}".format(ee)
+            )
 
     try:
-        copyfile(json_inp, json_inp + ".{}".format("bak") )
+        if keep_backup:
+            os.replace(json_inp, json_inp + ".{}".format("bak"))
+        os.replace(json_out_temp, json_inp)
     except:
         raise Exception('could not replace the geojson {} with line-delimited file {}'.format(
             json_inp,
             json_out_temp
             ))
 
-    try:
-        copyfile(json_out_temp, json_inp)
-    except:
-        raise Exception('could not replace the geojson {} with line-delimited file {}'.format(
-            json_inp,
-            json_out_temp
-            ))
+    _logger.info(
+        f'Converted {json_inp} to line delimited: kept {n_useful_records} of {n_records} records'
+        )
+
+    return {
+        "geojson_file": json_inp,
+        "records": n_records,
+        "useful_records": n_useful_records
+    }
+
+
+def check_observation_date(observation_date):
+    """Check that observation_date is a date of the form %Y-%m-%d
+    """
+
+    assert type(datetime.datetime.strptime(observation_date, "%Y-%m-%d")) == datetime.datetime, 'observation_date miss specified'
 
 
 def transform_and_enhance_record(
@@ -222,20 +437,25 @@ def transform_and_enhance_record(
     available_transformers,
     transformations,
     observation_date,
-    enhancement=None
+    enhancement=None,
+    plan=None
     ):
     """Function takes a single OSM data record and transforms it into a dict
     :param dict dict_inp: One dictionary of the data to be transformed
     :param list schema: A list of schema objects, building on the field schema that is used to create a BigQuery table
     :param list available_transformers: list of strings, representing the names of the transformation functions
     :param OSMTransformation transformations: Class to combine all the transformation functions, includes mapping, cleaning, and general transformations
+    :param list plan: plan from compile_transformer_plan; if specified, the
+        schema is not walked again and observation_date must have been
+        checked with check_observation_date
     :return dict: returns the transformed record with partition field included
     """
 
-    assert type(datetime.datetime.strptime(observation_date, "%Y-%m-%d")) == datetime.datetime, 'observation_date miss specified'
+    if plan is None:
+        check_observation_date(observation_date)
+        plan = compile_transformer_plan(schema, available_transformers, transformations)
 
-    res = {}
-    transform_record({'fields': schema}, [], dict_inp, res, available_transformers, transformations)
+    res = execute_transformer_plan(plan, dict_inp)
     res['observation_date'] = observation_date
 
     if enhancement:
@@ -244,13 +464,263 @@ def transform_and_enhance_record(
     return res
 
 
+def transform_lines(
+    lines,
+    schema,
+    available_transformers,
+    transformations,
+    observation_date
+    ):
+    """Transform line delimited json records and serialise them again
+
+    :param lines: iterable of json lines (str or bytes)
+    :return: (list of transformed json lines, number of records, number of failed records)
+    """
+
+    check_observation_date(observation_date)
+    plan = compile_transformer_plan(schema, available_transformers, transformations)
+
+    transformed_lines = []
+    n_records = 0
+    n_failed_records = 0
+
+    for line in lines:
+        if not line.strip():
+            continue
+        n_records += 1
+        try:
+            row = json.loads(line)
+        except:
+            raise Exception('could not load line to json. line = {}'.format(line) )
+
+        try:
+            #transform the request
+            transformed_req = transform_and_enhance_record(
+                dict_inp = row,
+                schema = schema,
+                available_transformers = available_transformers,
+                transformations = transformations,
+                observation_date = observation_date,
+                plan = plan
+                )
+        except Exception as ee:
+            n_failed_records += 1
+            print(ee)
+            print('could not transform the record:\n {}'.format( row ))
+            traceback.print_exc()
+            continue
+
+        try:
+            transformed_lines.append(
+                json.dumps(
+                    transformed_req,
+                    ignore_nan = True,
+                    default=_isoencode
+                    ) + '\n')
+        except:
+            n_failed_records += 1
+            print('could not write the transformed record:\n {}'.format(row))
+
+    return transformed_lines, n_records, n_failed_records
+
+
+def _timed_stage(iterable, stage_stats):
+    """Count the records of a stage of a generator pipeline and the time spent in it
+
+    The time includes the time spent in the upstream stages.
+    """
+
+    iterator = iter(iterable)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stage_stats['seconds'] += time.perf_counter() - start_time
+            return
+        stage_stats['seconds'] += time.perf_counter() - start_time
+        stage_stats['records'] += 1
+        yield item
+
+
+def _transform_records(records, plan, observation_date, stats):
+    """Transform records with a plan, failed records are counted and skipped
+    """
+
+    for record in records:
+        try:
+            transformed_req = execute_transformer_plan(plan, record)
+            transformed_req['observation_date'] = observation_date
+        except Exception:
+            stats['failed_records'] += 1
+            _logger.exception(f'Could not transform the record:\n {record}')
+            continue
+        yield transformed_req
+
+
+def transform_stream_and_save_to_file(
+    schema,
+    available_transformers,
+    transformations,
+    observation_date,
+    records,
+    output_file
+    ):
+    """Filter, transform and save records from an iterable in one pass
+
+    The records are filtered using is_useful_osm_record, transformed and
+    serialised by a generator pipeline. The output is written to a
+    temporary file which is renamed at the end.
+
+    :param records: iterable of osm records, e.g., geojson features
+    :param str output_file: to filename of the transformed file
+    :return dict: log with the records, bytes written, and the records
+        and seconds of every stage
+    """
+
+    check_observation_date(observation_date)
+    plan = compile_transformer_plan(schema, available_transformers, transformations)
+
+    stage_names = ['parse', 'filter', 'transform', 'serialise', 'write']
+    stages = {
+        stage_name: {"records": 0, "seconds": 0.0} for stage_name in stage_names
+    }
+    stats = {"failed_records": 0}
+
+    start_time = time.time()
+    output_file_temp = output_file + '.tmp'
+    try:
+        with open(output_file_temp, 'w') as output_fp:
+            records = _timed_stage(records, stages['parse'])
+            useful_records = _timed_stage(
+                filter(is_useful_osm_record, records), stages['filter']
+                )
+            transformed_records = _timed_stage(
+                _transform_records(useful_records, plan, observation_date, stats),
+                stages['transform']
+                )
+            transformed_lines = _timed_stage(
+                (
+                    json.dumps(record, ignore_nan=True, default=_isoencode) + '\n'
+                    for record in transformed_records
+                ),
+                stages['serialise']
+                )
+            for line in transformed_lines:
+                write_start_time = time.perf_counter()
+                output_fp.write(line)
+                stages['write']['seconds'] += time.perf_counter() - write_start_time
+                stages['write']['records'] += 1
+    except Exception:
+        # e.g., osmium failed while streaming the records
+        if os.path.isfile(output_file_temp):
+            os.remove(output_file_temp)
+        raise
+    os.replace(output_file_temp, output_file)
+    seconds = time.time() - start_time
+
+    # the time of each stage includes the time of the stages before it
+    for stage_name, upstream_stage_name in reversed(list(zip(stage_names[1:-1], stage_names[:-2]))):
+        stages[stage_name]['seconds'] -= stages[upstream_stage_name]['seconds']
+
+    n_records = stages['parse']['records']
+    res_log = {
+        "output_file": output_file,
+        "records": n_records,
+        "useful_records": stages['filter']['records'],
+        "failed_records": stats['failed_records'],
+        "bytes_written": os.path.getsize(output_file),
+        "seconds": seconds,
+        "records_per_second": n_records / seconds if seconds else None,
+        "stages": stages
+    }
+
+    _logger.info(
+        f'Transformed {n_records} records in {seconds} seconds into {output_file}'
+        )
+
+    return res_log
+
+
+def transform_geojson_and_save_to_file(
+    schema,
+    available_transformers,
+    transformations,
+    observation_date,
+    input_file,
+    output_file,
+    load_only_key=None
+    ):
+    """Filter, transform and save the records of a geojson file in one pass
+
+    This fuses clean_up_geojson and transform_records_and_save_to_file:
+    the features are streamed from the geojson export into
+    transform_stream_and_save_to_file, so that no intermediate line
+    delimited file is written.
+
+    :param str input_file: the geojson file, e.g., from osmium export
+    :param str output_file: to filename of the transformed file
+    :param load_only_key: key of the array of records in the json, default to features
+    :return dict: log of transform_stream_and_save_to_file with the bytes read
+    """
+
+    if load_only_key is None:
+        load_only_key = 'features'
+
+    with open(input_file, 'r', encoding='utf-8') as input_fp:
+        res_log = transform_stream_and_save_to_file(
+            schema,
+            available_transformers,
+            transformations,
+            observation_date,
+            _iter_json_array(input_fp, key=load_only_key),
+            output_file
+            )
+
+    return {
+        "input_file": input_file,
+        "bytes_read": os.path.getsize(input_file),
+        **res_log
+    }
+
+
+def _transform_file_range(job):
+    """Transform the records in a byte range of a file, run by the process pool
+    """
+
+    (
+        input_file, range_start, range_end,
+        schema, available_transformers, transformations, observation_date
+    ) = job
+
+    start_time = time.time()
+    with open(input_file, 'rb') as fp:
+        transformed_lines, n_records, n_failed_records = transform_lines(
+            _iter_lines_in_range(fp, range_start, range_end),
+            schema,
+            available_transformers,
+            transformations,
+            observation_date
+            )
+
+    return ''.join(transformed_lines), {
+        "worker": os.getpid(),
+        "bytes": range_end - range_start,
+        "records": n_records,
+        "failed_records": n_failed_records,
+        "seconds": time.time() - start_time
+    }
+
+
 def transform_records_and_save_to_file(
     schema,
     available_transformers,
     transformations,
     observation_date,
     input_file,
-    output_file
+    output_file,
+    workers=None,
+    chunk_size=None
     ):
     """
     :param list schema: a list of schema objects, building on the field schema that is used to create a BigQuery table
@@ -262,8 +732,16 @@ def transform_records_and_save_to_file(
                                           did not run properly
     :param str input_file: the filename of the input file
     :param str output_file: to filename of the transformed file
+    :param int workers: number of processes; if more than 1, the input file is
+        split into byte ranges at line boundaries, which are transformed in a
+        process pool and written in input order
+    :param int chunk_size: approximate size of the byte ranges in bytes
+    :return dict: log with the number of records, throughput and stats of the workers
     """
 
+    if workers is None:
+        workers = 1
+
     if os.path.isfile(output_file):
         try:
             os.remove(output_file)
@@ -276,36 +754,113 @@ def transform_records_and_save_to_file(
             output_file
             ) )
 
+    start_time = time.time()
+    jobs = [
+        (
+            input_file, range_start, range_end,
+            schema, available_transformers, transformations, observation_date
+        )
+        for range_start, range_end in _split_file_by_lines(input_file, chunk_size)
+    ]
+
+    chunk_stats = []
     with open(output_file, 'w+') as output_file_transformed:
-        with open(input_file, 'r') as input_file:
-            for line in input_file:
-                try:
-                    row = json.loads(line)
-                except:
-                    raise Exception('could not load line to json. line = {}'.format(line) )
-
-                try:
-                    #transform the request
-                    transformed_req = transform_and_enhance_record(
-                        dict_inp = row,
-                        schema = schema,
-                        available_transformers = available_transformers,
-                        transformations = transformations,
-                        observation_date = observation_date
-                        )
-                except Exception as ee:
-                    print(ee)
-                    print('could not transform the record:\n {}'.format( row ))
-                    traceback.print_exc()
-
-                try:
-                    output_file_transformed.write(
-                        json.dumps(
-                            transformed_req,
-                            ignore_nan = True,
-                            default=_isoencode
-                            ) + '\n')
-                except:
-                    print('could not write the transformed record:\n {}'.format(row))
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                # imap returns the chunks in the order of the input
+                for transformed_chunk, stats in pool.imap(_transform_file_range, jobs):
+                    output_file_transformed.write(transformed_chunk)
+                    chunk_stats.append(stats)
+        else:
+            for transformed_chunk, stats in map(_transform_file_range, jobs):
+                output_file_transformed.write(transformed_chunk)
+                chunk_stats.append(stats)
+
+    seconds = time.time() - start_time
+
+    worker_stats = {}
+    for stats in chunk_stats:
+        worker = worker_stats.setdefault(
+            stats['worker'],
+            {"chunks": 0, "records": 0, "failed_records": 0, "seconds": 0}
+            )
+        worker['chunks'] += 1
+        worker['records'] += stats['records']
+        worker['failed_records'] += stats['failed_records']
+        worker['seconds'] += stats['seconds']
+
+    n_records = sum(stats['records'] for stats in chunk_stats)
+    res_log = {
+        "input_file": input_file,
+        "output_file": output_file,
+        "workers": workers,
+        "chunks": len(chunk_stats),
+        "records": n_records,
+        "failed_records": sum(stats['failed_records'] for stats in chunk_stats),
+        "seconds": seconds,
+        "records_per_second": n_records / seconds if seconds else None,
+        "worker_stats": worker_stats
+    }
 
     print('wrote json file into: {}'.format(output_file))
+    _logger.info(
+        f'Transformed {n_records} records with {workers} workers in {seconds} seconds'
+        )
+
+    return res_log
+
+
+def merge_transformed_files(input_files, output_file, key=None):
+    """Concatenate files of transformed records and drop duplicated records
+
+    Records whose key was already written from one of the previous files
+    are dropped, e.g., ways crossing the border of two tiles are in the
+    files of both tiles. Records within one file are not compared. Lines
+    are copied as they are.
+
+    :param list input_files: line delimited json files
+    :param str output_file: the merged file
+    :param key: field identifying a record, default to id
+    :return dict: log with the records per input file and the duplicates
+    """
+
+    if key is None:
+        key = 'id'
+
+    seen_keys = set()
+    input_stats = []
+    n_duplicates = 0
+
+    output_file_temp = output_file + '.tmp'
+    with open(output_file_temp, 'w') as output_fp:
+        for input_file in input_files:
+            n_records = 0
+            file_keys = set()
+            with open(input_file, 'r') as input_fp:
+                for line in input_fp:
+                    if not line.strip():
+                        continue
+                    record_key = json.loads(line).get(key)
+                    if record_key in seen_keys:
+                        n_duplicates += 1
+                        continue
+                    if record_key is not None:
+                        file_keys.add(record_key)
+                    output_fp.write(line if line.endswith('\n') else line + '\n')
+                    n_records += 1
+            seen_keys.update(file_keys)
+            input_stats.append({"input_file": input_file, "records": n_records})
+    os.replace(output_file_temp, output_file)
+
+    n_records = sum(x['records'] for x in input_stats)
+    _logger.info(
+        f'Merged {len(input_files)} files into {output_file}: '
+        f'{n_records} records, {n_duplicates} duplicates'
+        )
+
+    return {
+        "output_file": output_file,
+        "records": n_records,
+        "duplicates": n_duplicates,
+        "inputs": input_stats
+    }
@@ -1,36 +1,372 @@
 import datetime
+import gzip
 import logging
 import os
 import json
+import re
+import time
+from functools import lru_cache
+from itertools import chain
 from time import sleep as _sleep
 import dateutil
 
 import numpy as np
 import pandas as pd
+import pyproj
 import pytz
 
+from shapely.geometry import LineString
 from shapely.ops import transform
 
+from app.geo.writer import NDJSONWriter as _NDJSONWriter
+
 logging.basicConfig()
 _logger = logging.getLogger('app.geo.util')
 
 
+# Size of the blocks read by iter_ndjson_blocks in bytes
+NDJSON_BLOCK_SIZE = 1 << 24
+
+
+def iter_ndjson_blocks(file_path, block_size=None, stats=None, quarantine_file=None):
+    """Parse a line delimited json file in blocks of lines
+
+    Every block is parsed with one call to the json decoder. Only if that
+    fails or does not give one record per line, the lines of the block are
+    parsed one by one to find the bad lines, which are counted and copied
+    to quarantine_file instead of being returned; if quarantine_file can
+    not be written, they are only logged. Lines which are not json objects
+    are bad lines as well; empty lines are skipped.
+
+    :param file_path: path to the file
+    :param block_size: approximate size of the blocks in bytes
+    :param dict stats: receives the number of lines, records and bad lines
+    :param quarantine_file: file the bad lines are written to, default to
+        file_path + .quarantine; it is only created if there are bad lines
+    :return: generator of lists of records (dicts)
+    """
+
+    if block_size is None:
+        block_size = NDJSON_BLOCK_SIZE
+    if stats is None:
+        stats = {}
+    if quarantine_file is None:
+        quarantine_file = f'{file_path}.quarantine'
+
+    stats.update({
+        "file_path": file_path,
+        "lines": 0,
+        "records": 0,
+        "bad_lines": 0,
+        "quarantine_file": None
+    })
+
+    # bad lines of a previous run
+    try:
+        if os.path.isfile(quarantine_file):
+            os.remove(quarantine_file)
+    except OSError as ee:
+        _logger.warning(f'Could not remove quarantine file {quarantine_file}: {ee}')
+
+    quarantine_fp = None
+    # False once the quarantine file can not be written, e.g., in a read
+    # only directory; the bad lines are only logged then
+    is_quarantine_writable = True
+    try:
+        with open(file_path, 'rb') as fp:
+            remainder = b''
+            while True:
+                block = fp.read(block_size)
+                if not block:
+                    lines = remainder.splitlines()
+                    remainder = b''
+                else:
+                    block = remainder + block
+                    block_end = block.rfind(b'\n') + 1
+                    lines = block[:block_end].splitlines()
+                    remainder = block[block_end:]
+                lines = [line for line in lines if line.strip()]
+
+                if lines:
+                    line_start = stats['lines']
+                    stats['lines'] += len(lines)
+                    try:
+                        records = json.loads(b'[' + b','.join(lines) + b']')
+                        # a record broken across lines or several records
+                        # in one line still parse as a json array
+                        if len(records) != len(lines):
+                            raise ValueError('not one record per line')
+                        if not all(isinstance(record, dict) for record in records):
+                            raise ValueError('not all lines are json objects')
+                    except ValueError:
+                        records = []
+                        for line_number, line in enumerate(lines, line_start + 1):
+                            try:
+                                record = json.loads(line)
+                                if not isinstance(record, dict):
+                                    raise ValueError('not a json object')
+                            except ValueError as ee:
+                                stats['bad_lines'] += 1
+                                if (quarantine_fp is None) and is_quarantine_writable:
+                                    try:
+                                        quarantine_fp = open(quarantine_file, 'wb')
+                                        stats['quarantine_file'] = quarantine_file
+                                    except OSError as open_error:
+                                        is_quarantine_writable = False
+                                        _logger.warning(
+                                            f'Could not open quarantine file {quarantine_file}: {open_error}'
+                                            )
+                                if quarantine_fp is None:
+                                    _logger.warning(f'Bad line {file_path}:{line_number}: {ee}')
+                                    continue
+                                quarantine_fp.write(line.rstrip(b'\r\n') + b'\n')
+                                _logger.debug(f'{file_path}:{line_number}: {ee}')
+                                continue
+                            records.append(record)
+                    stats['records'] += len(records)
+                    yield records
+
+                if not block:
+                    break
+    finally:
+        if quarantine_fp is not None:
+            quarantine_fp.close()
+
+    if stats['quarantine_file']:
+        _logger.warning(
+            f'{stats["bad_lines"]} bad lines of {file_path} were written to {quarantine_file}'
+            )
+    elif stats['bad_lines']:
+        _logger.warning(f'Skipped {stats["bad_lines"]} bad lines of {file_path}')
+
+
+def records_to_columns(records, columns=None):
+    """Columns of a list of records, None for missing fields
+
+    :param columns: names of the columns, default to all fields in the
+        order they appear
+    :return dict: column name -> list of values
+    """
+
+    if columns is None:
+        columns = []
+        seen_columns = set()
+        for record in records:
+            for column in record:
+                if column not in seen_columns:
+                    seen_columns.add(column)
+                    columns.append(column)
+
+    return {
+        column: [record.get(column) for record in records]
+        for column in columns
+    }
+
+
+def load_ndjson(
+    file_path,
+    columns=None,
+    record_filter=None,
+    block_size=None,
+    stats=None,
+    quarantine_file=None
+    ):
+    """Load a line delimited json file into a DataFrame
+
+    The file is parsed block by block, see iter_ndjson_blocks, and the
+    records of every block are filtered and converted to columns right
+    away, so that the records of at most one block are kept in memory and
+    rejected records never get into the columns. The columns are moved
+    into the DataFrame one by one. null is loaded as None.
+
+    :param columns: only load these columns, default to all fields
+    :param record_filter: function of a record returning whether the
+        record is loaded, default to all records
+    :param dict stats: receives the number of lines, records, bad lines,
+        rejected records and the seconds used
+    :return: DataFrame with one row per loaded record
+    """
+
+    if stats is None:
+        stats = {}
+
+    start_time = time.time()
+    data = {} if columns is None else {column: [] for column in columns}
+    n_rows = 0
+    n_rejected = 0
+    for records in iter_ndjson_blocks(
+        file_path, block_size=block_size, stats=stats, quarantine_file=quarantine_file
+        ):
+        if record_filter is not None:
+            n_records = len(records)
+            records = [record for record in records if record_filter(record)]
+            n_rejected += n_records - len(records)
+        block_columns = records_to_columns(records, columns=columns)
+        for column, values in block_columns.items():
+            if column not in data:
+                # fill the rows of the previous blocks without this field
+                data[column] = [None] * n_rows
+            data[column].extend(values)
+        for column in data:
+            if column not in block_columns:
+                data[column].extend([None] * len(records))
+        n_rows += len(records)
+        del records, block_columns
+
+    # convert and release the lists column by column, so that the lists
+    # of all columns are never kept next to the DataFrame
+    column_names = list(data)
+    df_output = pd.DataFrame(index=pd.RangeIndex(n_rows))
+    for column in column_names:
+        values = data.pop(column)
+        df_output[column] = pd.Series(
+            values, index=df_output.index, dtype=None if values else object
+            )
+        del values
+    stats['rejected'] = n_rejected
+    stats['seconds'] = time.time() - start_time
+
+    return df_output
+
+
 def load_records(data_path_inp):
+    """Load the records of a line delimited json file
+
+    null is loaded as None; lines which can not be parsed are skipped and
+    written to data_path_inp + .quarantine, see iter_ndjson_blocks.
+
+    :return list: records
+    """
 
     data = []
+    for records in iter_ndjson_blocks(data_path_inp):
+        data.extend(records)
 
-    with open(data_path_inp, 'r') as fp:
-        for line in fp:
-            line = line.replace('null', ' "None" ')
+    return data
+
+
+class _JSONStreamReader(object):
+    """Buffered reader to decode json values one by one from a file
+    """
+
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.is_eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size=None):
+        """Drop the consumed part of the buffer and read the next chunk
+        """
+        chunk = self.fp.read(size or self.chunk_size)
+        if not chunk:
+            self.is_eof = True
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    def peek(self):
+        """Next non whitespace character, None at the end of the file
+        """
+        while True:
+            self.position = self._whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.is_eof:
+                return None
+            self._fill()
+
+    def expect(self, characters):
+        """Consume the next non whitespace character, which must be one of characters
+        """
+        character = self.peek()
+        if (character is None) or (character not in characters):
+            raise ValueError(
+                f'Expected one of {characters} but found {character}'
+                )
+        self.position += 1
+        return character
+
+    def decode(self):
+        """Decode the next json value
+
+        Reads more data until the value is complete; a number which is
+        followed by the end of the buffer or by a number character could
+        be truncated.
+        The size of the reads doubles, so that large values are not
+        decoded again and again.
+        """
+        self.peek()
+        read_size = self.chunk_size
+        while True:
             try:
-                line_data = json.loads(line.strip())
-            except Exception as ee:
-                logging.warning('could not load ', line, '\n', ee)
-            data.append(line_data)
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                if self.is_eof or (
+                    (end < len(self.buffer))
+                    and (self.buffer[end] not in '0123456789.eE+-')
+                    ):
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.is_eof:
+                    raise
+            self._fill(read_size)
+            read_size *= 2
 
-    return data
 
-def save_records(data_inp, output, is_flush=None):
+def iter_json_array(fp, key=None, chunk_size=None):
+    """Iterate over the items of a json array without loading the whole file
+
+    Only one item (plus one chunk) is kept in memory at a time.
+
+    :param fp: file object opened in text mode
+    :param key: if the top level is an object, iterate over the array at key;
+        other values of the object are skipped
+    :param chunk_size: number of characters read at once
+    """
+
+    if chunk_size is None:
+        chunk_size = 1 << 20
+
+    reader = _JSONStreamReader(fp, chunk_size)
+
+    if reader.peek() == '{':
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            object_key = reader.decode()
+            reader.expect(':')
+            if (object_key == key) and (reader.peek() == '['):
+                break
+            # skip the value
+            reader.decode()
+            if reader.expect(',}') == '}':
+                _logger.warning(f'Could not find array {key} in json')
+                return
+
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.decode()
+        if reader.expect(',]') == ']':
+            return
+
+
+def save_records(data_inp, output, is_flush=None, compression=None):
+    """Append records to a line delimited json file
+
+    The records are serialised in one pass and written with one call,
+    see NDJSONWriter.
+
+    :param data_inp: list of records or a single record
+    :param is_flush: sync the file to disk after writing
+    :param compression: gzip, zstd or None, default to the file extension
+    """
 
     if is_flush is None:
         is_flush = False
@@ -43,12 +379,10 @@ def save_records(data_inp, output, is_flush=None):
         raise Exception('Input data is neither list nor dict: {}'.format(data_inp))
 
     try:
-        with open(output, 'a+') as fp:
-            for i in data:
-                json.dump(i, fp)
-                fp.write('\n')
-                if is_flush:
-                    fp.flush()
+        with _NDJSONWriter(
+            output, compression=compression, append=True, fsync=is_flush
+            ) as writer:
+            writer.write_records(data)
     except Exception as ee:
         raise Exception('Could not load data to file: {}'.format(ee))
 
@@ -132,16 +466,210 @@ def split_dataframe(df_inp, chunk_size=None, chunks=None):
     """
 
     if chunks:
-        chunk_size = int(df_inp.shape[0]/chunks)
+        chunk_size = int(np.ceil(df_inp.shape[0] / chunks))
+    if not chunk_size:
+        chunk_size = max(df_inp.shape[0], 1)
 
+    # slice by position, the index labels can be anything
     batch_df = [
-            df_inp.iloc[df_inp.index[i:i + chunk_size]]
+            df_inp.iloc[i:i + chunk_size]
             for i in range(0, df_inp.shape[0], chunk_size)
             ]
 
     return batch_df
 
 
+def split_file_by_lines(file_path, chunk_size=None):
+    """Split a line delimited file into byte ranges at line boundaries
+
+    :param file_path: path to the file
+    :param chunk_size: approximate size of each range in bytes
+    :return: list of (start, end) byte offsets
+    """
+
+    if chunk_size is None:
+        chunk_size = 1 << 25
+
+    file_size = os.path.getsize(file_path)
+
+    byte_ranges = []
+    with open(file_path, 'rb') as fp:
+        range_start = 0
+        while range_start < file_size:
+            fp.seek(min(range_start + chunk_size, file_size))
+            # move on to the start of the next line
+            fp.readline()
+            range_end = fp.tell()
+            byte_ranges.append((range_start, range_end))
+            range_start = range_end
+
+    return byte_ranges
+
+
+def iter_lines_in_range(fp, range_start, range_end):
+    """Iterate over the lines of a binary file within a byte range
+
+    :param fp: file object opened in binary mode
+    """
+
+    fp.seek(range_start)
+    position = range_start
+    while position < range_end:
+        line = fp.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line
+
+
+# Names of the (longitude, latitude) columns recognised in point files
+POINT_COLUMNS = [
+    ('longitude', 'latitude'),
+    ('lon', 'lat'),
+    ('lng', 'lat'),
+    ('x', 'y')
+]
+
+# Formats of point files by file extension
+POINT_FILE_FORMATS = {
+    ".csv": "csv",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".json": "ndjson",
+    ".parquet": "parquet",
+    ".pq": "parquet"
+}
+
+
+def points_file_format(file_path):
+    """Format of a point file (csv, ndjson or parquet) from its extension
+
+    A .gz extension of csv and ndjson files is ignored.
+    """
+
+    file_root, file_extension = os.path.splitext(file_path.lower())
+    if file_extension == '.gz':
+        file_extension = os.path.splitext(file_root)[1]
+
+    if file_extension not in POINT_FILE_FORMATS:
+        raise ValueError(
+            f'Unknown format of {file_path}, use one of {sorted(POINT_FILE_FORMATS)}'
+            )
+
+    return POINT_FILE_FORMATS[file_extension]
+
+
+def point_columns(columns):
+    """Names of the longitude and latitude columns among columns, see POINT_COLUMNS
+    """
+
+    columns = list(columns)
+    for longitude_column, latitude_column in POINT_COLUMNS:
+        if (longitude_column in columns) and (latitude_column in columns):
+            return longitude_column, latitude_column
+
+    raise ValueError(f'Did not find longitude and latitude columns in {columns}')
+
+
+def _iter_csv_points(file_path, block_size):
+
+    longitude_column, latitude_column = point_columns(
+        pd.read_csv(file_path, nrows=0).columns
+        )
+    for df_block in pd.read_csv(
+        file_path,
+        usecols=[longitude_column, latitude_column],
+        chunksize=block_size,
+        float_precision='round_trip'
+        ):
+        yield df_block[[longitude_column, latitude_column]].values
+
+
+def _iter_ndjson_points(file_path, block_size):
+    """Points of lines with a json object or a [longitude, latitude] array
+    """
+
+    open_file = gzip.open if file_path.lower().endswith('.gz') else open
+    columns = None
+    block = []
+    with open_file(file_path, 'rt') as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            point = json.loads(line)
+            if isinstance(point, dict):
+                if columns is None:
+                    columns = point_columns(point)
+                point = (point[columns[0]], point[columns[1]])
+            block.append(point)
+            if len(block) >= block_size:
+                yield np.array(block, dtype=np.float64).reshape(-1, 2)
+                block = []
+    if block:
+        yield np.array(block, dtype=np.float64).reshape(-1, 2)
+
+
+def _iter_parquet_points(file_path, block_size):
+
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(file_path)
+    columns = point_columns(parquet_file.schema.names)
+    for record_batch in parquet_file.iter_batches(
+        batch_size=block_size, columns=list(columns)
+        ):
+        yield np.column_stack([
+            record_batch.column(i).to_numpy(zero_copy_only=False) for i in range(2)
+        ]).astype(np.float64)
+
+
+def iter_points_file(file_path, chunk_size=None, skip_chunks=None, file_format=None):
+    """Read the points of a csv, ndjson or parquet file in chunks
+
+    Only one chunk is kept in memory at a time. All chunks but the last
+    have exactly chunk_size points, so that a run can be resumed by
+    skipping the chunks already done.
+
+    :param file_path: path to the file, see points_file_format and POINT_COLUMNS
+    :param chunk_size: number of points of a chunk, default to 100000
+    :param skip_chunks: number of chunks to skip at the start
+    :param file_format: csv, ndjson or parquet, default to the file extension
+    :return: generator of arrays of shape (n, 2) with longitude and latitude
+    """
+
+    if chunk_size is None:
+        chunk_size = 100000
+    if skip_chunks is None:
+        skip_chunks = 0
+    if file_format is None:
+        file_format = points_file_format(file_path)
+
+    iter_blocks = {
+        "csv": _iter_csv_points,
+        "ndjson": _iter_ndjson_points,
+        "parquet": _iter_parquet_points
+    }[file_format]
+
+    # the blocks of the readers are cut into chunks of chunk_size
+    skip_points = skip_chunks * chunk_size
+    buffer = []
+    n_buffer = 0
+    for block in iter_blocks(file_path, chunk_size):
+        if skip_points:
+            n_skipped = min(skip_points, len(block))
+            block = block[n_skipped:]
+            skip_points -= n_skipped
+        buffer.append(block)
+        n_buffer += len(block)
+        while n_buffer >= chunk_size:
+            points = np.concatenate(buffer)
+            yield points[:chunk_size]
+            buffer = [points[chunk_size:]]
+            n_buffer -= chunk_size
+    if n_buffer:
+        yield np.concatenate(buffer)
+
+
 def file_exists(file_path):
     """Check if a file exists, if a file is found, the stats will be logged
     """
@@ -157,6 +685,10 @@ def file_exists(file_path):
 
 def distance_between_geom(geom1, geom2, proj):
     """Calculate distance between two shapely objects
+
+    Both geometries are projected on every call; for many queries
+    against the same geometries, project their coordinates once using
+    project_coords and use the distance of the projected objects.
     """
 
     geom1_conv = transform( proj, geom1 )
@@ -165,6 +697,262 @@ def distance_between_geom(geom1, geom2, proj):
     return geom1_conv.distance( geom2_conv )
 
 
+@lru_cache(maxsize=None)
+def get_transformer(from_crs=None, to_crs=None):
+    """Get a reusable transformer between two coordinate reference systems
+
+    Transformers are expensive to create, so they are cached.
+    The axis order is always (longitude, latitude) or (x, y).
+
+    :param from_crs: source crs, default to EPSG:4326
+    :param to_crs: target crs, default to EPSG:32633
+    """
+
+    if from_crs is None:
+        from_crs = 'EPSG:4326'
+    if to_crs is None:
+        to_crs = 'EPSG:32633'
+
+    return pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
+
+def project_coords(coords, transformer=None):
+    """Project an array of coordinates with one call to the transformer
+
+    :param coords: array of shape (m, 2)
+    :param transformer: pyproj Transformer, get_transformer() is used by default
+    :return: array of shape (m, 2)
+    """
+
+    if transformer is None:
+        transformer = get_transformer()
+
+    projected_x, projected_y = transformer.transform(coords[:, 0], coords[:, 1])
+
+    return np.column_stack([projected_x, projected_y]).reshape(-1, 2)
+
+
+def coordinates_to_arrays(geoms_coordinates):
+    """Convert lists of coordinates to a flat coordinate buffer with offsets
+
+    The coordinates of geometry i are ``coords[offsets[i]:offsets[i + 1]]``.
+
+    :param geoms_coordinates: iterable of sequences of (x, y), e.g.,
+        the coordinates of GeoJSON LineStrings
+    :return: (coords of shape (m, 2), offsets of shape (n + 1,))
+    """
+
+    geoms_coordinates = list(geoms_coordinates)
+
+    offsets = np.zeros(len(geoms_coordinates) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(
+        [len(geom_coordinates) for geom_coordinates in geoms_coordinates]
+        )
+
+    coords = np.array(
+        list(chain.from_iterable(geoms_coordinates)), dtype=np.float64
+        ).reshape(-1, 2)
+
+    return coords, offsets
+
+
+def line_strings_to_arrays(geoms):
+    """Convert LineStrings to a flat coordinate buffer with offsets
+
+    :param geoms: iterable of shapely LineStrings
+    :return: (coords of shape (m, 2), offsets of shape (n + 1,))
+    """
+
+    return coordinates_to_arrays(geom.coords for geom in geoms)
+
+
+def arrays_to_line_strings(coords, offsets):
+    """Convert a flat coordinate buffer with offsets back to LineStrings
+
+    This is the inverse of line_strings_to_arrays.
+
+    :return: object array of LineStrings
+    """
+
+    # fill the object array one by one, numpy and pandas would otherwise
+    # try to convert the geometries to arrays of coordinates
+    geoms = np.empty(len(offsets) - 1, dtype=object)
+    for i, (line_start, line_end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        geoms[i] = LineString(coords[line_start:line_end])
+
+    return geoms
+
+
+def line_strings_bounds(coords, offsets):
+    """Bounds of every line of a flat coordinate buffer with offsets
+
+    :return: array of shape (n, 4) with minx, miny, maxx, maxy
+    """
+
+    if len(offsets) < 2:
+        return np.zeros((0, 4), dtype=np.float64)
+
+    line_start = offsets[:-1]
+
+    return np.column_stack([
+        np.minimum.reduceat(coords[:, 0], line_start),
+        np.minimum.reduceat(coords[:, 1], line_start),
+        np.maximum.reduceat(coords[:, 0], line_start),
+        np.maximum.reduceat(coords[:, 1], line_start)
+    ])
+
+
+def parse_bounding_box(bounding_box):
+    """Values of a bounding box
+
+    :param bounding_box: "left,bottom,right,top" as used by osmium, or a
+        sequence of the four values
+    :return tuple: (left, bottom, right, top) as floats
+    """
+
+    if isinstance(bounding_box, str):
+        bounding_box = bounding_box.split(',')
+
+    return tuple(float(x) for x in bounding_box)
+
+
+def geojson_bounds(geometry):
+    """Bounds of a GeoJSON geometry dict without building a shapely geometry
+
+    :return tuple: (left, bottom, right, top), None for geometries without
+        coordinates
+    """
+
+    coordinates = geometry.get('coordinates')
+    if geometry.get('type') == 'LineString':
+        positions = coordinates
+    else:
+        # flatten the nested coordinates of the other geometry types
+        positions = []
+        stack = [coordinates]
+        while stack:
+            value = stack.pop()
+            if not value:
+                continue
+            if isinstance(value[0], (list, tuple)):
+                stack.extend(value)
+            else:
+                positions.append(value)
+    if not positions:
+        return None
+
+    longitudes = [position[0] for position in positions]
+    latitudes = [position[1] for position in positions]
+
+    return min(longitudes), min(latitudes), max(longitudes), max(latitudes)
+
+
+def split_bounding_box(bounding_box, rows, columns):
+    """Split a bounding box into a grid of tiles
+
+    :param bounding_box: "left,bottom,right,top" as used by osmium, or a
+        sequence of the four values
+    :param rows: number of tiles along the latitude
+    :param columns: number of tiles along the longitude
+    :return list: (tile name, "left,bottom,right,top") row by row, from
+        the bottom left tile
+    """
+
+    left, bottom, right, top = parse_bounding_box(bounding_box)
+
+    if (rows < 1) or (columns < 1):
+        raise ValueError(f'Can not split into {rows} x {columns} tiles')
+    if (left >= right) or (bottom >= top):
+        raise ValueError(f'Invalid bounding box: {bounding_box}')
+
+    x_edges = [left + (right - left) * i / columns for i in range(columns)] + [right]
+    y_edges = [bottom + (top - bottom) * i / rows for i in range(rows)] + [top]
+
+    return [
+        (
+            f'tile_{row}_{column}',
+            '{},{},{},{}'.format(
+                x_edges[column], y_edges[row], x_edges[column + 1], y_edges[row + 1]
+                )
+        )
+        for row in range(rows)
+        for column in range(columns)
+    ]
+
+
+def points_to_segments_distance(points, seg_start, seg_end):
+    """Distance between points and line segments, element by element
+
+    The formula is the same as used by GEOS (shapely) for point to
+    segment distances.
+
+    :param points: array of shape (n, 2)
+    :param seg_start: array of shape (n, 2), the start of the segments
+    :param seg_end: array of shape (n, 2), the end of the segments
+    """
+
+    px, py = points[:, 0], points[:, 1]
+    ax, ay = seg_start[:, 0], seg_start[:, 1]
+    bx, by = seg_end[:, 0], seg_end[:, 1]
+
+    dx = bx - ax
+    dy = by - ay
+    len2 = dx * dx + dy * dy
+    is_degenerate = len2 == 0
+    len2_safe = np.where(is_degenerate, 1, len2)
+
+    r = ((px - ax) * dx + (py - ay) * dy) / len2_safe
+    s = ((ay - py) * dx - (ax - px) * dy) / len2_safe
+
+    distance_a = np.sqrt((px - ax) ** 2 + (py - ay) ** 2)
+    distance_b = np.sqrt((px - bx) ** 2 + (py - by) ** 2)
+    distance_ab = np.abs(s) * np.sqrt(len2)
+
+    return np.where(
+        is_degenerate | (r <= 0),
+        distance_a,
+        np.where(r >= 1, distance_b, distance_ab)
+        )
+
+
+def points_to_lines_distance(points, line_ids, coords, offsets):
+    """Distance between points[k] and line line_ids[k] for all k
+
+    All segments of all the requested lines are expanded and measured
+    in one go, then reduced to the minimum for each (point, line) pair.
+
+    :param points: array of shape (n, 2)
+    :param line_ids: array of shape (n,), positions of the lines
+    :param coords: coordinate buffer from line_strings_to_arrays
+    :param offsets: offsets from line_strings_to_arrays
+    :return: array of shape (n,)
+    """
+
+    line_ids = np.asarray(line_ids, dtype=np.int64)
+    if not len(line_ids):
+        return np.zeros(0, dtype=np.float64)
+
+    line_start = offsets[line_ids]
+    line_end = offsets[line_ids + 1]
+    n_segments = np.maximum(line_end - line_start - 1, 1)
+
+    pair_first_segment = np.zeros(len(line_ids), dtype=np.int64)
+    pair_first_segment[1:] = np.cumsum(n_segments)[:-1]
+
+    segment_pair = np.repeat(np.arange(len(line_ids)), n_segments)
+    segment_start = (
+        line_start[segment_pair]
+        + np.arange(len(segment_pair)) - pair_first_segment[segment_pair]
+        )
+    segment_end = np.minimum(segment_start + 1, line_end[segment_pair] - 1)
+
+    distances = points_to_segments_distance(
+        points[segment_pair], coords[segment_start], coords[segment_end]
+        )
+
+    return np.minimum.reduceat(distances, pair_first_segment)
+
+
 def insert_to_dict_at_level(dictionary, dict_key_path, dict_value):
     """Insert values to dictioinary according to path specified
     """
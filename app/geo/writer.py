@@ -0,0 +1,334 @@
+import datetime
+import gzip
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import simplejson as json
+
+logging.basicConfig()
+_logger = logging.getLogger('app.geo.writer')
+
+# Compression of the output by file extension
+COMPRESSIONS = {
+    ".gz": "gzip",
+    ".zst": "zstd",
+    ".zstd": "zstd"
+}
+
+# Columnar formats by file extension, all other files are written as
+# line delimited json
+OUTPUT_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow"
+}
+
+# Default compression levels
+COMPRESSION_LEVELS = {
+    "gzip": 6,
+    "zstd": 3
+}
+
+# Number of bytes of serialised records collected before they are
+# compressed and written
+WRITE_BUFFER_SIZE = 1 << 22
+
+
+def to_json_value(obj):
+    """Convert values simplejson can not serialise, used as its default
+
+    Unlike isoencode, every numpy scalar is converted with one check;
+    python and numpy floats never get here, NaN is written as null by
+    ignore_nan.
+    """
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is pd.NaT:
+        return None
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+_ENCODER = json.JSONEncoder(ignore_nan=True, default=to_json_value)
+
+
+def records_to_ndjson(records):
+    """Serialise records into line delimited json in one pass
+    """
+
+    encode = _ENCODER.encode
+
+    return ''.join([encode(record) + '\n' for record in records])
+
+
+def compression_from_path(file_path):
+    """Compression of a file from its extension: gzip, zstd or None
+    """
+
+    return COMPRESSIONS.get(os.path.splitext(file_path)[1].lower())
+
+
+def compress(data, compression=None, compression_level=None):
+    """Compress bytes into one complete gzip member or zstd frame
+
+    Members and frames can be concatenated, so that compressed files can
+    be appended to and are still read as one stream.
+    """
+
+    if not compression:
+        return data
+
+    if compression_level is None:
+        compression_level = COMPRESSION_LEVELS[compression]
+
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=compression_level)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('zstd compression needs the package zstandard')
+        return zstandard.ZstdCompressor(level=compression_level).compress(data)
+
+    raise ValueError(f'Unknown compression {compression}')
+
+
+class NDJSONWriter(object):
+    """Buffered writer of records as line delimited json
+
+    Records are serialised batch by batch and written once WRITE_BUFFER_SIZE
+    bytes are collected. A new file is written to a temporary file next to
+    output, which replaces output on commit; a crash or abort never leaves
+    a truncated output behind. With append, the records are appended to
+    output directly.
+
+    Use it as context manager, which commits on success and aborts on errors:
+
+    ```
+    with NDJSONWriter('distances.json.gz') as writer:
+        writer.write_records(records)
+    ```
+
+    :param output: path to the output file
+    :param compression: gzip, zstd or None, default to the file extension
+    :param compression_level: default to COMPRESSION_LEVELS
+    :param append: append to output instead of replacing it, default to False
+    :param buffer_size: bytes collected before they are written
+    :param fsync: sync the file to disk on commit, default to True
+    """
+
+    def __init__(
+        self,
+        output,
+        compression=None,
+        compression_level=None,
+        append=None,
+        buffer_size=None,
+        fsync=None
+        ):
+
+        if compression is None:
+            compression = compression_from_path(output)
+        if append is None:
+            append = False
+        if buffer_size is None:
+            buffer_size = WRITE_BUFFER_SIZE
+        if fsync is None:
+            fsync = True
+
+        self.output = output
+        self.compression = compression
+        self.compression_level = compression_level
+        self.append = append
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.records = 0
+        self.bytes_written = 0
+
+        output_dir = os.path.dirname(output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        if append:
+            self.file_path = output
+            self._fp = open(output, 'ab')
+        else:
+            self.file_path = f'{output}.tmp-{os.getpid()}'
+            self._fp = open(self.file_path, 'wb')
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def write_records(self, records):
+        """Serialise and buffer a batch of records
+        """
+
+        data = records_to_ndjson(records).encode('utf-8')
+        self._buffer.append(data)
+        self._buffer_bytes += len(data)
+        self.records += len(records)
+        if self._buffer_bytes >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Compress and write the buffered records
+        """
+
+        if not self._buffer:
+            return
+
+        data = compress(
+            b''.join(self._buffer), self.compression, self.compression_level
+            )
+        self._fp.write(data)
+        self.bytes_written += len(data)
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def commit(self):
+        """Write the remaining records and move the file to output
+        """
+
+        self.flush()
+        self._fp.flush()
+        if self.fsync:
+            os.fsync(self._fp.fileno())
+        self._fp.close()
+        if not self.append:
+            os.replace(self.file_path, self.output)
+
+        _logger.debug(
+            f'Wrote {self.records} records ({self.bytes_written} bytes) to {self.output}'
+            )
+
+    def abort(self):
+        """Drop the records, output is left as it was
+        """
+
+        self._fp.close()
+        if (not self.append) and os.path.isfile(self.file_path):
+            os.remove(self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def output_format_from_path(file_path):
+    """Format of an output file from its extension: parquet, arrow or ndjson
+    """
+
+    return OUTPUT_FORMATS.get(os.path.splitext(file_path)[1].lower(), 'ndjson')
+
+
+class ColumnarWriter(object):
+    """Writer of columns of arrays into a Parquet or Arrow IPC file, via pyarrow
+
+    Every batch of columns is converted to Arrow without building python
+    records and written as one row group (Parquet) or record batch (Arrow).
+    Like NDJSONWriter, the file is written to a temporary file which
+    replaces output on commit; use it as context manager.
+
+    :param output: path to the output file
+    :param columns: list of (name, type) of the columns, where type is an
+        Arrow type alias, e.g., int64, float64 or string
+    :param file_format: parquet or arrow, default to the file extension
+    :param compression: compression of the Parquet columns, default to snappy
+    """
+
+    def __init__(self, output, columns, file_format=None, compression=None):
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception('Parquet and Arrow output need the package pyarrow')
+
+        if file_format is None:
+            file_format = output_format_from_path(output)
+        if file_format not in ('parquet', 'arrow'):
+            raise ValueError(f'Unknown columnar format {file_format}')
+        if compression is None:
+            compression = 'snappy'
+
+        self.output = output
+        self.file_format = file_format
+        self.rows = 0
+        self._pa = pa
+        self.schema = pa.schema([
+            pa.field(name, pa.type_for_alias(column_type))
+            for name, column_type in columns
+        ])
+
+        output_dir = os.path.dirname(output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        self.file_path = f'{output}.tmp-{os.getpid()}'
+        if file_format == 'parquet':
+            self._sink = None
+            self._writer = pq.ParquetWriter(
+                self.file_path, self.schema, compression=compression
+                )
+        else:
+            self._sink = pa.OSFile(self.file_path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self.schema)
+
+    def write_columns(self, columns):
+        """Write a batch of columns
+
+        :param dict columns: name -> array, all of the same length
+        """
+
+        table = self._pa.Table.from_arrays(
+            [
+                self._pa.array(columns[field.name], type=field.type, from_pandas=True)
+                for field in self.schema
+            ],
+            schema=self.schema
+            )
+        self._writer.write_table(table)
+        self.rows += table.num_rows
+
+    def _close(self):
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+
+    def commit(self):
+        """Close the file and move it to output
+        """
+
+        self._close()
+        os.replace(self.file_path, self.output)
+
+        _logger.debug(f'Wrote {self.rows} rows to {self.output}')
+
+    def abort(self):
+        """Drop the file, output is left as it was
+        """
+
+        self._close()
+        if os.path.isfile(self.file_path):
+            os.remove(self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
@@ -0,0 +1,236 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+
+import pandas as pd
+
+from app.distance_calculator import attach_street_store as _attach_street_store
+from app.distance_calculator import distances_to_records as _distances_to_records
+from app.distance_calculator import parse_geo_points as _parse_geo_points
+from app.distance_calculator import save_street_store as _save_street_store
+from app.distance_calculator import street_distances_to_points as _street_distances_to_points
+from app.distance_calculator import street_query_arrays as _street_query_arrays
+from app.geo.util import split_dataframe as _split_dataframe
+
+logging.basicConfig()
+_logger = logging.getLogger('app.query-executor')
+
+# Number of points answered by one task of the process pool
+QUERY_CHUNK_SIZE = 1000
+
+# Columns and Arrow types of distances_to_columns
+DISTANCE_COLUMNS = [
+    ('point_index', 'int64'),
+    ('longitude', 'float64'),
+    ('latitude', 'float64'),
+    ('id', 'string'),
+    ('name', 'string'),
+    ('highway', 'string'),
+    ('distance', 'float64')
+]
+
+# Streets of the worker process: (street store, spatial index, query arrays)
+_WORKER_STREETS = None
+
+
+def _set_worker_streets(street_store, street_index):
+
+    global _WORKER_STREETS
+    _WORKER_STREETS = (
+        street_store, street_index, _street_query_arrays(street_store)
+        )
+
+
+def _init_worker(cache_dir):
+    """Attach a worker process to the street cache, run by the process pool
+    """
+
+    street_data = _attach_street_store(cache_dir)
+    if street_data is None:
+        _logger.error(f'Could not attach to street cache {cache_dir}')
+        return
+    _set_worker_streets(*street_data)
+
+
+def distances_to_columns(df_distances, points, point_offset=None):
+    """Columns of the result of street_distances_to_points for columnar output
+
+    :param points: array of the (longitude, latitude) of the query
+    :param point_offset: index of the first point, added to point_index
+    :return dict: point_index, longitude, latitude, id, name, highway and
+        distance, see DISTANCE_COLUMNS
+    """
+
+    if point_offset is None:
+        point_offset = 0
+
+    point_index = df_distances['point_index'].values
+
+    return {
+        "point_index": point_index + point_offset,
+        "longitude": points[point_index, 0],
+        "latitude": points[point_index, 1],
+        "id": df_distances['id'].values,
+        "name": df_distances['name'].values,
+        "highway": df_distances['highway'].values,
+        "distance": df_distances['distance'].values
+    }
+
+
+def _query_chunk(job):
+    """Answer the points of a chunk, run by the process pool
+    """
+
+    chunk_index, point_offset, points, max_distance, top_k, as_columns = job
+    if _WORKER_STREETS is None:
+        raise Exception(f'Worker {os.getpid()} has no streets to answer chunk {chunk_index}')
+    street_store, street_index, street_arrays = _WORKER_STREETS
+
+    start_time = time.time()
+    df_distances = _street_distances_to_points(
+        points, street_store,
+        max_distance=max_distance,
+        street_index=street_index,
+        top_k=top_k,
+        street_arrays=street_arrays
+        )
+    if as_columns:
+        res = distances_to_columns(df_distances, points, point_offset=point_offset)
+    else:
+        res = _distances_to_records(df_distances, len(points))
+
+    return res, {
+        "chunk": chunk_index,
+        "worker": os.getpid(),
+        "points": len(points),
+        "rows": len(df_distances),
+        "seconds": time.time() - start_time
+    }
+
+
+def _iter_jobs(point_chunks, max_distance, top_k, as_columns, point_offset):
+
+    for chunk_index, points in enumerate(point_chunks):
+        yield chunk_index, point_offset, points, max_distance, top_k, as_columns
+        point_offset += len(points)
+
+
+def split_points(geo_points, chunk_size=None):
+    """Split points into chunks of chunk_size points
+
+    :param geo_points: (longitude,latitude) points
+    :param chunk_size: number of points of a chunk, default to QUERY_CHUNK_SIZE
+    :return: list of arrays of shape (n, 2)
+    """
+
+    if chunk_size is None:
+        chunk_size = QUERY_CHUNK_SIZE
+
+    df_points = pd.DataFrame(
+        _parse_geo_points(geo_points), columns=['longitude', 'latitude']
+        )
+
+    return [
+        df_chunk.values for df_chunk in _split_dataframe(df_points, chunk_size=chunk_size)
+    ]
+
+
+def iter_parallel_distances(
+    street_store,
+    street_index,
+    point_chunks,
+    max_distance=None,
+    top_k=None,
+    workers=None,
+    chunk_stats=None,
+    as_columns=None,
+    point_offset=None
+    ):
+    """Answer chunks of points across a process pool, in the order of the chunks
+
+    The workers share one read-only copy of the streets by mapping the
+    street cache street_store is mapped from (see attach_street_store).
+    Streets which are not mapped from a cache, e.g., without the cache or
+    if an outdated cache could not be rebuilt, are saved to a temporary
+    cache for the duration of the run, so that the workers answer from the
+    same streets as this process whatever the start method of the pool
+    (fork, spawn or forkserver). At most two chunks per worker are read
+    ahead, so that point_chunks can stream from a file.
+
+    :param street_store: StreetStore as returned by load_street_store
+    :param street_index: spatial index of the streets
+    :param point_chunks: iterable of arrays of (longitude,latitude) points,
+        e.g., from split_points or iter_points_file
+    :param workers: number of processes, default to 1 (no process pool)
+    :param list chunk_stats: receives the timing of every chunk
+    :param as_columns: return the columns of distances_to_columns instead
+        of records, default to False
+    :param point_offset: index of the first point, e.g., when resuming
+    :return: generator of the records of every chunk, one {"records": [...]}
+        per point like geo_distance_calculator, or of the columns of every chunk
+    """
+
+    if workers is None:
+        workers = 1
+    if point_offset is None:
+        point_offset = 0
+
+    jobs = _iter_jobs(point_chunks, max_distance, top_k, bool(as_columns), point_offset)
+
+    _set_worker_streets(street_store, street_index)
+
+    start_time = time.time()
+    n_points = 0
+    pool = None
+    temp_dir = None
+    try:
+        if workers > 1:
+            cache_dir = getattr(street_store, 'cache_dir', None)
+            if cache_dir is None:
+                temp_dir = tempfile.mkdtemp(prefix='street-cache-')
+                cache_dir = os.path.join(temp_dir, 'streets')
+                _save_street_store(cache_dir, street_store, street_index, None)
+            pool = multiprocessing.Pool(
+                workers, initializer=_init_worker, initargs=(cache_dir,)
+                )
+            chunk_results = _iter_ordered_results(pool, jobs, 2 * workers)
+        else:
+            chunk_results = map(_query_chunk, jobs)
+
+        for records, stats in chunk_results:
+            _logger.info(
+                f'Chunk {stats["chunk"]}: {stats["points"]} points in '
+                f'{stats["seconds"]:.3f} seconds on worker {stats["worker"]}'
+                )
+            n_points += stats['points']
+            if chunk_stats is not None:
+                chunk_stats.append(stats)
+            yield records
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    seconds = time.time() - start_time
+    _logger.info(
+        f'Answered {n_points} points with {workers} workers in {seconds} seconds'
+        )
+
+
+def _iter_ordered_results(pool, jobs, max_pending):
+    """Results of _query_chunk for jobs, in order, with at most max_pending jobs queued
+    """
+
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(_query_chunk, (job,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
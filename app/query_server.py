@@ -0,0 +1,426 @@
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import simplejson as json
+
+from app.distance_calculator import distances_to_records as _distances_to_records
+from app.distance_calculator import load_street_store as _load_street_store
+from app.distance_calculator import parse_geo_points as _parse_geo_points
+from app.distance_calculator import street_distances_to_points as _street_distances_to_points
+from app.distance_calculator import street_query_arrays as _street_query_arrays
+from app.geo.util import isoencode as _isoencode
+
+logging.basicConfig()
+_logger = logging.getLogger('app.query-server')
+
+# Max number of points answered with one query, and the time in seconds a
+# request waits for other requests to join its batch
+MAX_BATCH_POINTS = 1024
+MAX_BATCH_WAIT = 0.002
+
+# Number of the latest requests used for the latency percentiles
+LATENCY_WINDOW = 10000
+LATENCY_PERCENTILES = [50, 90, 95, 99]
+
+
+class LatencyStats(object):
+    """Thread-safe latency and batch size statistics of a server
+
+    :param window: number of the latest latencies kept for the percentiles
+    """
+
+    def __init__(self, window=None):
+
+        if window is None:
+            window = LATENCY_WINDOW
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._batch_points = deque(maxlen=window)
+        self._start_time = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.points = 0
+
+    def add_request(self, seconds, is_error=None):
+        with self._lock:
+            self._latencies.append(seconds)
+            self.requests += 1
+            if is_error:
+                self.errors += 1
+
+    def add_batch(self, n_requests, n_points):
+        with self._lock:
+            self._batch_points.append(n_points)
+            self.batches += 1
+            self.points += n_points
+
+    def summary(self):
+        """Counters and the percentiles of the latency in milliseconds
+        """
+
+        with self._lock:
+            latencies = np.array(self._latencies, dtype=np.float64) * 1000
+            batch_points = np.array(self._batch_points, dtype=np.float64)
+            res = {
+                "uptime_seconds": time.time() - self._start_time,
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "points": self.points
+            }
+
+        res['latency_ms'] = {
+            f'p{percentile}': (
+                float(np.percentile(latencies, percentile)) if len(latencies) else None
+                )
+            for percentile in LATENCY_PERCENTILES
+        }
+        res['latency_ms']['mean'] = float(latencies.mean()) if len(latencies) else None
+        res['mean_batch_points'] = (
+            float(batch_points.mean()) if len(batch_points) else None
+            )
+
+        return res
+
+
+class MicroBatcher(object):
+    """Combine concurrent queries into batches answered by one call
+
+    Requests are collected until MAX_BATCH_POINTS points are waiting or
+    the first request has waited MAX_BATCH_WAIT seconds. Requests with the
+    same options are answered together by one call of query.
+
+    :param query: callable(points, max_distance, top_k) returning one result
+        per point
+    :param max_batch_points: max number of points of a batch
+    :param max_wait: max seconds a request waits for others to join
+    :param stats: LatencyStats receiving the batch sizes
+    """
+
+    def __init__(self, query, max_batch_points=None, max_wait=None, stats=None):
+
+        if max_batch_points is None:
+            max_batch_points = MAX_BATCH_POINTS
+        if max_wait is None:
+            max_wait = MAX_BATCH_WAIT
+
+        self._query = query
+        self._max_batch_points = max_batch_points
+        self._max_wait = max_wait
+        self._stats = stats
+        self._requests = queue.Queue()
+        self._is_closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, points, max_distance=None, top_k=None):
+        """Queue a query and return a Future of its results
+        """
+
+        if self._is_closed:
+            raise RuntimeError('MicroBatcher is closed')
+
+        future = Future()
+        self._requests.put((points, max_distance, top_k, future))
+
+        return future
+
+    def close(self):
+        self._is_closed = True
+        self._requests.put(None)
+        self._thread.join()
+
+    def _run(self):
+
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+
+            batch = [request]
+            n_points = len(request[0])
+            deadline = time.perf_counter() + self._max_wait
+            is_closing = False
+            while n_points < self._max_batch_points:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    is_closing = True
+                    break
+                batch.append(request)
+                n_points += len(request[0])
+
+            self._answer(batch)
+            if is_closing:
+                return
+
+    def _answer(self, batch):
+
+        batch_groups = {}
+        for request in batch:
+            batch_groups.setdefault((request[1], request[2]), []).append(request)
+
+        for (max_distance, top_k), requests in batch_groups.items():
+            points = np.concatenate([request[0] for request in requests])
+            try:
+                results = self._query(points, max_distance, top_k)
+            except Exception as ee:
+                _logger.exception('Query failed')
+                for request in requests:
+                    request[3].set_exception(ee)
+                continue
+
+            if self._stats is not None:
+                self._stats.add_batch(len(requests), len(points))
+
+            request_start = 0
+            for request in requests:
+                request_end = request_start + len(request[0])
+                request[3].set_result(results[request_start:request_end])
+                request_start = request_end
+
+
+def street_query(streets_df, street_index):
+    """Query callable of a MicroBatcher for prepared street data
+
+    The arrays needed for the distances are computed once here instead of
+    for every query.
+    """
+
+    street_arrays = _street_query_arrays(streets_df)
+
+    def query(points, max_distance=None, top_k=None):
+        df_distances = _street_distances_to_points(
+            points, streets_df,
+            max_distance=max_distance,
+            street_index=street_index,
+            top_k=top_k,
+            street_arrays=street_arrays
+            )
+        return _distances_to_records(df_distances, len(points))
+
+    return query
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """HTTP API of the query server
+
+    * ``GET /nearest?point=lon,lat&point=...&max_distance=...&top_k=...``
+    * ``POST /nearest`` with ``{"points": [[lon, lat], ...], "max_distance": ..., "top_k": ...}``
+    * ``GET /stats`` with counters and latency percentiles
+    * ``GET /health``
+
+    /nearest answers with ``{"data": [{"records": [...]}, ...]}``, one entry
+    per point, like geo_distance_calculator.
+    """
+
+    server_version = 'StreetDistanceServer/1.0'
+
+    def address_string(self):
+        # client_address is empty for unix sockets
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return 'unix'
+
+    def log_message(self, format, *args):
+        _logger.debug('%s - %s', self.address_string(), format % args)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ignore_nan=True, default=_isoencode).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer_query(self, points, max_distance, top_k):
+        start_time = time.perf_counter()
+        is_error = True
+        try:
+            points = _parse_geo_points(points)
+            if not np.isfinite(points).all():
+                raise ValueError('points have to be finite (longitude,latitude) pairs')
+            max_distance = float(max_distance) if max_distance not in (None, '') else None
+            top_k = int(top_k) if top_k not in (None, '') else None
+        except (ValueError, TypeError, SyntaxError) as ee:
+            self._send_json(400, {"error": f'Invalid query: {ee}'})
+            self.server.stats.add_request(time.perf_counter() - start_time, is_error)
+            return
+
+        try:
+            records = self.server.batcher.submit(
+                points, max_distance=max_distance, top_k=top_k
+                ).result()
+            self._send_json(200, {"data": records})
+            is_error = False
+        except Exception as ee:
+            self._send_json(500, {"error": repr(ee)})
+        finally:
+            self.server.stats.add_request(time.perf_counter() - start_time, is_error)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/nearest':
+            query = parse_qs(url.query)
+            self._answer_query(
+                query.get('point', []),
+                query.get('max_distance', [None])[0],
+                query.get('top_k', [None])[0]
+                )
+        elif url.path == '/stats':
+            self._send_json(200, self.server.stats.summary())
+        elif url.path == '/health':
+            self._send_json(200, {"status": "ok", "streets": self.server.n_streets})
+        else:
+            self._send_json(404, {"error": f'Unknown path: {url.path}'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/nearest':
+            self._send_json(404, {"error": f'Unknown path: {url.path}'})
+            return
+
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+            query = json.loads(self.rfile.read(content_length) or b'{}')
+            if not isinstance(query, dict):
+                raise ValueError('the body has to be a json object')
+        except ValueError as ee:
+            self._send_json(400, {"error": f'Invalid json: {ee}'})
+            return
+
+        self._answer_query(
+            query.get('points', []),
+            query.get('max_distance'),
+            query.get('top_k')
+            )
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTPServer handling every request in a thread
+    """
+
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ThreadingHTTPServer listening on a unix socket
+    """
+
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def create_query_server(
+    streets_df,
+    street_index,
+    host=None,
+    port=None,
+    unix_socket=None,
+    max_batch_points=None,
+    max_wait=None
+    ):
+    """Create a server answering nearest street queries for prepared streets
+
+    :param streets_df: StreetStore or street GeoDataFrame as returned by
+        prepare_street_data
+    :param street_index: spatial index of the streets
+    :param host: host of the http server, default to 127.0.0.1
+    :param port: port of the http server, default to 8080; 0 picks a free port
+    :param unix_socket: path of a unix socket to listen on instead of host and port
+    :param max_batch_points: see MicroBatcher
+    :param max_wait: see MicroBatcher
+    :return: the server, call serve_forever to start it
+    """
+
+    if host is None:
+        host = '127.0.0.1'
+    if port is None:
+        port = 8080
+
+    if unix_socket:
+        server = UnixHTTPServer(unix_socket, QueryRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+
+    server.stats = LatencyStats()
+    server.batcher = MicroBatcher(
+        street_query(streets_df, street_index),
+        max_batch_points=max_batch_points,
+        max_wait=max_wait,
+        stats=server.stats
+        )
+    server.n_streets = len(streets_df)
+
+    return server
+
+
+def serve(
+    street_resource,
+    schema,
+    host=None,
+    port=None,
+    unix_socket=None,
+    use_cache=None,
+    dtype=None,
+    max_batch_points=None,
+    max_wait=None
+    ):
+    """Load the streets of a city once and answer queries until interrupted
+
+    :param dtype: dtype of the street coordinates, see prepare_street_store
+    """
+
+    start_time = time.time()
+    streets_df, street_index = _load_street_store(
+        street_resource, schema, use_cache=use_cache, dtype=dtype
+        )
+    _logger.info(
+        f'Loaded {len(streets_df)} streets in {time.time() - start_time} seconds'
+        )
+
+    server = create_query_server(
+        streets_df, street_index,
+        host=host,
+        port=port,
+        unix_socket=unix_socket,
+        max_batch_points=max_batch_points,
+        max_wait=max_wait
+        )
+
+    if unix_socket:
+        _logger.info(f'Serving on unix socket {unix_socket}')
+    else:
+        _logger.info(f'Serving on http://{server.server_name}:{server.server_port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
@@ -0,0 +1,72 @@
+import random
+
+import simplejson as json
+
+
+def generate_street_records(
+    n_streets, center=None, span=None, observation_date=None, seed=None
+    ):
+    """Generate transformed street records in the format of transformed_json_file
+
+    :param n_streets: number of street records
+    :param center: (longitude, latitude) of the generated city
+    :param span: width and height of the city in degrees
+    """
+
+    if center is None:
+        center = (13.4, 52.5)
+    if span is None:
+        span = 0.3
+    if observation_date is None:
+        observation_date = '2019-05-01'
+
+    rand = random.Random(seed)
+    highways = ['residential', 'primary', 'secondary', 'tertiary', 'service']
+
+    for i in range(n_streets):
+        longitude = center[0] + (rand.random() - 0.5) * span
+        latitude = center[1] + (rand.random() - 0.5) * span
+        coordinates = [[longitude, latitude]]
+        for _ in range(rand.randint(1, 8)):
+            longitude += rand.uniform(-1e-3, 1e-3)
+            latitude += rand.uniform(-1e-3, 1e-3)
+            coordinates.append([longitude, latitude])
+
+        yield {
+            "id": "way/{}".format(1000 + i),
+            "name": "Street {}".format(rand.randint(0, n_streets // 4)),
+            "geometry": str({"type": "LineString", "coordinates": coordinates}),
+            "types": {"highway": rand.choice(highways)},
+            "observation_date": observation_date
+        }
+
+
+def generate_points(n_points, center=None, span=None, seed=None):
+    """Generate (longitude, latitude) query points inside the generated city
+    """
+
+    if center is None:
+        center = (13.4, 52.5)
+    if span is None:
+        span = 0.3
+
+    rand = random.Random(seed)
+
+    return [
+        (
+            center[0] + (rand.random() - 0.5) * span,
+            center[1] + (rand.random() - 0.5) * span
+        )
+        for _ in range(n_points)
+    ]
+
+
+def write_street_records(records, file_path):
+    """Write records as line delimited json
+    """
+
+    with open(file_path, 'w') as fp:
+        for record in records:
+            fp.write(json.dumps(record) + '\n')
+
+    return file_path
@@ -0,0 +1,102 @@
+"""Throughput and peak memory of load_ndjson vs. the previous load_records
+
+The last variant pushes the columns and the filters of load_street_store
+down into the loader.
+
+Run from the root of the repository:
+
+    python -m benchmarks.load_records --streets 200000
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from app.distance_calculator import STREET_RECORD_COLUMNS
+from app.distance_calculator import street_record_filter
+from app.geo.util import load_ndjson
+from benchmarks.fixtures import generate_street_records
+from benchmarks.fixtures import write_street_records
+
+
+def legacy_load_records(data_path_inp):
+    """load_records before the bulk loader, including its null replacement
+    """
+
+    data = []
+
+    with open(data_path_inp, 'r') as fp:
+        for line in fp:
+            line = line.replace('null', ' "None" ')
+            try:
+                line_data = json.loads(line.strip())
+            except Exception as ee:
+                logging.warning('could not load ', line, '\n', ee)
+            data.append(line_data)
+
+    return data
+
+
+def measure(name, load, file_path):
+
+    start_time = time.time()
+    df_loaded = load(file_path)
+    seconds = time.time() - start_time
+    del df_loaded
+
+    # tracing slows the loaders down, so the memory is measured in a second run
+    tracemalloc.start()
+    df_loaded = load(file_path)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    file_size = os.path.getsize(file_path)
+    print(
+        '{:<36} {:>8.2f} s {:>8.1f} MB/s {:>8.1f} MB peak {:>9} rows'.format(
+            name, seconds, file_size / 1e6 / seconds, peak_bytes / 1e6, len(df_loaded)
+            )
+        )
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='NDJSON loader benchmark')
+    parser.add_argument('--streets', type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = write_street_records(
+            generate_street_records(args.streets, seed=42),
+            os.path.join(temp_dir, 'streets.json')
+            )
+        print(f'{os.path.getsize(file_path) / 1e6:.1f} MB, {args.streets} records')
+
+        measure(
+            'load_records + DataFrame (previous)',
+            lambda x: pd.DataFrame(legacy_load_records(x)),
+            file_path
+            )
+        measure('load_ndjson', load_ndjson, file_path)
+        measure(
+            'load_ndjson, 4 columns',
+            lambda x: load_ndjson(x, columns=['id', 'name', 'geometry', 'types']),
+            file_path
+            )
+        measure(
+            'load_ndjson, streets pushed down',
+            lambda x: load_ndjson(
+                x,
+                columns=STREET_RECORD_COLUMNS,
+                record_filter=street_record_filter(geometry_types=['LineString'])
+                ),
+            file_path
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Per query cost of projecting streets on every query vs. projecting them once
+
+Run from the root of the repository:
+
+    python -m benchmarks.projection --streets 2000 --points 5
+"""
+import argparse
+import time
+from functools import partial
+
+import geopandas as gpd
+import pyproj
+from shapely.geometry import Point
+
+from app.distance_calculator import PROJECT
+from app.distance_calculator import prepare_street_data
+from app.distance_calculator import street_distance_to_point
+from app.geo.util import distance_between_geom
+from benchmarks.fixtures import generate_points
+from benchmarks.fixtures import generate_street_records
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Projection benchmark')
+    parser.add_argument('--streets', type=int, default=2000)
+    parser.add_argument('--points', type=int, default=5)
+    args = parser.parse_args()
+
+    df_streets, street_index = prepare_street_data(
+        gpd.GeoDataFrame(list(generate_street_records(args.streets, seed=42)))
+        )
+    geo_points = generate_points(args.points, seed=42)
+
+    # projection of every street on every query, as before
+    per_geometry_projections = {'transformer': PROJECT}
+    if hasattr(pyproj, 'transform'):
+        per_geometry_projections['legacy pyproj.transform'] = partial(
+            pyproj.transform,
+            pyproj.Proj(init='EPSG:4326'),
+            pyproj.Proj(init='EPSG:32633')
+            )
+
+    for projection_name, projection in per_geometry_projections.items():
+        start_time = time.time()
+        for geo_point in geo_points:
+            geo_point = Point(geo_point)
+            df_streets.geometry.apply(
+                lambda x: distance_between_geom(x, geo_point, projection)
+                )
+        per_query = (time.time() - start_time) / len(geo_points)
+        print(f'project per query ({projection_name}): {per_query:.4f} s/query')
+
+    # streets projected in prepare_street_data, only the point is projected
+    start_time = time.time()
+    for geo_point in geo_points:
+        geo_point_projected = Point(PROJECT(*geo_point))
+        df_streets['geometry_projected'].apply(geo_point_projected.distance)
+    per_query = (time.time() - start_time) / len(geo_points)
+    print(f'projected once: {per_query:.4f} s/query')
+
+    start_time = time.time()
+    for geo_point in geo_points:
+        street_distance_to_point(geo_point, df_streets, street_index=street_index)
+    per_query = (time.time() - start_time) / len(geo_points)
+    print(f'projected once, full street_distance_to_point: {per_query:.4f} s/query')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Memory of prepared street data as GeoDataFrame vs. StreetStore
+
+Every variant is prepared in a fresh process, the resident memory kept
+after the input records are released is reported.
+
+Run from the root of the repository (linux only, reads /proc):
+
+    python -m benchmarks.street_store --streets 200000
+"""
+import argparse
+import ctypes
+import gc
+import multiprocessing
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+
+from app.distance_calculator import prepare_street_data
+from app.distance_calculator import prepare_street_store
+from benchmarks.fixtures import generate_street_records
+
+
+def resident_bytes():
+    """Resident memory of this process
+
+    Freed memory is first returned to the system, so that only the memory
+    still in use is counted.
+    """
+
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(variant, n_streets):
+    """Prepare the generated streets as variant and measure the memory kept
+    """
+
+    memory_before = resident_bytes()
+    df_inp = gpd.GeoDataFrame(list(generate_street_records(n_streets, seed=42)))
+
+    start_time = time.time()
+    if variant == 'GeoDataFrame':
+        streets, _ = prepare_street_data(df_inp)
+        nbytes = None
+    else:
+        streets, _ = prepare_street_store(
+            df_inp, dtype=np.float32 if variant.endswith('float32') else None
+            )
+        nbytes = streets.nbytes
+    seconds = time.time() - start_time
+
+    del df_inp
+
+    return {
+        "variant": variant,
+        "seconds": seconds,
+        "resident_bytes": resident_bytes() - memory_before,
+        "nbytes": nbytes
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Street store memory benchmark')
+    parser.add_argument('--streets', type=int, default=200000)
+    args = parser.parse_args()
+
+    variants = ['GeoDataFrame', 'StreetStore', 'StreetStore float32']
+    context = multiprocessing.get_context('fork')
+    results = []
+    for variant in variants:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(measure, (variant, args.streets)))
+
+    baseline = results[0]['resident_bytes']
+    for res in results:
+        nbytes = '' if res['nbytes'] is None else '{:.1f} MB'.format(res['nbytes'] / 1e6)
+        print(
+            '{:<20} {:>8.1f} MB resident {:>6.1f}x smaller {:>10} arrays {:>6.2f} s'.format(
+                res['variant'],
+                res['resident_bytes'] / 1e6,
+                baseline / max(res['resident_bytes'], 1),
+                nbytes,
+                res['seconds']
+                )
+            )
+
+
+if __name__ == '__main__':
+    main()